@@ -0,0 +1,419 @@
+"""
+Shared resolution of the lookup entities referenced by name or code from
+guides and spreadsheets: hospitals, surgeons, anesthesiologists (cooperados),
+convênios and ProcedimentoDetalhes.
+
+Each (kind, group) table is loaded once into a process-level LRU of
+``{lowercased name: instance}`` snapshots. A per-kind version stamp, kept in
+the Django cache and bumped by post_save/post_delete signals (see
+agenda.signals), invalidates the snapshots of every process sharing that
+cache; snapshots also expire after ENTITY_CACHE_TTL_SECONDS as a bound on
+staleness with a per-process cache backend. ProcedimentoDetalhes is never
+scanned: codes are looked up case-insensitively one by one and remembered,
+misses included.
+
+The name snapshots are never modified once loaded, and the code cache only
+records what the database returned. Each EntityResolver writes its own
+additions (rows it created, similar-name aliases) to an EntityOverlay over the
+shared snapshot, so they stay local to one run or request.
+
+Cached instances are shared between requests and threads: assign them to
+foreign keys, but never modify them.
+"""
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from django.core.cache import cache
+from django.db.models.functions import Lower
+
+from financas.matching import NameSimilarity, first_similar
+from registration.models import Anesthesiologist, HospitalClinic, Surgeon
+
+from .models import Convenios, ProcedimentoDetalhes
+
+
+ENTITY_CACHE_SIZE = 128
+ENTITY_CACHE_TTL_SECONDS = 600
+
+ENTITY_KINDS = {
+    'hospital': (HospitalClinic, True),
+    'surgeon': (Surgeon, True),
+    'anesthesiologist': (Anesthesiologist, True),
+    'convenio': (Convenios, False),
+    'procedimento_detalhe': (ProcedimentoDetalhes, False),
+}
+MODEL_KINDS = {model: kind for kind, (model, _) in ENTITY_KINDS.items()}
+
+_snapshots = OrderedDict()
+_lock = threading.Lock()
+
+
+def _version_key(kind):
+    return f'entities:version:{kind}'
+
+
+def entity_version(kind):
+    return cache.get(_version_key(kind), 0)
+
+
+def bump_entity_version(kind):
+    """Invalidate every cached snapshot of kind (called from the model signals)."""
+    try:
+        cache.incr(_version_key(kind))
+    except ValueError:
+        cache.set(_version_key(kind), 1, None)
+
+
+def clear_entity_cache():
+    with _lock:
+        _snapshots.clear()
+
+
+def code_key(code):
+    """Cache key of a codigo_procedimento: stripped and lowercased."""
+    return str(code).strip().lower()
+
+
+class CodeCache(dict):
+    """
+    {codigo_procedimento: ProcedimentoDetalhes or None} filled on demand,
+    one query per unseen code instead of a scan of the whole table. Codes
+    are matched case-insensitively (keys go through code_key()).
+    """
+
+    def known(self, code):
+        """True if code was already looked up (found or not), without querying."""
+        return dict.__contains__(self, code_key(code))
+
+    def __contains__(self, code):
+        key = code_key(code)
+        if not dict.__contains__(self, key):
+            dict.__setitem__(
+                self, key,
+                ProcedimentoDetalhes.objects.filter(codigo_procedimento__iexact=key).order_by('pk').first(),
+            )
+        return dict.__getitem__(self, key) is not None
+
+    def __getitem__(self, code):
+        self.__contains__(code)
+        return dict.__getitem__(self, code_key(code))
+
+    def __setitem__(self, code, detalhe):
+        dict.__setitem__(self, code_key(code), detalhe)
+
+    def get(self, code, default=None):
+        return self[code] if code in self else default
+
+
+class EntityOverlay(MutableMapping):
+    """
+    Copy-on-write view of a shared snapshot: reads fall through to it,
+    writes stay in this overlay. Iterates the snapshot's keys first, then
+    the added ones, like a dict the additions were appended to.
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.added = {}
+        self._key = code_key if isinstance(shared, CodeCache) else (lambda key: key)
+
+    def __getitem__(self, key):
+        key = self._key(key)
+        if key in self.added:
+            return self.added[key]
+        return self.shared[key]
+
+    def __contains__(self, key):
+        key = self._key(key)
+        return key in self.added or key in self.shared
+
+    def __setitem__(self, key, value):
+        self.added[self._key(key)] = value
+
+    def __delitem__(self, key):
+        del self.added[self._key(key)]
+
+    def __iter__(self):
+        yield from self.shared
+        for key in self.added:
+            if not dict.__contains__(self.shared, key):
+                yield key
+
+    def __len__(self):
+        return len(self.shared) + sum(1 for key in self.added if not dict.__contains__(self.shared, key))
+
+    def known(self, code):
+        return self._key(code) in self.added or self.shared.known(code)
+
+
+def _load(kind, group_id):
+    model, per_group = ENTITY_KINDS[kind]
+    if kind == 'procedimento_detalhe':
+        return CodeCache()
+    queryset = model.objects.filter(group_id=group_id) if per_group else model.objects.all()
+    entities = {}
+    for entity in queryset.order_by('pk'):
+        if entity.name:
+            entities.setdefault(entity.name.lower(), entity)
+    return entities
+
+
+def entity_snapshot(kind, group_id=None):
+    """Shared {lowercased name (or code): instance} dict for kind and group."""
+    if not ENTITY_KINDS[kind][1]:
+        group_id = None
+    key = (kind, group_id)
+    version = entity_version(kind)
+    now = time.monotonic()
+    with _lock:
+        cached = _snapshots.get(key)
+        if cached and cached[0] == version and now - cached[1] < ENTITY_CACHE_TTL_SECONDS:
+            _snapshots.move_to_end(key)
+            return cached[2]
+    entities = _load(kind, group_id)
+    with _lock:
+        _snapshots[key] = (version, now, entities)
+        _snapshots.move_to_end(key)
+        while len(_snapshots) > ENTITY_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+    return entities
+
+
+class EntityResolver:
+    """
+    Per-group access to the shared entity snapshots.
+
+    A resolver pins each snapshot on first use, so one run or request keeps
+    working on the same dicts even if the version changes meanwhile; create a
+    new resolver to see invalidations. The mapping properties, an EntityOverlay
+    over each snapshot, are the caches handed to the conciliation helpers
+    (financas.engine.update_procedimento_with_api_data_cached and friends),
+    which may write to them freely; the lookup methods resolve a single name case-insensitively,
+    falling back to the database when the snapshot is older than a row created
+    by another process.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.group_id = group.pk if group else None
+        self._pinned = {}
+
+    def _snapshot(self, kind):
+        if kind not in self._pinned:
+            self._pinned[kind] = EntityOverlay(entity_snapshot(kind, self.group_id))
+        return self._pinned[kind]
+
+    @property
+    def hospitals(self):
+        return self._snapshot('hospital')
+
+    @property
+    def surgeons(self):
+        return self._snapshot('surgeon')
+
+    @property
+    def anesthesiologists(self):
+        return self._snapshot('anesthesiologist')
+
+    @property
+    def convenios(self):
+        return self._snapshot('convenio')
+
+    @property
+    def procedimento_detalhes(self):
+        return self._snapshot('procedimento_detalhe')
+
+    def _lookup(self, kind, entities, name):
+        if not name or not str(name).strip():
+            return None
+        name = str(name).strip()
+        key = name.lower()
+        if key in entities:
+            return entities[key]
+        model, per_group = ENTITY_KINDS[kind]
+        queryset = model.objects.filter(name__iexact=name)
+        if per_group:
+            queryset = queryset.filter(group_id=self.group_id)
+        entity = queryset.order_by('pk').first()
+        if entity:
+            entities[key] = entity
+        return entity
+
+    def hospital(self, name):
+        return self._lookup('hospital', self.hospitals, name)
+
+    def surgeon(self, name):
+        return self._lookup('surgeon', self.surgeons, name)
+
+    def anesthesiologist(self, name):
+        return self._lookup('anesthesiologist', self.anesthesiologists, name)
+
+    def convenio(self, name):
+        return self._lookup('convenio', self.convenios, name)
+
+    def get_or_create_convenio(self, name):
+        convenio = self.convenio(name)
+        if convenio is None:
+            convenio, _ = Convenios.objects.get_or_create(name=name.strip())
+            self.convenios[name.strip().lower()] = convenio
+        return convenio
+
+    def procedimento_detalhe(self, code):
+        """ProcedimentoDetalhes by code (case-insensitive), or None."""
+        if not code or not str(code).strip():
+            return None
+        return self.procedimento_detalhes.get(str(code).strip())
+
+    # Bulk creation (two-pass conciliation). bulk_create sends no post_save,
+    # so each method bumps the version itself when it creates rows.
+
+    def _unseen_names(self, names, entities):
+        """{lowercased name: first spelling} of the names not in entities."""
+        unseen = {}
+        for name in names:
+            if name and name.strip() and name.strip().lower() not in entities:
+                unseen.setdefault(name.strip().lower(), name.strip())
+        return unseen
+
+    def _existing_by_lower_name(self, model, keys):
+        found = {}
+        queryset = model.objects.annotate(name_lower=Lower('name')).filter(name_lower__in=keys)
+        for entity in queryset.order_by('pk'):
+            found.setdefault(entity.name_lower, entity)
+        return found
+
+    def ensure_hospitals(self, names):
+        """
+        Resolve hospital names like HospitalClinic.objects.get_or_create(name__iexact=...)
+        (matching any group, creating in this one) with one query and one bulk insert.
+        """
+        hospitals = self.hospitals
+        unseen = self._unseen_names(names, hospitals)
+        if not unseen:
+            return 0
+        hospitals.update(self._existing_by_lower_name(HospitalClinic, list(unseen)))
+        new = [HospitalClinic(name=name, group=self.group) for key, name in unseen.items() if key not in hospitals]
+        for hospital in HospitalClinic.objects.bulk_create(new):
+            hospitals[hospital.name.lower()] = hospital
+        if new:
+            bump_entity_version('hospital')
+        return len(new)
+
+    def ensure_convenios(self, names):
+        """Resolve convênio names case-insensitively, bulk-creating the missing ones."""
+        convenios = self.convenios
+        unseen = self._unseen_names(names, convenios)
+        if not unseen:
+            return 0
+        convenios.update(self._existing_by_lower_name(Convenios, list(unseen)))
+        new = [Convenios(name=name) for key, name in unseen.items() if key not in convenios]
+        if new:
+            # Convenios.name is unique: a concurrent insert is skipped and fetched below
+            Convenios.objects.bulk_create(new, ignore_conflicts=True)
+            convenios.update(self._existing_by_lower_name(Convenios, [c.name.lower() for c in new]))
+            bump_entity_version('convenio')
+        return len(new)
+
+    def _ensure_similar(self, kind, entities, names, build, threshold, by_extra=None, best=False):
+        """
+        For each unseen name, reuse the entity by_extra holds for its extra
+        value (surgeons by CRM), else the first cached entity whose name is
+        similar above threshold (with best, the most similar one), aliasing it
+        under the new key; otherwise plan a new instance. Planned instances take
+        part in later matches, as they did when entities were created one guide
+        at a time.
+        """
+        by_extra = {} if by_extra is None else by_extra
+        new = []
+        candidates = None
+        for name, extra in names.items():
+            key = name.lower()
+            if key in entities:
+                continue
+            match = by_extra.get(extra) if extra else None
+            if match is None and best:
+                if candidates is None:
+                    # Each entity once under its own name, like a scan of the group's rows
+                    candidates = list({id(entity): entity for entity in entities.values() if entity and entity.name}.values())
+                    similarity = NameSimilarity([entity.name for entity in candidates])
+                index = similarity.best(key, threshold)
+                match = candidates[index] if index is not None else None
+            elif match is None:
+                match = first_similar(key, entities, threshold)
+            if match is None:
+                match = build(name, extra)
+                new.append(match)
+                candidates = None
+                if extra:
+                    by_extra[extra] = match
+            entities[key] = match
+        if new:
+            type(new[0]).objects.bulk_create(new)
+            bump_entity_version(kind)
+        return len(new)
+
+    def _ensure_surgeons(self, names_to_crm, threshold, best):
+        """
+        Like financas.engine.find_or_create_surgeon, a surgeon of the group
+        with the guide's CRM is reused before any name is compared.
+        """
+        names_to_crm = {name: (str(crm).strip() or None) if crm else None for name, crm in names_to_crm.items()}
+        crms = {crm for name, crm in names_to_crm.items() if crm and name.lower() not in self.surgeons}
+        by_crm = {}
+        if crms:
+            for surgeon in Surgeon.objects.filter(group_id=self.group_id, crm__in=crms).order_by('pk'):
+                by_crm.setdefault(surgeon.crm, surgeon)
+        return self._ensure_similar(
+            'surgeon', self.surgeons, names_to_crm,
+            lambda name, crm: Surgeon(name=name, crm=crm, group=self.group), threshold, by_crm, best,
+        )
+
+    def ensure_surgeons(self, names_to_crm, threshold=0.85):
+        """names_to_crm: {surgeon name: crm or None}. CRM first, then the first similar name."""
+        return self._ensure_surgeons(names_to_crm, threshold, best=False)
+
+    def ensure_anesthesiologists(self, names, threshold=0.85):
+        return self._ensure_similar(
+            'anesthesiologist', self.anesthesiologists, dict.fromkeys(names),
+            lambda name, _: Anesthesiologist(name=name, group=self.group), threshold,
+        )
+
+    # Guides updating existing procedures resolve their surgeons and cooperados
+    # like financas.engine.find_or_create_surgeon/find_or_create_anesthesiologist
+    # (the most similar name above 0.7), in bulk.
+
+    def resolve_surgeons(self, names_to_crm, threshold=0.7):
+        """names_to_crm: {surgeon name: crm or None}. CRM first, then the most similar name."""
+        return self._ensure_surgeons(names_to_crm, threshold, best=True)
+
+    def resolve_anesthesiologists(self, names, threshold=0.7):
+        """Exact name first, then the most similar name."""
+        return self._ensure_similar(
+            'anesthesiologist', self.anesthesiologists, dict.fromkeys(names),
+            lambda name, _: Anesthesiologist(name=name, group=self.group), threshold, best=True,
+        )
+
+    def ensure_procedimento_detalhes(self, codes_to_names):
+        """
+        codes_to_names: {codigo_procedimento: descricao}. Fetches the unknown
+        codes in one query and bulk-creates the missing ones.
+        """
+        detalhes = self.procedimento_detalhes
+        unseen = {code: name for code, name in codes_to_names.items() if code and not detalhes.known(code)}
+        if not unseen:
+            return 0
+        found = {d.codigo_procedimento: d for d in ProcedimentoDetalhes.objects.filter(codigo_procedimento__in=list(unseen))}
+        new = [ProcedimentoDetalhes(codigo_procedimento=code, name=name) for code, name in unseen.items() if code not in found]
+        if new:
+            # codigo_procedimento is unique: concurrent inserts are skipped and fetched below
+            ProcedimentoDetalhes.objects.bulk_create(new, ignore_conflicts=True)
+            found.update(
+                (d.codigo_procedimento, d)
+                for d in ProcedimentoDetalhes.objects.filter(codigo_procedimento__in=[d.codigo_procedimento for d in new])
+            )
+            bump_entity_version('procedimento_detalhe')
+        for code in unseen:
+            detalhes[code] = found.get(code)
+        return len(new)
@@ -3,6 +3,7 @@ from django import forms
 from qualidade.models import ProcedimentoQualidade
 from registration.models import Anesthesiologist, HospitalClinic, Surgeon
 from .models import Procedimento, EscalaAnestesiologista, ProcedimentoDetalhes, Convenios
+from .entities import EntityResolver
 from financas.models import ProcedimentoFinancas
 from datetime import datetime, timedelta
 from dal import autocomplete
@@ -301,7 +302,7 @@ class ProcedimentoForm(forms.ModelForm):
         convenio_selecionado = self.cleaned_data.get('convenio')
 
         if convenio_nome_novo:
-            convenio_obj, created = Convenios.objects.get_or_create(name=convenio_nome_novo.strip())
+            convenio_obj = EntityResolver(self.user_group).get_or_create_convenio(convenio_nome_novo)
             instance.convenio = convenio_obj
         elif convenio_selecionado:
             instance.convenio = convenio_selecionado
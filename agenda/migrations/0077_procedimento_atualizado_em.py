@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0076_alter_escalaanestesiologista_hora_fim_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='procedimento',
+            name='atualizado_em',
+            field=models.DateTimeField(auto_now=True, null=True, verbose_name='Atualizado em'),
+        ),
+    ]
@@ -122,6 +122,9 @@ class Procedimento(models.Model):
         choices=ACOMODACAO_CHOICES,
         verbose_name='Acomodação'
     )
+    # Bumped by save() and by the conciliation bulk updates; compared against
+    # financas.ConciliacaoTentativa.candidatos to skip re-scoring unchanged candidates
+    atualizado_em = models.DateTimeField(auto_now=True, null=True, blank=True, verbose_name='Atualizado em')
 
     class Meta:
         verbose_name = "Procedimento"
@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+
+from .entities import MODEL_KINDS, bump_entity_version
+
+
+def invalidate_entity_cache(sender, **kwargs):
+    """Bump the entity-cache version whenever a resolvable entity changes."""
+    bump_entity_version(MODEL_KINDS[sender])
+
+
+for model in MODEL_KINDS:
+    post_save.connect(invalidate_entity_cache, sender=model, dispatch_uid=f'entity_cache_save_{model.__name__}')
+    post_delete.connect(invalidate_entity_cache, sender=model, dispatch_uid=f'entity_cache_delete_{model.__name__}')
@@ -2,6 +2,7 @@ from django.test import TestCase
 from django.urls import reverse
 from .models import Procedimento, Groups, Convenios, ProcedimentoDetalhes, HospitalClinic, Surgeon
 from .forms import ProcedimentoForm
+from .entities import EntityResolver, clear_entity_cache, entity_snapshot
 from registration.models import CustomUser, Anesthesiologist
 from django.utils import timezone
 import datetime
@@ -118,3 +119,98 @@ class ProcedimentoFormTest(TestCase):
         procedimento.group = self.group
         procedimento.save()
         self.assertEqual(procedimento.tipo_procedimento, 'eletiva') # Model default
+
+
+class EntityResolverTest(TestCase):
+    def setUp(self):
+        clear_entity_cache()
+        self.group = Groups.objects.create(name="Grupo Entidades")
+        self.other_group = Groups.objects.create(name="Outro Grupo")
+        self.hospital = HospitalClinic.objects.create(name="Hospital Central", group=self.group)
+        HospitalClinic.objects.create(name="Hospital Central", group=self.other_group)
+        self.detalhe = ProcedimentoDetalhes.objects.create(name="Colecistectomia", codigo_procedimento="31005497")
+
+    def test_lookups_are_cached_per_group_after_warm_up(self):
+        resolver = EntityResolver(self.group)
+        self.assertEqual(resolver.hospital(" hospital central "), self.hospital)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(EntityResolver(self.group).hospital("HOSPITAL CENTRAL"), self.hospital)
+            self.assertEqual(len(resolver.hospitals), 1)
+
+    def test_save_and_delete_signals_invalidate_snapshots(self):
+        self.assertNotIn("clinica norte", EntityResolver(self.group).hospitals)
+
+        clinica = HospitalClinic.objects.create(name="Clinica Norte", group=self.group)
+        self.assertEqual(EntityResolver(self.group).hospitals["clinica norte"], clinica)
+
+        clinica.delete()
+        self.assertNotIn("clinica norte", EntityResolver(self.group).hospitals)
+
+    def test_procedure_codes_resolved_on_demand_without_table_scan(self):
+        resolver = EntityResolver(self.group)
+        with self.assertNumQueries(2):
+            self.assertEqual(resolver.procedimento_detalhe("31005497"), self.detalhe)
+            self.assertIsNone(resolver.procedimento_detalhe("00000000"))
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.procedimento_detalhe("31005497"), self.detalhe)
+            self.assertIsNone(resolver.procedimento_detalhe("00000000"))
+
+    def test_procedure_codes_match_case_insensitively(self):
+        detalhe = ProcedimentoDetalhes.objects.create(name="Consulta", codigo_procedimento="CONS01")
+        resolver = EntityResolver(self.group)
+        self.assertEqual(resolver.procedimento_detalhe(" cons01 "), detalhe)
+        self.assertEqual(resolver.procedimento_detalhe("Cons01"), detalhe)
+
+    def test_ensure_surgeons_reuses_the_surgeon_with_the_same_crm(self):
+        surgeon = Surgeon.objects.create(name="Dr. Joao Carlos da Silva Pereira", crm="555", group=self.group)
+        Surgeon.objects.create(name="Joao Silva", crm="777", group=self.other_group)
+        resolver = EntityResolver(self.group)
+
+        self.assertEqual(resolver.ensure_surgeons({"Joao C. Silva Pereira": " 555 ", "Outro Nome": "777", "Mais Um": "777"}), 1)
+
+        self.assertEqual(resolver.surgeons["joao c. silva pereira"], surgeon)
+        self.assertEqual(Surgeon.objects.filter(group=self.group, crm="555").count(), 1)
+        # The new surgeon is planned once per CRM
+        self.assertEqual(Surgeon.objects.filter(group=self.group, crm="777").count(), 1)
+        self.assertEqual(resolver.surgeons["mais um"], resolver.surgeons["outro nome"])
+
+    def test_similar_aliases_stay_in_their_resolver(self):
+        surgeon = Surgeon.objects.create(name="Carlos Mendes", group=self.group)
+        conciliation = EntityResolver(self.group)
+        self.assertEqual(conciliation.ensure_surgeons({"Carlos Mendez": None}), 0)
+        self.assertEqual(conciliation.surgeons["carlos mendez"], surgeon)
+
+        # An exact lookup elsewhere (the spreadsheet import) must not see the alias
+        self.assertIsNone(EntityResolver(self.group).surgeon("Carlos Mendez"))
+        self.assertNotIn("carlos mendez", entity_snapshot("surgeon", self.group.pk))
+
+    def test_get_or_create_convenio_reuses_case_insensitive_match(self):
+        convenio = Convenios.objects.create(name="Unimed")
+        resolver = EntityResolver(self.group)
+        self.assertEqual(resolver.get_or_create_convenio("unimed"), convenio)
+        novo = resolver.get_or_create_convenio("Amil")
+        self.assertEqual(Convenios.objects.get(name="Amil"), novo)
+
+    def test_ensure_methods_bulk_create_only_missing_entities(self):
+        Convenios.objects.create(name="Unimed")
+        resolver = EntityResolver(self.group)
+        self.assertEqual(resolver.ensure_hospitals(["HOSPITAL CENTRAL", "Clinica Sul", "clinica sul "]), 1)
+        self.assertEqual(resolver.ensure_convenios(["unimed", "Amil"]), 1)
+        self.assertEqual(resolver.ensure_surgeons({"Carlos Mendes": "1234", "Carlos Mendez": None}), 1)
+        self.assertEqual(resolver.ensure_anesthesiologists(["Ana Souza"]), 1)
+        self.assertEqual(resolver.ensure_procedimento_detalhes({"31005497": "X", "40301010": "Hemograma"}), 1)
+
+        self.assertEqual(resolver.hospitals["hospital central"], self.hospital)
+        self.assertEqual(HospitalClinic.objects.get(name="Clinica Sul").group, self.group)
+        self.assertEqual(Convenios.objects.filter(name__iexact="unimed").count(), 1)
+        self.assertEqual(resolver.surgeons["carlos mendez"], Surgeon.objects.get(group=self.group))
+        self.assertEqual(Anesthesiologist.objects.get(name="Ana Souza").group, self.group)
+        self.assertEqual(resolver.procedimento_detalhe("40301010").name, "Hemograma")
+        self.assertEqual(resolver.procedimento_detalhe("31005497"), self.detalhe)
+
+        with self.assertNumQueries(0):
+            resolver.ensure_hospitals(["Clinica Sul"])
+            resolver.ensure_surgeons({"carlos mendes": None})
+            resolver.ensure_procedimento_detalhes({"40301010": "Hemograma"})
+        self.assertIn("clinica sul", EntityResolver(self.group).hospitals)
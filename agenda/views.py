@@ -3,6 +3,7 @@ from financas.models import ProcedimentoFinancas
 from qualidade.models import ProcedimentoQualidade
 from registration.models import Anesthesiologist, CustomUser, Surgeon
 from .models import Procedimento, EscalaAnestesiologista, ProcedimentoDetalhes, Convenios
+from .entities import EntityResolver
 from .forms import ProcedimentoForm, EscalaForm, SingleDayEscalaForm, SurveyForm
 from django.contrib.auth.decorators import login_required
 from calendar import monthrange, weekday
@@ -1213,15 +1214,15 @@ def import_procedures(request):
     row_results = []
 
     from django.utils import timezone as dj_tz
-    from registration.models import HospitalClinic, Surgeon
 
     print("[IMPORT] Current timezone:", dj_tz.get_current_timezone())
 
-    # Preload ProcedimentoDetalhes for fuzzy matching
-    detalhes_all = list(ProcedimentoDetalhes.objects.all())
-    detalhes_codes = {((d.codigo_procedimento or '').strip().lower()): d for d in detalhes_all if d.codigo_procedimento}
-    detalhes_name_norm_map = { _normalize_string(d.name): d for d in detalhes_all if d.name }
-    detalhes_name_norms = list(detalhes_name_norm_map.keys())
+    # Hospitals, surgeons, cooperados, convênios and codes come from the shared entity cache
+    entity_resolver = EntityResolver(request.user.group)
+
+    # ProcedimentoDetalhes names are only loaded if a row needs fuzzy matching
+    detalhes_all = []
+    detalhes_name_norm_map = {}
 
     def _find_best_procedimento_detalhe(value_text: str):
         if not value_text:
@@ -1230,9 +1231,9 @@ def import_procedures(request):
         tokens = [t.strip() for t in re.split(r"[+;,]", value_text) if (t and t.strip())]
         for token in tokens:
             # 1) Exact by code
-            code_key = token.strip().lower()
-            if code_key in detalhes_codes:
-                return detalhes_codes[code_key]
+            by_code = entity_resolver.procedimento_detalhe(token)
+            if by_code:
+                return by_code
             # 2) Exact by name (case-insensitive)
             exact = ProcedimentoDetalhes.objects.filter(name__iexact=token).first()
             if exact:
@@ -1243,13 +1244,16 @@ def import_procedures(request):
                 return contains
             # 3.5) Normalized substring containment (accent-insensitive)
             token_norm = _normalize_string(token)
+            if not detalhes_all:
+                detalhes_all.extend(ProcedimentoDetalhes.objects.all())
+                detalhes_name_norm_map.update({_normalize_string(d.name): d for d in detalhes_all if d.name})
             for d in detalhes_all:
                 if not d.name:
                     continue
                 if token_norm and token_norm in _normalize_string(d.name):
                     return d
             # 4) Fuzzy by normalized name (lower cutoff)
-            close = get_close_matches(token_norm, detalhes_name_norms, n=1, cutoff=0.6)
+            close = get_close_matches(token_norm, list(detalhes_name_norm_map), n=1, cutoff=0.6)
             if close:
                 return detalhes_name_norm_map[close[0]]
         return None
@@ -1345,13 +1349,13 @@ def import_procedures(request):
             # Convenio
             convenio_obj = None
             if plan_value:
-                convenio_obj, _ = Convenios.objects.get_or_create(name=plan_value)
+                convenio_obj = entity_resolver.get_or_create_convenio(plan_value)
 
             # Hospital or outro_local
             hospital_obj = None
             outro_local_value = None
             if hospital_value:
-                hospital_obj = HospitalClinic.objects.filter(group=request.user.group, name__iexact=hospital_value).first()
+                hospital_obj = entity_resolver.hospital(hospital_value)
                 if not hospital_obj:
                     outro_local_value = hospital_value
             print(f"[IMPORT][Row {row_number}] Hospital -> obj:{hospital_obj} outro_local:{outro_local_value}")
@@ -1360,7 +1364,7 @@ def import_procedures(request):
             surgeon_obj = None
             surgeon_name_fallback = None
             if surgeon_value:
-                surgeon_obj = Surgeon.objects.filter(group=request.user.group, name__iexact=surgeon_value).first()
+                surgeon_obj = entity_resolver.surgeon(surgeon_value)
                 if not surgeon_obj:
                     surgeon_name_fallback = surgeon_value
             print(f"[IMPORT][Row {row_number}] Surgeon -> obj:{surgeon_obj} fallback_name:{surgeon_name_fallback}")
@@ -1374,7 +1378,7 @@ def import_procedures(request):
                     code = code.strip()
                     if not code:
                         continue
-                    procedimento_principal = ProcedimentoDetalhes.objects.filter(codigo_procedimento__iexact=code).first()
+                    procedimento_principal = entity_resolver.procedimento_detalhe(code)
                     if procedimento_principal:
                         break
                 # Fallback: best-effort match by name (fuzzy)
@@ -1394,14 +1398,14 @@ def import_procedures(request):
             has_cooperado_col = 'cooperado' in col_map
             cooperado_obj = None
             if has_cooperado_col and cooperado_value:
-                cooperado_obj = Anesthesiologist.objects.filter(group=request.user.group, name__iexact=cooperado_value).first()
+                cooperado_obj = entity_resolver.anesthesiologist(cooperado_value)
                 if not cooperado_obj:
                     warnings.append(f"Cooperado não encontrado: {cooperado_value}")
             elif not has_cooperado_col and anesth_value:
                 # Try to derive cooperado from anesth list (take first matching)
                 possible_names = [n.strip() for n in re.split(r"[+,;]", anesth_value) if n.strip()]
                 for n in possible_names:
-                    found = Anesthesiologist.objects.filter(group=request.user.group, name__iexact=n).first()
+                    found = entity_resolver.anesthesiologist(n)
                     if found:
                         cooperado_obj = found
                         break
@@ -1492,7 +1496,7 @@ def import_procedures(request):
             if anesth_value and 'cooperado' not in col_map:
                 names = [n.strip() for n in re.split(r"[+,;]", anesth_value) if n.strip()]
                 for name in names:
-                    anest = Anesthesiologist.objects.filter(group=request.user.group, name__iexact=name).first()
+                    anest = entity_resolver.anesthesiologist(name)
                     if anest:
                         procedimento.anestesistas_responsaveis.add(anest)
                         added_anesth.append(name)
@@ -2,6 +2,8 @@
 ASGI config for clinic_erp project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve the project through it (e.g. with uvicorn or daphne) so long-lived
+streams such as financas.views.stream_conciliacao do not hold a worker thread.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
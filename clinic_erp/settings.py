@@ -74,6 +74,10 @@ COOPAHUB_API = {
     'VALIDATE_ENDPOINT': '/portal/acesso/ajaxValidaConexao.php',
     'DEFAULT_ORIGIN': 'PF',
     'TOKEN_REFRESH_MINUTES': 30,
+    # Conciliation fetch: month windows pulled concurrently from ajaxGuias.php
+    'GUIAS_FETCH_WORKERS': 4,
+    'GUIAS_FETCH_RETRIES': 3,
+    'GUIAS_RETRY_BACKOFF_SECONDS': 2,
 }
 
 ROOT_URLCONF = 'clinic_erp.urls'
@@ -127,6 +131,63 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# 'default' holds the entity snapshots' version stamps, read on every entity
+# lookup: it stays in process (snapshots also expire, see agenda.entities).
+# 'dashboard' holds the dashboard results and their per-group generations
+# (dashboard.cache). It must be shared by the web processes and the
+# conciliation worker, whose writes bump the generations: the database cache
+# is shared by every process using the database (its table is created by the
+# dashboard migrations). DJANGO_CACHE_DIR switches both to file-based caches,
+# shared only by the processes on one host.
+
+cache_dir = os.getenv('DJANGO_CACHE_DIR')
+
+if cache_dir:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': cache_dir,
+        },
+        'dashboard': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(cache_dir, 'dashboard'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'dashboard': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+        },
+    }
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.0/topics/logging/
+# The conciliation worker reports progress through the financas loggers
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'financas': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
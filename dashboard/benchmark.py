@@ -0,0 +1,69 @@
+"""
+Micro-benchmarks for the dashboard timing statistics.
+
+Times ``stats.robust_summary`` and ``stats.robust_summary_by`` on synthetic
+samples shaped like the delay / duration series (log-normal seconds with a
+few missing values and long outliers) against the list-based IQR mean the
+dashboard used before, so regressions show up without a database.
+"""
+import time
+
+import numpy as np
+
+from .stats import robust_summary, robust_summary_by
+
+
+def _reference_iqr_mean(values):
+    """The previous list-based implementation, kept only as a baseline."""
+    data = [v for v in values if v == v]
+    if not data:
+        return None
+    q1, q3 = np.percentile(data, [25, 75])
+    iqr = q3 - q1
+    lower, upper = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    filtered = [x for x in data if lower <= x <= upper]
+    return float(np.mean(filtered if filtered else data))
+
+
+def _samples(size, labels, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(mean=7.5, sigma=0.6, size=size)
+    outliers = rng.random(size) < 0.01
+    values[outliers] *= 20
+    values[rng.random(size) < 0.02] = np.nan
+    tipos = np.array([f'tipo_{i}' for i in range(labels)], dtype=object)[rng.integers(0, labels, size)]
+    return values, tipos
+
+
+def _best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_stats_benchmark(samples=100_000, labels=4, repeat=5, seed=0):
+    """Best-of-repeat timings in milliseconds for each statistic on one synthetic sample."""
+    values, tipos = _samples(samples, labels, seed)
+    as_list = values.tolist()
+
+    timings = {
+        'robust_summary': _best_of(repeat, robust_summary, values),
+        'robust_summary_from_list': _best_of(repeat, robust_summary, as_list),
+        'robust_summary_by': _best_of(repeat, robust_summary_by, values, tipos),
+        'reference_iqr_mean': _best_of(repeat, _reference_iqr_mean, as_list),
+    }
+    summary = robust_summary(values)
+    return {
+        'samples': samples,
+        'labels': labels,
+        'repeat': repeat,
+        'seed': seed,
+        'milliseconds': {name: round(seconds * 1000, 3) for name, seconds in timings.items()},
+        'speedup_vs_reference': round(timings['reference_iqr_mean'] / timings['robust_summary'], 1),
+        'mean_matches_reference': bool(np.isclose(summary['mean'], _reference_iqr_mean(as_list))),
+        'summary': summary,
+    }
@@ -0,0 +1,92 @@
+"""
+Per-group cache of dashboard results.
+
+Entries are keyed by (group, view, normalized filter params) and stored with
+the group's generation, a random token kept in the dashboard cache and
+replaced after every committed write to the data the dashboards read
+(post_save/post_delete in dashboard.signals, and the conciliation engine
+flush, whose bulk writes send no signals). One set invalidates every cached
+result of the group, and a hit costs a single get_many of the generation and
+the entry. Entries also expire after DASHBOARD_CACHE_TTL_SECONDS, which bounds
+the drift of the rolling "last N days" windows.
+
+A new token is written instead of incrementing a counter: cache.incr() is a
+read-then-write on the database backend, so two concurrent bumps could store
+the same value, and a counter evicted by culling would restart at a value
+old entries were stored under.
+
+The 'dashboard' cache alias must be shared by the web processes and the
+conciliation worker (the database cache by default, see settings.CACHES):
+with a per-process backend such as LocMemCache the worker's bumps never reach
+the web processes, which keep serving their results until the TTL expires.
+"""
+import hashlib
+import uuid
+
+from django.core.cache import caches
+from django.db import transaction
+
+
+DASHBOARD_CACHE_ALIAS = 'dashboard'
+DASHBOARD_CACHE_TTL_SECONDS = 300
+
+
+def _cache():
+    return caches[DASHBOARD_CACHE_ALIAS]
+
+
+def _generation_key(group_id):
+    return f'dashboard:generation:{group_id}'
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def dashboard_generation(group_id):
+    """Current generation token of group_id, created if the group has none yet."""
+    key = _generation_key(group_id)
+    generation = _cache().get(key)
+    if generation is None:
+        # add() keeps the token of a concurrent first reader
+        _cache().add(key, _new_generation(), None)
+        generation = _cache().get(key)
+    return generation
+
+
+def bump_dashboard_generation(group_id):
+    """Invalidate every cached dashboard result of group_id once the current transaction commits."""
+    if group_id is None:
+        return
+
+    def bump():
+        _cache().set(_generation_key(group_id), _new_generation(), None)
+
+    # Bumping before the commit would let a concurrent request cache the old
+    # rows under the new generation
+    transaction.on_commit(bump)
+
+
+def normalized_params(query, defaults):
+    """
+    Tuple of (name, value) for the filter params in defaults ({name: value
+    when absent}) read from a QueryDict; other params are ignored.
+    """
+    return tuple((name, query.get(name, default)) for name, default in sorted(defaults.items()))
+
+
+def cached_result(group_id, name, params, compute):
+    """compute() cached under (group_id, name, params); params is a tuple of plain values."""
+    digest = hashlib.sha1(repr(params).encode()).hexdigest()
+    generation_key = _generation_key(group_id)
+    key = f'dashboard:{name}:{group_id}:{digest}'
+    found = _cache().get_many([generation_key, key])
+    generation = found.get(generation_key)
+    entry = found.get(key)
+    if generation is not None and entry is not None and entry[0] == generation:
+        return entry[1]
+    if generation is None:
+        generation = dashboard_generation(group_id)
+    result = compute()
+    _cache().set(key, (generation, result), DASHBOARD_CACHE_TTL_SECONDS)
+    return result
@@ -0,0 +1,56 @@
+"""
+Benchmark the dashboard timing statistics on synthetic samples.
+
+Usage:
+    python manage.py benchmark_dashboard_stats                                # 100k samples, JSON to stdout
+    python manage.py benchmark_dashboard_stats --samples 1000000 --labels 12
+    python manage.py benchmark_dashboard_stats --output stats.json            # Keep results between releases
+
+No database access: the samples are generated in memory.
+"""
+import json
+import platform
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dashboard.benchmark import run_stats_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time the dashboard robust statistics on synthetic samples and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=100_000, help='Number of samples')
+        parser.add_argument('--labels', type=int, default=4, help='Distinct procedure types in the breakdown')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per statistic (best one is kept)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed')
+        parser.add_argument('--output', type=str, help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        result = run_stats_benchmark(
+            samples=options['samples'],
+            labels=options['labels'],
+            repeat=options['repeat'],
+            seed=options['seed'],
+        )
+        timings = result['milliseconds']
+        self.stderr.write(
+            f"robust_summary {timings['robust_summary']}ms, robust_summary_by {timings['robust_summary_by']}ms, "
+            f"{result['speedup_vs_reference']}x the reference"
+        )
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            **result,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Benchmark report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
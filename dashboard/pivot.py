@@ -0,0 +1,54 @@
+"""
+Grouped queries behind the financial dashboard tables and series.
+
+Instead of one aggregate query per (row, column) cell, pivot() runs a single
+GROUP BY over all the cell keys and returns the cells as a dict, which the
+views reshape in memory; cells with no rows are simply absent.
+"""
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce, TruncMonth
+
+
+def _detached(queryset):
+    """
+    The same rows without the DISTINCT and the multi-valued joins of an
+    anesthesiologist filter, which would repeat rows inside a GROUP BY.
+    """
+    if queryset.query.distinct:
+        return queryset.model.objects.filter(pk__in=queryset.values('pk'))
+    return queryset
+
+
+def pivot(queryset, keys, **measures):
+    """
+    {key: {measure: value}} from one GROUP BY of queryset over keys
+    ({name: expression}); key is the value itself for a single key, else a
+    tuple in the order of keys.
+    """
+    names = list(keys)
+    cells = {}
+    for row in _detached(queryset).values(**keys).annotate(**measures).order_by():
+        key = tuple(row.pop(name) for name in names)
+        cells[key[0] if len(key) == 1 else key] = row
+    return cells
+
+
+def faturado_by_period(queryset, period):
+    """{day or first day of month: {'total': Sum(valor_faturado), 'count': rows}}; period is 'daily' or 'monthly'."""
+    key = F('data_efetiva') if period == 'daily' else TruncMonth('data_efetiva')
+    return pivot(queryset, {'periodo': key}, total=Sum('valor_faturado'), count=Count('id'))
+
+
+def faturado_by_anestesista_month(queryset):
+    """
+    {(anesthesiologist id, first day of month): {'total', 'anestesias'}}.
+    A row counts for each responsible anesthesiologist of its procedure, or
+    for the cooperado when there is none; anestesias are distinct procedures.
+    """
+    anestesista = Coalesce('procedimento__anestesistas_responsaveis__id', 'procedimento__cooperado_id')
+    return pivot(
+        queryset,
+        {'anestesista': anestesista, 'mes': TruncMonth('data_efetiva')},
+        total=Sum('valor_faturado'),
+        anestesias=Count('procedimento', distinct=True),
+    )
@@ -0,0 +1,109 @@
+"""
+Single-pass aggregates behind the quality dashboard.
+
+Every flag percentage is a conditional Count in one aggregate query per
+model, each timing series (delay, duration, RPA discharge) comes from
+one values_list fetch turned into NumPy arrays of seconds for
+dashboard.stats, and the peak-hours heatmap is one GROUP BY on the local
+weekday and hour.
+"""
+import numpy as np
+from django.db.models import Avg, Count, Q
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay
+from django.utils import timezone
+
+
+# {metric: condition} counted over ProcedimentoQualidade
+QUALIDADE_FLAGS = {
+    'dor_pos_operatoria': Q(dor_pos_operatoria=True),
+    'ponv': Q(ponv=True),
+    'evento_adverso_evitavel': Q(evento_adverso_evitavel=True),
+    'eventos_adversos': Q(eventos_adversos_graves=True),
+    'reacoes_alergicas': Q(reacao_alergica_grave=True),
+    'encaminhamentos_uti': Q(encaminhamento_uti=True),
+    'adesao_checklist': Q(adesao_checklist=True),
+    'conformidade_protocolos': Q(conformidade_diretrizes=True),
+    'tecnicas_assepticas': Q(uso_tecnicas_assepticas=True),
+    'adesao_profilaxia_antibiotica': Q(adesao_profilaxia_antibiotica=True),
+    'adesao_prevencao_tvp_tep': Q(adesao_prevencao_tvp_tep=True),
+    'abreviacao_jejum_percent': Q(abreviacao_jejum=True),
+    'aldrete_maior_que_8_percent': Q(escala_aldrete__gt=8),
+}
+
+# {metric: condition} counted over AvaliacaoRPA
+RPA_FLAGS = {
+    'dor_pos_operatoria': Q(dor_pos_operatoria=True),
+    'ponv': Q(ponv=True),
+    'evento_adverso_evitavel': Q(evento_adverso=True),
+}
+
+
+def flag_counts(queryset, flags, **extra):
+    """{'total': rows, metric: rows matching its condition, ...} in one query."""
+    return queryset.aggregate(
+        total=Count('pk'),
+        **{metric: Count('pk', filter=condition) for metric, condition in flags.items()},
+        **extra,
+    )
+
+
+def qualidade_counts(queryset):
+    return flag_counts(queryset, QUALIDADE_FLAGS, csat_score=Avg('csat_score'))
+
+
+def rpa_counts(rpa_queryset):
+    return flag_counts(rpa_queryset, RPA_FLAGS)
+
+
+def _epoch_seconds(values):
+    return np.array([value.timestamp() if value is not None else np.nan for value in values], dtype=float)
+
+
+def timing_samples(queryset):
+    """
+    (delays, durations, procedure types) as parallel arrays: seconds from the
+    scheduled to the effective start and from the effective start to the end,
+    NaN where a timestamp is missing or the difference is negative.
+    """
+    rows = list(queryset.values_list(
+        'procedimento__data_horario', 'data_horario_inicio_efetivo', 'data_horario_fim_efetivo',
+        'procedimento__procedimento_type',
+    ).order_by())
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=object)
+    agendado, inicio, fim, tipos = zip(*rows)
+    agendado, inicio, fim = _epoch_seconds(agendado), _epoch_seconds(inicio), _epoch_seconds(fim)
+    delays = inicio - agendado
+    durations = fim - inicio
+    # NaN (a missing timestamp) fails the comparison and stays NaN
+    delays[~(delays >= 0)] = np.nan
+    durations[~(durations >= 0)] = np.nan
+    return delays, durations, np.array(tipos, dtype=object)
+
+
+def rpa_discharge_samples(rpa_queryset):
+    """(seconds until RPA discharge, procedure types); tempo_alta_rpa is stored as a time of day."""
+    rows = list(rpa_queryset.values_list('tempo_alta_rpa', 'procedimento__procedimento_type').order_by())
+    if not rows:
+        return np.empty(0), np.empty(0, dtype=object)
+    tempos, tipos = zip(*rows)
+    seconds = np.array(
+        [t.hour * 3600 + t.minute * 60 + t.second if t is not None else np.nan for t in tempos], dtype=float,
+    )
+    return seconds, np.array(tipos, dtype=object)
+
+
+def peak_hours_heatmap(queryset):
+    """
+    [[procedures per hour] for each weekday, Monday first] (7x24) by the
+    local (current time zone) weekday and hour of data_horario.
+    """
+    tz = timezone.get_current_timezone()
+    heatmap = [[0] * 24 for _ in range(7)]
+    rows = queryset.exclude(data_horario__isnull=True).values(
+        dia=ExtractIsoWeekDay('data_horario', tzinfo=tz),
+        hora=ExtractHour('data_horario', tzinfo=tz),
+    ).annotate(total=Count('pk')).order_by()
+    for row in rows:
+        heatmap[row['dia'] - 1][row['hora']] = row['total']
+    return heatmap
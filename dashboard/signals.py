@@ -0,0 +1,34 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_delete, post_save
+
+from agenda.models import Procedimento
+from financas.models import ProcedimentoFinancas
+from qualidade.models import AvaliacaoRPA, ProcedimentoQualidade
+from registration.models import Anesthesiologist, Surgeon
+
+from .cache import bump_dashboard_generation
+
+
+# Models the dashboards read, with or without a group of their own
+GROUPED_MODELS = (Procedimento, ProcedimentoFinancas, Anesthesiologist, Surgeon)
+PER_PROCEDIMENTO_MODELS = (ProcedimentoQualidade, AvaliacaoRPA)
+
+
+def _group_id(instance):
+    if isinstance(instance, PER_PROCEDIMENTO_MODELS):
+        try:
+            return instance.procedimento.group_id
+        except ObjectDoesNotExist:
+            # Deleted along with its procedure, which bumps the generation itself
+            return None
+    return instance.group_id
+
+
+def invalidate_dashboard_cache(sender, instance, **kwargs):
+    """Bump the dashboard generation of the group whose data changed."""
+    bump_dashboard_generation(_group_id(instance))
+
+
+for model in GROUPED_MODELS + PER_PROCEDIMENTO_MODELS:
+    post_save.connect(invalidate_dashboard_cache, sender=model, dispatch_uid=f'dashboard_cache_save_{model.__name__}')
+    post_delete.connect(invalidate_dashboard_cache, sender=model, dispatch_uid=f'dashboard_cache_delete_{model.__name__}')
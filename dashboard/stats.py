@@ -0,0 +1,75 @@
+"""
+Vectorized robust statistics for the dashboard timing metrics.
+
+Samples are 1-D NumPy arrays of seconds (NaN marks a missing value and is
+ignored). One np.percentile call gives the quartiles, median, p90 and p95;
+the mean leaves out the values beyond 1.5 IQR of the quartiles. Breakdowns
+sort the sample by label once and summarize each contiguous slice.
+"""
+import numpy as np
+
+
+PERCENTILES = (25, 50, 75, 90, 95)
+EMPTY_SUMMARY = {'count': 0, 'mean': None, 'median': None, 'p90': None, 'p95': None}
+
+
+def _valid(values):
+    data = np.asarray(values, dtype=float)
+    return data[~np.isnan(data)]
+
+
+def _iqr_mean(data, q1, q3):
+    """Mean without the 1.5 IQR outliers; the plain mean when that is not meaningful."""
+    iqr = q3 - q1
+    # Fewer than 4 values or a zero IQR leave nothing to filter
+    if data.size < 4 or iqr == 0:
+        return float(data.mean())
+    inside = (data >= q1 - 1.5 * iqr) & (data <= q3 + 1.5 * iqr)
+    if not inside.any():
+        return float(data.mean())
+    return float(data[inside].mean())
+
+
+def _summarize(data):
+    if data.size == 0:
+        return dict(EMPTY_SUMMARY)
+    q1, median, q3, p90, p95 = np.percentile(data, PERCENTILES)
+    return {
+        'count': int(data.size),
+        'mean': _iqr_mean(data, q1, q3),
+        'median': float(median),
+        'p90': float(p90),
+        'p95': float(p95),
+    }
+
+
+def robust_summary(values):
+    """
+    {'count', 'mean', 'median', 'p90', 'p95'} of values: the mean is
+    IQR-filtered, the percentiles cover the whole sample; None when empty.
+    """
+    return _summarize(_valid(values))
+
+
+def robust_summary_by(values, labels):
+    """{label: robust_summary} for values grouped by the parallel labels."""
+    data = np.asarray(values, dtype=float)
+    labels = np.asarray(labels, dtype=object)
+    present = ~np.isnan(data)
+    data, labels = data[present], labels[present]
+    if data.size == 0:
+        return {}
+
+    # Integer codes keep None and mixed labels sortable
+    codes_by_label = {}
+    codes = np.fromiter(
+        (codes_by_label.setdefault(label, len(codes_by_label)) for label in labels), dtype=np.intp, count=labels.size,
+    )
+    order = np.argsort(codes, kind='stable')
+    data, codes = data[order], codes[order]
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    label_by_code = {code: label for label, code in codes_by_label.items()}
+    return {
+        label_by_code[int(group_codes[0])]: _summarize(group)
+        for group, group_codes in zip(np.split(data, bounds), np.split(codes, bounds))
+    }
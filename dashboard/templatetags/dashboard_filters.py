@@ -22,3 +22,14 @@ def multiply(value, arg):
         return float(value) * float(arg)
     except (ValueError, TypeError):
         return ''
+
+@register.filter
+def hhmm(seconds):
+    """Seconds as hh:mm (hours may exceed 24); '--:--' when missing."""
+    if seconds is None:
+        return '--:--'
+    try:
+        hours, remainder = divmod(int(float(seconds)), 3600)
+    except (ValueError, TypeError):
+        return '--:--'
+    return f"{hours:02d}:{remainder // 60:02d}"
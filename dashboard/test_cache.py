@@ -0,0 +1,163 @@
+from datetime import date, time
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from agenda.entities import clear_entity_cache
+from agenda.models import Procedimento
+from constants import GESTOR_USER
+from financas.engine import ConciliacaoEngine
+from financas.models import ProcedimentoFinancas
+from qualidade.models import AvaliacaoRPA, ProcedimentoQualidade
+from registration.models import Anesthesiologist, CustomUser, Groups, Membership, Surgeon
+
+from . import views
+from .cache import bump_dashboard_generation, cached_result, dashboard_generation
+
+
+class CachedResultTest(TestCase):
+    """
+    cached_result: uma entrada por (grupo, painel, filtros), descartada quando a geração do grupo muda.
+    """
+
+    def setUp(self):
+        self.calls = 0
+
+    def _compute(self):
+        self.calls += 1
+        return {'chamada': self.calls}
+
+    def test_hits_until_the_generation_is_bumped(self):
+        self.assertEqual(cached_result(1, 'qualidade', (('period', '30'),), self._compute), {'chamada': 1})
+        self.assertEqual(cached_result(1, 'qualidade', (('period', '30'),), self._compute), {'chamada': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_dashboard_generation(1)
+
+        self.assertEqual(cached_result(1, 'qualidade', (('period', '30'),), self._compute), {'chamada': 2})
+        self.assertEqual(self.calls, 2)
+
+    def test_entries_are_keyed_by_group_view_and_params(self):
+        cached_result(1, 'qualidade', (('period', '30'),), self._compute)
+        cached_result(1, 'qualidade', (('period', '90'),), self._compute)
+        cached_result(1, 'financas', (('period', '30'),), self._compute)
+        cached_result(2, 'qualidade', (('period', '30'),), self._compute)
+        self.assertEqual(self.calls, 4)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_dashboard_generation(2)
+
+        cached_result(1, 'qualidade', (('period', '30'),), self._compute)
+        self.assertEqual(self.calls, 4)
+
+    def test_bump_waits_for_the_commit(self):
+        generation = dashboard_generation(1)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            bump_dashboard_generation(1)
+        self.assertEqual(dashboard_generation(1), generation)
+
+        callbacks[0]()
+        self.assertNotEqual(dashboard_generation(1), generation)
+
+    def test_bumps_replace_the_generation_without_reading_it(self):
+        # incr() reads then writes on the database cache; two bumps must give two generations
+        seen = {dashboard_generation(1)}
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                bump_dashboard_generation(1)
+            seen.add(dashboard_generation(1))
+        self.assertEqual(len(seen), 3)
+
+    def test_lost_generation_invalidates_the_entries(self):
+        cached_result(1, 'qualidade', (('period', '30'),), self._compute)
+        # Culled by the cache: the group gets a new generation, not an old one back
+        caches['dashboard'].delete('dashboard:generation:1')
+        self.assertEqual(cached_result(1, 'qualidade', (('period', '30'),), self._compute), {'chamada': 2})
+
+    def test_bump_without_group_is_ignored(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            bump_dashboard_generation(None)
+        self.assertEqual(callbacks, [])
+
+
+class DashboardInvalidationTest(TestCase):
+    """
+    Escritas nos dados lidos pelos painéis (sinais e flush do motor de conciliação) invalidam o cache do grupo.
+    """
+
+    def setUp(self):
+        clear_entity_cache()
+        self.group = Groups.objects.create(name='Grupo Cache')
+        self.other_group = Groups.objects.create(name='Outro Grupo')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_cache', email='gestor_cache@teste.com', password='x', group=self.group, validado=True,
+        )
+        Membership.objects.create(user=self.user, group=self.group, role=GESTOR_USER, validado=True)
+        self.surgeon = Surgeon.objects.create(name='Dr. Paulo', group=self.group)
+        self.anest = Anesthesiologist.objects.create(name='Ana Coop', group=self.group)
+        self.proc = Procedimento.objects.create(
+            group=self.group, nome_paciente='Joana Prado', cirurgiao=self.surgeon, cooperado=self.anest,
+            data_horario=timezone.now().replace(microsecond=0),
+        )
+        self.qualidade = ProcedimentoQualidade.objects.create(procedimento=self.proc, ponv=True)
+        self.rpa = AvaliacaoRPA.objects.create(
+            procedimento=self.proc, tempo_alta_rpa=time(0, 40), dor_pos_operatoria=False, escala='EVA',
+        )
+        self.financa = ProcedimentoFinancas.objects.create(
+            procedimento=self.proc, tipo_cobranca='cooperativa', cpsa='100', valor_faturado=Decimal('100.00'),
+        )
+
+    def assertBumps(self, write):
+        """write() bumps the group's generation once committed, and only that group's."""
+        before, other_before = dashboard_generation(self.group.pk), dashboard_generation(self.other_group.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            write()
+        self.assertNotEqual(dashboard_generation(self.group.pk), before)
+        self.assertEqual(dashboard_generation(self.other_group.pk), other_before)
+
+    def test_saves_bump_the_generation(self):
+        for instance in (self.proc, self.qualidade, self.rpa, self.financa, self.surgeon, self.anest):
+            with self.subTest(model=type(instance).__name__):
+                self.assertBumps(instance.save)
+
+    def test_deletes_bump_the_generation(self):
+        for instance in (self.financa, self.rpa, self.qualidade, self.surgeon, self.anest, self.proc):
+            with self.subTest(model=type(instance).__name__):
+                self.assertBumps(instance.delete)
+
+    def test_engine_flush_bumps_the_generation(self):
+        guia = {
+            'nrocpsa': '200', 'paciente': 'Pedro Alves', 'dt_cirurg': '2025-05-07', 'hora_inicial': '09:00',
+            'hospital': 'Hospital Motor', 'cooperado': 'Ana Coop', 'STATUS': 'Aguardando Pagamento',
+            'valor_faturado': '150.00',
+        }
+        # Bulk writes send no signals: the flush bumps the generation itself
+        self.assertBumps(
+            lambda: ConciliacaoEngine(self.group, start_date=date(2025, 1, 1)).run(iter([('200', guia)]))
+        )
+        self.assertTrue(ProcedimentoFinancas.objects.filter(group=self.group, cpsa='200').exists())
+
+    def test_cached_contexts_are_recomputed_after_a_write(self):
+        self.client.force_login(self.user)
+        for url, context_func in (
+            (reverse('dashboard'), '_dashboard_context'),
+            (reverse('financas_dashboard_view'), '_financas_dashboard_context'),
+        ):
+            with self.subTest(url=url), mock.patch.object(
+                views, context_func, wraps=getattr(views, context_func),
+            ) as compute:
+                self.assertEqual(self.client.get(url).status_code, 200)
+                # Params outside the filters share the entry
+                self.assertEqual(self.client.get(url, {'utm_source': 'email'}).status_code, 200)
+                self.assertEqual(compute.call_count, 1)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.financa.valor_faturado = Decimal('120.00')
+                    self.financa.save()
+
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertEqual(compute.call_count, 2)
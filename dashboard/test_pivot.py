@@ -0,0 +1,136 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db.models import Count, F, Q, Sum
+from django.test import TestCase
+from django.utils import timezone
+
+from agenda.models import Procedimento
+from financas.models import ProcedimentoFinancas
+from registration.models import Anesthesiologist, Groups
+
+from .pivot import faturado_by_anestesista_month, faturado_by_period, pivot
+
+
+MONTHS = (date(2025, 4, 1), date(2025, 5, 1))
+
+
+def _month_rows(queryset, month):
+    return queryset.filter(data_efetiva__year=month.year, data_efetiva__month=month.month)
+
+
+def _previous_anestesista_cell(queryset, anest_id, month):
+    """The four per-cell queries the monthly anesthesiologist breakdown ran before dashboard.pivot."""
+    rows = _month_rows(queryset, month)
+    responsaveis = rows.filter(procedimento__anestesistas_responsaveis__id=anest_id)
+    cooperado = rows.filter(procedimento__anestesistas_responsaveis__isnull=True, procedimento__cooperado__id=anest_id)
+    total = Decimal('0')
+    total += responsaveis.aggregate(total=Sum('valor_faturado'))['total'] or 0
+    total += cooperado.aggregate(total=Sum('valor_faturado'))['total'] or 0
+    anestesias = (
+        responsaveis.values('procedimento').distinct().count()
+        + cooperado.values('procedimento').distinct().count()
+    )
+    return total, anestesias
+
+
+class PivotTest(TestCase):
+    """
+    pivot: um GROUP BY igual às agregações por célula, inclusive com o filtro de anestesista (DISTINCT).
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Pivot')
+        self.ana, self.bruno, self.carla = (
+            Anesthesiologist.objects.create(name=name, group=self.group) for name in ('Ana', 'Bruno', 'Carla')
+        )
+        # Two responsaveis and a cooperado: each row counts for Ana and Bruno
+        conjunto = self._procedimento(datetime(2025, 4, 10, 9), cooperado=self.carla, responsaveis=[self.ana, self.bruno])
+        self._financa(conjunto, '100.00')
+        self._financa(conjunto, '50.00')
+        # No responsaveis: falls back to the cooperado
+        sem_responsavel = self._procedimento(datetime(2025, 4, 10, 14), cooperado=self.carla)
+        self._financa(sem_responsavel, '30.00')
+        so_ana = self._procedimento(datetime(2025, 5, 3, 8), cooperado=self.bruno, responsaveis=[self.ana])
+        self._financa(so_ana, '70.00')
+        # Unlinked: dated by the API surgery date, no anesthesiologist
+        ProcedimentoFinancas.objects.create(
+            group=self.group, tipo_cobranca='cooperativa', api_data_cirurgia=date(2025, 5, 3),
+            valor_faturado=Decimal('20.00'),
+        )
+
+    def _procedimento(self, data_horario, cooperado, responsaveis=()):
+        proc = Procedimento.objects.create(
+            group=self.group, nome_paciente='Paciente', cooperado=cooperado,
+            data_horario=timezone.make_aware(data_horario),
+        )
+        proc.anestesistas_responsaveis.add(*responsaveis)
+        return proc
+
+    def _financa(self, procedimento, valor):
+        return ProcedimentoFinancas.objects.create(
+            procedimento=procedimento, tipo_cobranca='cooperativa', valor_faturado=Decimal(valor),
+        )
+
+    def _querysets(self):
+        todos = ProcedimentoFinancas.objects.filter(group=self.group)
+        # The dashboard's anesthesiologist filter: the responsaveis join repeats
+        # the rows of a procedure with two responsaveis
+        por_carla = todos.filter(
+            Q(procedimento__cooperado=self.carla.id) | Q(procedimento__anestesistas_responsaveis=self.carla.id)
+        ).distinct()
+        return {'todos': todos, 'por_carla': por_carla}
+
+    def test_period_cells_match_per_period_aggregates(self):
+        for name, queryset in self._querysets().items():
+            daily = faturado_by_period(queryset, 'daily')
+            for day in queryset.values_list('data_efetiva', flat=True).distinct():
+                rows = queryset.filter(data_efetiva=day)
+                with self.subTest(queryset=name, day=day):
+                    self.assertEqual(daily[day]['total'], rows.aggregate(total=Sum('valor_faturado'))['total'])
+                    self.assertEqual(daily[day]['count'], rows.count())
+
+            monthly = faturado_by_period(queryset, 'monthly')
+            for month in MONTHS:
+                rows = _month_rows(queryset, month)
+                with self.subTest(queryset=name, month=month):
+                    self.assertEqual(
+                        monthly.get(month, {}).get('total'), rows.aggregate(total=Sum('valor_faturado'))['total'],
+                    )
+                    self.assertEqual(monthly.get(month, {}).get('count', 0), rows.count())
+
+    def test_anestesista_cells_match_per_cell_queries(self):
+        for name, queryset in self._querysets().items():
+            cells = faturado_by_anestesista_month(queryset)
+            for anest in (self.ana, self.bruno, self.carla):
+                for month in MONTHS:
+                    cell = cells.get((anest.id, month), {})
+                    with self.subTest(queryset=name, anestesista=anest.name, month=month):
+                        self.assertEqual(
+                            (cell.get('total') or Decimal('0'), cell.get('anestesias', 0)),
+                            _previous_anestesista_cell(queryset, anest.id, month),
+                        )
+
+    def test_responsaveis_take_precedence_over_the_cooperado(self):
+        cells = faturado_by_anestesista_month(self._querysets()['todos'])
+
+        april, may = MONTHS
+        self.assertEqual(cells[self.ana.id, april], {'total': Decimal('150.00'), 'anestesias': 1})
+        self.assertEqual(cells[self.bruno.id, april], {'total': Decimal('150.00'), 'anestesias': 1})
+        self.assertEqual(cells[self.carla.id, april], {'total': Decimal('30.00'), 'anestesias': 1})
+        self.assertEqual(cells[self.ana.id, may], {'total': Decimal('70.00'), 'anestesias': 1})
+        # Bruno is only the cooperado of a procedure with a responsavel
+        self.assertNotIn((self.bruno.id, may), cells)
+        self.assertEqual(cells[None, may]['total'], Decimal('20.00'))
+
+    def test_distinct_queryset_is_not_inflated_by_the_join(self):
+        por_carla = self._querysets()['por_carla']
+        april = MONTHS[0]
+
+        # Grouping the DISTINCT queryset directly counts the two-responsaveis rows twice
+        inflated = por_carla.values(mes=F('data_efetiva')).annotate(total=Sum('valor_faturado')).order_by()
+        self.assertEqual(sum(row['total'] for row in inflated), Decimal('330.00'))
+
+        cells = pivot(por_carla, {'mes': F('data_efetiva')}, total=Sum('valor_faturado'), count=Count('id'))
+        self.assertEqual(cells, {date(2025, 4, 10): {'total': Decimal('180.00'), 'count': 3}})
+        self.assertEqual(faturado_by_period(por_carla, 'monthly')[april], {'total': Decimal('180.00'), 'count': 3})
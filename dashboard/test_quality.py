@@ -0,0 +1,164 @@
+import random
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db.models import Avg
+from django.test import TestCase
+from django.utils import timezone
+
+from agenda.models import Procedimento
+from qualidade.models import AvaliacaoRPA, ProcedimentoQualidade
+from registration.models import Groups
+
+from .quality import peak_hours_heatmap, qualidade_counts, rpa_counts
+
+
+# The per-metric filters the quality dashboard counted one query at a time
+PREVIOUS_QUALIDADE_FILTERS = {
+    'dor_pos_operatoria': {'dor_pos_operatoria': True},
+    'ponv': {'ponv': True},
+    'evento_adverso_evitavel': {'evento_adverso_evitavel': True},
+    'eventos_adversos': {'eventos_adversos_graves': True},
+    'reacoes_alergicas': {'reacao_alergica_grave': True},
+    'encaminhamentos_uti': {'encaminhamento_uti': True},
+    'adesao_checklist': {'adesao_checklist': True},
+    'conformidade_protocolos': {'conformidade_diretrizes': True},
+    'tecnicas_assepticas': {'uso_tecnicas_assepticas': True},
+    'adesao_profilaxia_antibiotica': {'adesao_profilaxia_antibiotica': True},
+    'adesao_prevencao_tvp_tep': {'adesao_prevencao_tvp_tep': True},
+    'abreviacao_jejum_percent': {'abreviacao_jejum': True},
+    'aldrete_maior_que_8_percent': {'escala_aldrete__gt': 8},
+}
+PREVIOUS_RPA_FILTERS = {
+    'dor_pos_operatoria': {'dor_pos_operatoria': True},
+    'ponv': {'ponv': True},
+    'evento_adverso_evitavel': {'evento_adverso': True},
+}
+QUALIDADE_BOOLEANS = [
+    'eventos_adversos_graves', 'reacao_alergica_grave', 'encaminhamento_uti', 'evento_adverso_evitavel',
+    'adesao_checklist', 'uso_tecnicas_assepticas', 'conformidade_diretrizes', 'ponv', 'adesao_profilaxia_antibiotica',
+    'adesao_prevencao_tvp_tep', 'dor_pos_operatoria', 'abreviacao_jejum',
+]
+
+
+class QualityCountsTest(TestCase):
+    """
+    Contagens de qualidade e RPA em uma agregação, iguais às consultas por métrica.
+    """
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.group = Groups.objects.create(name='Grupo Qualidade')
+        inicio = timezone.make_aware(datetime(2025, 5, 1, 7, 0))
+        for i in range(40):
+            proc = Procedimento.objects.create(
+                group=self.group, nome_paciente=f'Paciente {i}', data_horario=inicio + timedelta(hours=9 * i),
+            )
+            ProcedimentoQualidade.objects.create(
+                procedimento=proc,
+                escala_aldrete=rng.choice([None, 5, 8, 9, 10]),
+                csat_score=rng.choice([None, Decimal('3.50'), Decimal('4.25'), Decimal('5.00')]),
+                **{field: rng.choice([True, False, None]) for field in QUALIDADE_BOOLEANS},
+            )
+            if i % 3:
+                AvaliacaoRPA.objects.create(
+                    procedimento=proc, tempo_alta_rpa=time(0, rng.randrange(60)), escala='EVA',
+                    dor_pos_operatoria=rng.random() < 0.5, ponv=rng.choice([True, False, None]),
+                    evento_adverso=rng.choice([True, False, None]),
+                )
+
+    def _querysets(self):
+        qualidade = ProcedimentoQualidade.objects.filter(procedimento__group=self.group)
+        corte = timezone.make_aware(datetime(2025, 5, 8))
+        return {
+            'todos': qualidade,
+            'periodo': qualidade.filter(procedimento__data_horario__lt=corte),
+            'vazio': qualidade.none(),
+        }
+
+    def test_qualidade_counts_match_per_metric_queries(self):
+        for name, queryset in self._querysets().items():
+            counts = qualidade_counts(queryset)
+            with self.subTest(queryset=name):
+                self.assertEqual(counts['total'], queryset.count())
+                self.assertEqual(counts['csat_score'], queryset.aggregate(Avg('csat_score'))['csat_score__avg'])
+                for metric, lookup in PREVIOUS_QUALIDADE_FILTERS.items():
+                    self.assertEqual(counts[metric], queryset.filter(**lookup).count(), metric)
+
+    def test_rpa_counts_match_per_metric_queries(self):
+        for name, queryset in self._querysets().items():
+            rpa_queryset = AvaliacaoRPA.objects.filter(procedimento__qualidade__in=queryset)
+            counts = rpa_counts(rpa_queryset)
+            with self.subTest(queryset=name):
+                self.assertEqual(counts['total'], rpa_queryset.count())
+                for metric, lookup in PREVIOUS_RPA_FILTERS.items():
+                    self.assertEqual(counts[metric], rpa_queryset.filter(**lookup).count(), metric)
+
+    def test_counts_are_one_query(self):
+        queryset = self._querysets()['todos']
+        with self.assertNumQueries(1):
+            qualidade_counts(queryset)
+        with self.assertNumQueries(1):
+            rpa_counts(AvaliacaoRPA.objects.filter(procedimento__group=self.group))
+
+    def test_fixture_exercises_every_metric(self):
+        counts = qualidade_counts(self._querysets()['todos'])
+        self.assertEqual(counts['total'], 40)
+        for metric in PREVIOUS_QUALIDADE_FILTERS:
+            self.assertTrue(0 < counts[metric] < 40, metric)
+
+
+class PeakHoursHeatmapTest(TestCase):
+    """
+    Mapa de horários de pico pelo dia da semana e hora locais (America/Sao_Paulo), não UTC.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Pico')
+
+    def _procedimento(self, data_horario):
+        return Procedimento.objects.create(group=self.group, nome_paciente='Paciente', data_horario=data_horario)
+
+    def _utc(self, *args):
+        return datetime(*args, tzinfo=dt_timezone.utc)
+
+    def test_events_after_midnight_utc_fall_on_the_previous_local_day(self):
+        # Tuesday 2025-05-06 01:30Z is Monday 22:30 in São Paulo (UTC-3)
+        self._procedimento(self._utc(2025, 5, 6, 1, 30))
+        self._procedimento(self._utc(2025, 5, 6, 1, 45))
+        # Monday 2025-05-05 02:00Z is Sunday 23:00
+        self._procedimento(self._utc(2025, 5, 5, 2, 0))
+        # Tuesday 03:10Z is already Tuesday 00:10
+        self._procedimento(self._utc(2025, 5, 6, 3, 10))
+
+        with timezone.override('America/Sao_Paulo'):
+            heatmap = peak_hours_heatmap(Procedimento.objects.filter(group=self.group))
+
+        segunda, terca, domingo = 0, 1, 6
+        self.assertEqual(heatmap[segunda][22], 2)
+        self.assertEqual(heatmap[domingo][23], 1)
+        self.assertEqual(heatmap[terca][0], 1)
+        # Nothing is left in the UTC day and hour
+        self.assertEqual(heatmap[terca][1], 0)
+        self.assertEqual(heatmap[segunda][2], 0)
+        self.assertEqual(sum(map(sum, heatmap)), 4)
+
+    def test_matches_localtime_of_each_procedure(self):
+        rng = random.Random(11)
+        inicio = self._utc(2025, 3, 1)
+        for _ in range(60):
+            self._procedimento(inicio + timedelta(minutes=rng.randrange(60 * 24 * 60)))
+
+        with timezone.override('America/Sao_Paulo'):
+            queryset = Procedimento.objects.filter(group=self.group)
+            heatmap = peak_hours_heatmap(queryset)
+            expected = [[0] * 24 for _ in range(7)]
+            for data_horario in queryset.values_list('data_horario', flat=True):
+                local = timezone.localtime(data_horario)
+                expected[local.weekday()][local.hour] += 1
+
+        self.assertEqual(heatmap, expected)
+
+    def test_shape_without_procedures(self):
+        heatmap = peak_hours_heatmap(Procedimento.objects.none())
+        self.assertEqual(heatmap, [[0] * 24 for _ in range(7)])
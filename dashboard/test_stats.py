@@ -0,0 +1,197 @@
+import math
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from agenda.models import Procedimento
+from constants import CIRURGIA_AMBULATORIAL_PROCEDIMENTO, CONSULTA_PROCEDIMENTO
+from qualidade.models import AvaliacaoRPA, ProcedimentoQualidade
+from registration.models import Groups
+
+from .quality import rpa_discharge_samples, timing_samples
+from .stats import EMPTY_SUMMARY, robust_summary, robust_summary_by
+from .utils import calculate_iqr_filtered_average_seconds
+
+
+def _previous_iqr_mean(values):
+    """The calculate_iqr_filtered_average_seconds body before dashboard.stats, on the non-NaN values."""
+    data = np.asarray([v for v in values if not math.isnan(v)], dtype=float)
+    if data.size == 0:
+        return None
+    if data.size < 4:
+        return data.mean()
+    q1, q3 = np.percentile(data, [25, 75])
+    iqr = q3 - q1
+    if iqr == 0:
+        return data.mean()
+    inside = (data >= q1 - 1.5 * iqr) & (data <= q3 + 1.5 * iqr)
+    if not inside.any():
+        return data.mean()
+    return data[inside].mean()
+
+
+class RobustSummaryTest(SimpleTestCase):
+    """
+    robust_summary: média filtrada por IQR e percentis iguais aos do cálculo anterior.
+    """
+
+    SAMPLES = [
+        [10, 12, 15, 11, 13, 100, 9],
+        [1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+        [5, 5, 5, 5, 5, 50],
+        [1.5, 2.5, 3.5],
+        [120.0, 3600.0, 95.0, 110.0, 130.0, 98.0, 7200.0, 105.0],
+    ]
+
+    def assertMatchesPrevious(self, values):
+        summary = robust_summary(values)
+        valid = [v for v in values if not math.isnan(v)]
+        self.assertEqual(summary['count'], len(valid))
+        self.assertAlmostEqual(summary['mean'], _previous_iqr_mean(values))
+        self.assertAlmostEqual(summary['median'], float(np.median(valid)))
+        self.assertAlmostEqual(summary['p90'], float(np.percentile(valid, 90)))
+        self.assertAlmostEqual(summary['p95'], float(np.percentile(valid, 95)))
+
+    def test_matches_previous_mean_and_median(self):
+        for values in self.SAMPLES:
+            with self.subTest(values=values):
+                self.assertMatchesPrevious(values)
+
+    def test_matches_previous_on_random_samples(self):
+        rng = np.random.default_rng(0)
+        for size in (4, 5, 17, 250):
+            values = rng.lognormal(mean=7.5, sigma=0.6, size=size)
+            values[rng.random(size) < 0.05] *= 20
+            with self.subTest(size=size):
+                self.assertMatchesPrevious(values.tolist())
+
+    def test_outliers_leave_the_mean_but_not_the_percentiles(self):
+        summary = robust_summary([10, 12, 15, 11, 13, 100, 9])
+        self.assertAlmostEqual(summary['mean'], 70 / 6)
+        self.assertEqual(summary['median'], 12.0)
+        self.assertGreater(summary['p95'], 15)
+
+    def test_nan_values_are_ignored(self):
+        values = [10, float('nan'), 12, 15, 11, float('nan'), 13, 100, 9]
+        self.assertMatchesPrevious(values)
+        self.assertEqual(robust_summary(values), robust_summary([10, 12, 15, 11, 13, 100, 9]))
+
+    def test_empty_and_all_nan(self):
+        self.assertEqual(robust_summary([]), EMPTY_SUMMARY)
+        self.assertEqual(robust_summary([float('nan'), float('nan')]), EMPTY_SUMMARY)
+        self.assertIsNone(calculate_iqr_filtered_average_seconds([]))
+
+    def test_single_value(self):
+        self.assertEqual(
+            robust_summary([42.0]),
+            {'count': 1, 'mean': 42.0, 'median': 42.0, 'p90': 42.0, 'p95': 42.0},
+        )
+        self.assertEqual(calculate_iqr_filtered_average_seconds([42]), 42.0)
+
+    def test_accepts_numpy_arrays(self):
+        values = [10, 12, 15, 11, 13, 100, 9]
+        self.assertEqual(robust_summary(np.array(values)), robust_summary(values))
+
+
+class RobustSummaryByTest(SimpleTestCase):
+    """
+    robust_summary_by: o resumo de cada rótulo é o robust_summary do seu subconjunto.
+    """
+
+    def test_each_label_matches_its_own_summary(self):
+        rng = np.random.default_rng(1)
+        values = rng.lognormal(mean=7.5, sigma=0.6, size=300)
+        values[rng.random(300) < 0.05] = np.nan
+        labels = np.array(['cirurgia', 'exame', None, 'bloqueio'], dtype=object)[rng.integers(0, 4, 300)]
+
+        summaries = robust_summary_by(values, labels)
+
+        for label in ('cirurgia', 'exame', None, 'bloqueio'):
+            subset = [v for v, l in zip(values.tolist(), labels) if l == label]
+            with self.subTest(label=label):
+                self.assertEqual(summaries[label], robust_summary(subset))
+                self.assertAlmostEqual(summaries[label]['mean'], _previous_iqr_mean(subset))
+                valid = [v for v in subset if not math.isnan(v)]
+                self.assertAlmostEqual(summaries[label]['median'], float(np.median(valid)))
+
+    def test_labels_with_only_nan_are_left_out(self):
+        summaries = robust_summary_by([1.0, float('nan'), 3.0], ['a', 'b', 'a'])
+        self.assertEqual(list(summaries), ['a'])
+        self.assertEqual(summaries['a']['count'], 2)
+        self.assertEqual(summaries['a']['median'], 2.0)
+
+    def test_single_value_per_label(self):
+        summaries = robust_summary_by([5.0, 7.0], ['a', 'b'])
+        self.assertEqual(summaries['a'], {'count': 1, 'mean': 5.0, 'median': 5.0, 'p90': 5.0, 'p95': 5.0})
+        self.assertEqual(summaries['b']['mean'], 7.0)
+
+    def test_empty(self):
+        self.assertEqual(robust_summary_by([], []), {})
+        self.assertEqual(robust_summary_by([float('nan')], ['a']), {})
+
+
+class TimingSamplesTest(TestCase):
+    """
+    Amostras de atraso, duração e alta da RPA em segundos, com NaN para horários ausentes ou invertidos.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Estatísticas')
+        self.agendado = timezone.make_aware(datetime(2025, 5, 6, 8, 0))
+
+    def _procedimento(self, tipo, inicio=None, fim=None, tempo_alta_rpa=None):
+        proc = Procedimento.objects.create(
+            group=self.group, nome_paciente='Paciente', data_horario=self.agendado, procedimento_type=tipo,
+        )
+        ProcedimentoQualidade.objects.create(
+            procedimento=proc, data_horario_inicio_efetivo=inicio, data_horario_fim_efetivo=fim,
+        )
+        if tempo_alta_rpa is not None:
+            AvaliacaoRPA.objects.create(
+                procedimento=proc, tempo_alta_rpa=tempo_alta_rpa, dor_pos_operatoria=False, escala='EVA',
+            )
+        return proc
+
+    def test_delays_and_durations_in_seconds(self):
+        cirurgia, consulta = CIRURGIA_AMBULATORIAL_PROCEDIMENTO, CONSULTA_PROCEDIMENTO
+        self._procedimento(cirurgia, self.agendado + timedelta(minutes=10), self.agendado + timedelta(minutes=70))
+        self._procedimento(consulta, self.agendado + timedelta(minutes=5))
+        # Started before the schedule and ended before starting: both NaN
+        self._procedimento(cirurgia, self.agendado - timedelta(minutes=15), self.agendado - timedelta(minutes=20))
+
+        delays, durations, tipos = timing_samples(ProcedimentoQualidade.objects.all())
+
+        by_tipo = {}
+        for delay, duration, tipo in zip(delays.tolist(), durations.tolist(), tipos.tolist()):
+            by_tipo.setdefault(tipo, []).append((delay, duration))
+        self.assertEqual(len(by_tipo[cirurgia]), 2)
+        self.assertIn((600.0, 3600.0), by_tipo[cirurgia])
+        self.assertEqual(sum(math.isnan(d) and math.isnan(u) for d, u in by_tipo[cirurgia]), 1)
+        self.assertEqual(by_tipo[consulta][0][0], 300.0)
+        self.assertTrue(math.isnan(by_tipo[consulta][0][1]))
+
+        self.assertEqual(robust_summary(delays)['count'], 2)
+        self.assertEqual(robust_summary(durations), robust_summary([3600.0]))
+        self.assertEqual(robust_summary_by(delays, tipos)[consulta]['mean'], 300.0)
+
+    def test_rpa_discharge_seconds(self):
+        self._procedimento(CIRURGIA_AMBULATORIAL_PROCEDIMENTO, tempo_alta_rpa=time(0, 45))
+        self._procedimento(CONSULTA_PROCEDIMENTO, tempo_alta_rpa=time(1, 2, 30))
+        self._procedimento(CONSULTA_PROCEDIMENTO)
+
+        seconds, tipos = rpa_discharge_samples(AvaliacaoRPA.objects.all())
+
+        self.assertEqual(
+            sorted(zip(tipos.tolist(), seconds.tolist())),
+            [(CIRURGIA_AMBULATORIAL_PROCEDIMENTO, 2700.0), (CONSULTA_PROCEDIMENTO, 3750.0)],
+        )
+
+    def test_empty_querysets(self):
+        delays, durations, tipos = timing_samples(ProcedimentoQualidade.objects.none())
+        self.assertEqual((delays.size, durations.size, tipos.size), (0, 0, 0))
+        self.assertEqual(robust_summary(delays), EMPTY_SUMMARY)
+        self.assertEqual(robust_summary_by(delays, tipos), {})
+        seconds, tipos = rpa_discharge_samples(AvaliacaoRPA.objects.none())
+        self.assertEqual(seconds.size, 0)
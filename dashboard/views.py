@@ -1,10 +1,14 @@
 from django.shortcuts import render
-from django.db.models import Avg, Count, Case, When, F, Q, Sum, ExpressionWrapper, DurationField
-from django.db.models.functions import Coalesce, TruncMonth, TruncDate, Cast
+from django.db.models import Avg, Count, F, Q, Sum, ExpressionWrapper, DurationField
+from django.db.models.functions import Coalesce, TruncMonth
 from constants import GESTOR_USER, ADMIN_USER, ANESTESISTA_USER, CLINIC_TYPE_CHOICES
 # import numpy as np # No longer needed here, it's in utils
-from .utils import calculate_iqr_filtered_average_seconds # Import the function
+from .pivot import faturado_by_anestesista_month, faturado_by_period
+from .cache import cached_result, normalized_params
+from .quality import peak_hours_heatmap, qualidade_counts, rpa_counts, rpa_discharge_samples, timing_samples
+from .stats import robust_summary, robust_summary_by
 from financas.models import ProcedimentoFinancas
+from financas.rollup import rollup_rows
 from qualidade.models import ProcedimentoQualidade
 from agenda.models import ProcedimentoDetalhes, Procedimento
 from django.contrib.auth.decorators import login_required
@@ -36,14 +40,39 @@ MONTH_NAMES_PT = {
     12: 'Dezembro',
 }
 
+# Query params read by each cached dashboard, with their value when absent
+QUALIDADE_PARAMS = {
+    'period': '', 'start_date': '', 'end_date': '', 'month': '', 'procedimento': None,
+    'dor_view': 'final', 'ponv_view': 'final', 'evento_view': 'final',
+}
+FINANCAS_PARAMS = {
+    'period': '', 'start_date': '', 'end_date': '', 'month': '', 'anestesista': None, 'cirurgiao': None,
+    'procedimento': None, 'graph_type': 'ticket', 'anestesista_view': 'valor_faturado', 'clinic': None,
+    'include_cooperativa': '1', 'include_particular': '1', 'include_hospital': '1', 'include_via_cirurgiao': '1',
+}
+
+
 @login_required
 def dashboard_view(request):
     """Dashboard de Qualidade, com opção de Período Personalizado."""
     if not request.user.validado:
         return render(request, 'usuario_nao_autenticado.html')
-    if request.user.get_active_role() != GESTOR_USER:
+    active_role = request.user.get_active_role()
+    if active_role != GESTOR_USER:
         return HttpResponseForbidden("Acesso Negado")
 
+    # Only gestores get here, so the context depends on the group and the filters alone
+    context = cached_result(
+        request.user.group_id,
+        'qualidade',
+        normalized_params(request.GET, QUALIDADE_PARAMS),
+        lambda: _dashboard_context(request),
+    )
+    return render(request, 'dashboard.html', {**context, 'active_role': active_role})
+
+
+def _dashboard_context(request):
+    """Contexto do Dashboard de Qualidade para o grupo e os filtros da requisição."""
     user_group = request.user.group
     
     # Get 'period' from URL; can be an integer (days) or 'custom'
@@ -79,9 +108,6 @@ def dashboard_view(request):
         queryset = queryset.filter(procedimento__procedimento_principal__name=procedimento)
         rpa_queryset = rpa_queryset.filter(procedimento__procedimento_principal__name=procedimento)
 
-    # Helper function is now in dashboard/utils.py
-    # def calculate_iqr_filtered_average_seconds(data_seconds_list): ...
-
     # -----------------------------------------------------------------------
     # 1) Handle custom date range if 'period=custom' + both start/end are given
     # -----------------------------------------------------------------------
@@ -136,35 +162,41 @@ def dashboard_view(request):
             rpa_queryset = rpa_queryset.filter(procedimento__data_horario__gte=start_date)
             delta_days = 180
 
-    # Now proceed with the rest of the metrics
-    total_count = queryset.count()
-    rpa_total_count = rpa_queryset.count()
+    # Now proceed with the rest of the metrics: every flag in one query per model
+    counts = qualidade_counts(queryset)
+    rpa = rpa_counts(rpa_queryset)
+    total_count = counts['total']
+    rpa_total_count = rpa['total']
 
     # Dor pos-operatoria
-    dor_count = (rpa_queryset.filter(dor_pos_operatoria=True).count() if dor_view == 'rpa' 
-                 else queryset.filter(dor_pos_operatoria=True).count())
+    dor_count = rpa['dor_pos_operatoria'] if dor_view == 'rpa' else counts['dor_pos_operatoria']
     dor_total = rpa_total_count if dor_view == 'rpa' else total_count
 
     # PONV
-    ponv_count = (rpa_queryset.filter(ponv=True).count() if ponv_view == 'rpa' 
-                  else queryset.filter(ponv=True).count())
+    ponv_count = rpa['ponv'] if ponv_view == 'rpa' else counts['ponv']
     ponv_total = rpa_total_count if ponv_view == 'rpa' else total_count
 
     # Evento Adverso
-    evento_count = (rpa_queryset.filter(evento_adverso=True).count() if evento_view == 'rpa' 
-                    else queryset.filter(evento_adverso_evitavel=True).count())
+    evento_count = rpa['evento_adverso_evitavel'] if evento_view == 'rpa' else counts['evento_adverso_evitavel']
     evento_total = rpa_total_count if evento_view == 'rpa' else total_count
 
-    # Atraso médio (avg_delay) calculation with IQR
-    delays_seconds = []
-    if total_count > 0:
-        for pq_item in queryset: # Renamed to avoid conflict with outer 'procedimento' variable
-            if pq_item.data_horario_inicio_efetivo and pq_item.procedimento and pq_item.procedimento.data_horario:
-                delay = pq_item.data_horario_inicio_efetivo - pq_item.procedimento.data_horario
-                if delay.total_seconds() >= 0: # Consider only non-negative delays
-                    delays_seconds.append(delay.total_seconds())
-    
-    avg_delay_seconds_filtered = calculate_iqr_filtered_average_seconds(delays_seconds)
+    # Atraso, duração and tempo até alta da RPA: IQR-filtered mean, median,
+    # p90 and p95, overall and per procedure type, from one slim fetch each
+    delays_seconds, durations_seconds, timing_tipos = timing_samples(queryset)
+    alta_rpa_seconds, alta_rpa_tipos = rpa_discharge_samples(rpa_queryset)
+    tipo_labels = dict(Procedimento.PROCEDIMENTO_TYPE)
+    tempos = {}
+    for metric, seconds, tipos in (
+        ('atraso', delays_seconds, timing_tipos),
+        ('duracao', durations_seconds, timing_tipos),
+        ('alta_rpa', alta_rpa_seconds, alta_rpa_tipos),
+    ):
+        tempos[metric] = robust_summary(seconds)
+        tempos[metric]['por_tipo'] = {
+            tipo_labels.get(tipo, tipo): summary for tipo, summary in robust_summary_by(seconds, tipos).items()
+        }
+
+    avg_delay_seconds_filtered = tempos['atraso']['mean']
     atraso_medio_formatted = None
     if avg_delay_seconds_filtered is not None:
         avg_delay_td = timedelta(seconds=avg_delay_seconds_filtered)
@@ -176,16 +208,7 @@ def dashboard_view(request):
         else:
             atraso_medio_formatted = f"{int(hours):02d}:{int(minutes):02d}"
 
-    # Duração média (avg_duration) calculation with IQR
-    durations_seconds = []
-    if total_count > 0:
-        for pq_item in queryset: # Renamed
-            if pq_item.data_horario_fim_efetivo and pq_item.data_horario_inicio_efetivo:
-                duration = pq_item.data_horario_fim_efetivo - pq_item.data_horario_inicio_efetivo
-                if duration.total_seconds() >= 0: # Consider only non-negative durations
-                     durations_seconds.append(duration.total_seconds())
-
-    avg_duration_seconds_filtered = calculate_iqr_filtered_average_seconds(durations_seconds)
+    avg_duration_seconds_filtered = tempos['duracao']['mean']
     duracao_media_formatted = None
     if avg_duration_seconds_filtered is not None:
         avg_duration_td = timedelta(seconds=avg_duration_seconds_filtered)
@@ -227,45 +250,48 @@ def dashboard_view(request):
         start_date_val = timezone.now() - timedelta(days=p_days)
         peak_hours_queryset = peak_hours_queryset.filter(data_horario__gte=start_date_val)
 
-    peak_hours = defaultdict(int)
-    for p_item in peak_hours_queryset:
-        if p_item.data_horario:
-            hour = p_item.data_horario.hour
-            peak_hours[hour] += 1
-    
+    # Weekday x hour heatmap in local time
+    peak_hours_by_weekday = peak_hours_heatmap(peak_hours_queryset)
+
     # Format peak hours for chart (all 24 hours)
-    peak_hours_data = [peak_hours[h] for h in range(24)]
+    peak_hours_data = [sum(day[h] for day in peak_hours_by_weekday) for h in range(24)]
+
+    def percent(metric):
+        return counts[metric] / total_count * 100 if total_count > 0 else None
 
     # Monta o dicionário de métricas
     metrics = {
-        'eventos_adversos': queryset.filter(eventos_adversos_graves=True).count() / total_count * 100 if total_count > 0 else None,
+        'eventos_adversos': percent('eventos_adversos'),
         'atraso_medio': atraso_medio_formatted,
         'duracao_media': duracao_media_formatted,
-        'reacoes_alergicas': queryset.filter(reacao_alergica_grave=True).count() / total_count * 100 if total_count > 0 else None,
-        'encaminhamentos_uti': queryset.filter(encaminhamento_uti=True).count() / total_count * 100 if total_count > 0 else None,
+        'tempo_alta_rpa': tempos['alta_rpa']['mean'],
+        'tempos': tempos,
+        'reacoes_alergicas': percent('reacoes_alergicas'),
+        'encaminhamentos_uti': percent('encaminhamentos_uti'),
         'ponv': (ponv_count / ponv_total * 100) if ponv_total > 0 else None,
         'dor_pos_operatoria': (dor_count / dor_total * 100) if dor_total > 0 else None,
         'evento_adverso_evitavel': (evento_count / evento_total * 100) if evento_total > 0 else None,
-        'adesao_checklist': queryset.filter(adesao_checklist=True).count() / total_count * 100 if total_count > 0 else None,
-        'conformidade_protocolos': queryset.filter(conformidade_diretrizes=True).count() / total_count * 100 if total_count > 0 else None,
-        'tecnicas_assepticas': queryset.filter(uso_tecnicas_assepticas=True).count() / total_count * 100 if total_count > 0 else None,
-        'adesao_profilaxia_antibiotica': queryset.filter(adesao_profilaxia_antibiotica=True).count() / total_count * 100 if total_count > 0 else None,
-        'adesao_prevencao_tvp_tep': queryset.filter(adesao_prevencao_tvp_tep=True).count() / total_count * 100 if total_count > 0 else None,
-        'csat_score': queryset.aggregate(Avg('csat_score'))['csat_score__avg'],
+        'adesao_checklist': percent('adesao_checklist'),
+        'conformidade_protocolos': percent('conformidade_protocolos'),
+        'tecnicas_assepticas': percent('tecnicas_assepticas'),
+        'adesao_profilaxia_antibiotica': percent('adesao_profilaxia_antibiotica'),
+        'adesao_prevencao_tvp_tep': percent('adesao_prevencao_tvp_tep'),
+        'csat_score': counts['csat_score'],
         'ponv_view': ponv_view,
         'evento_view': evento_view,
         'dor_view': dor_view,
-        'abreviacao_jejum_percent': queryset.filter(abreviacao_jejum=True).count() / total_count * 100 if total_count > 0 else None,
-        'aldrete_maior_que_8_percent': queryset.filter(escala_aldrete__gt=8).count() / total_count * 100 if total_count > 0 else None,
+        'abreviacao_jejum_percent': percent('abreviacao_jejum_percent'),
+        'aldrete_maior_que_8_percent': percent('aldrete_maior_que_8_percent'),
         'peak_hours_data': peak_hours_data,
+        'peak_hours_heatmap': peak_hours_by_weekday,
     }
 
     # Procedures for the filter
-    procedimentos = ProcedimentoDetalhes.objects.filter(
+    procedimentos = list(ProcedimentoDetalhes.objects.filter(
         procedimento__group=user_group
-    ).order_by('name').distinct()
+    ).order_by('name').distinct())
 
-    return render(request, 'dashboard.html', {
+    return {
         'metrics': metrics,
         'procedimentos': procedimentos,
         'selected_procedimento': procedimento,
@@ -275,8 +301,7 @@ def dashboard_view(request):
         'GESTOR_USER': GESTOR_USER,
         'ADMIN_USER': ADMIN_USER,
         'ANESTESISTA_USER': ANESTESISTA_USER,
-        'active_role': request.user.get_active_role(),
-    })
+    }
 
 @login_required
 def financas_dashboard_view(request):
@@ -287,9 +312,22 @@ def financas_dashboard_view(request):
 
     if not request.user.validado:
         return render(request, 'usuario_nao_autenticado.html')
-    if request.user.get_active_role() != GESTOR_USER:
+    active_role = request.user.get_active_role()
+    if active_role != GESTOR_USER:
         return HttpResponseForbidden("Acesso Negado")
 
+    # Only gestores get here, so the context depends on the group and the filters alone
+    context = cached_result(
+        request.user.group_id,
+        'financas',
+        normalized_params(request.GET, FINANCAS_PARAMS),
+        lambda: _financas_dashboard_context(request),
+    )
+    return render(request, 'dashboard_financas.html', {**context, 'active_role': active_role})
+
+
+def _financas_dashboard_context(request):
+    """Contexto do Dashboard de Finanças para o grupo e os filtros da requisição."""
     user_group = request.user.group
     user = request.user # Get the current user
 
@@ -310,16 +348,9 @@ def financas_dashboard_view(request):
     include_hospital = request.GET.get('include_hospital', '1')
     include_via_cirurgiao = request.GET.get('include_via_cirurgiao', '1')
 
-    # Base queryset with effective_date for filtering
+    # Base queryset; date filters use the stored, indexed data_efetiva
     queryset = (
         ProcedimentoFinancas.objects
-        .annotate(
-            effective_date_for_filter=Case(
-                When(procedimento__isnull=False, then=Cast('procedimento__data_horario', db_models.DateField())),
-                When(procedimento__isnull=True, then='api_data_cirurgia'),
-                output_field=db_models.DateField()
-            )
-        )
         .select_related('procedimento', 'procedimento__procedimento_principal', 'group')
         .filter(group=user_group) # Filter on ProcedimentoFinancas.group itself
     )
@@ -397,8 +428,8 @@ def financas_dashboard_view(request):
             chart_end_date = timezone.make_aware(month_end)
 
             queryset = queryset.filter(
-                effective_date_for_filter__gte=month_start.date(),
-                effective_date_for_filter__lte=month_end.date()
+                data_efetiva__gte=month_start.date(),
+                data_efetiva__lte=month_end.date()
             )
 
             selected_period = 'month'
@@ -408,7 +439,7 @@ def financas_dashboard_view(request):
             selected_period = 180
             chart_end_date = now
             chart_start_date = now - timedelta(days=180)
-            queryset = queryset.filter(effective_date_for_filter__gte=chart_start_date.date())
+            queryset = queryset.filter(data_efetiva__gte=chart_start_date.date())
 
     # if user selected 'custom' and provided valid start/end dates
     elif period == 'custom' and start_date_str and end_date_str:
@@ -422,10 +453,10 @@ def financas_dashboard_view(request):
             chart_start_date = timezone.make_aware(custom_start)
             chart_end_date = timezone.make_aware(custom_end)
 
-            # Filter the queryset for this custom range using effective_date_for_filter
+            # Filter the queryset for this custom range using data_efetiva
             queryset = queryset.filter(
-                effective_date_for_filter__gte=custom_start.date(),
-                effective_date_for_filter__lte=custom_end.date()
+                data_efetiva__gte=custom_start.date(),
+                data_efetiva__lte=custom_end.date()
             )
 
             selected_period = 'custom'
@@ -435,7 +466,7 @@ def financas_dashboard_view(request):
             selected_period = 180
             chart_end_date = now
             chart_start_date = now - timedelta(days=180)
-            queryset = queryset.filter(effective_date_for_filter__gte=chart_start_date.date())
+            queryset = queryset.filter(data_efetiva__gte=chart_start_date.date())
 
     else:
         # Not custom or missing date(s). Possibly numeric.
@@ -446,13 +477,13 @@ def financas_dashboard_view(request):
             selected_period = period_days
             chart_end_date = now
             chart_start_date = now - timedelta(days=period_days)
-            queryset = queryset.filter(effective_date_for_filter__gte=chart_start_date.date())
+            queryset = queryset.filter(data_efetiva__gte=chart_start_date.date())
         except (ValueError, TypeError):
             # fallback
             selected_period = 180
             chart_end_date = now
             chart_start_date = now - timedelta(days=180)
-            queryset = queryset.filter(effective_date_for_filter__gte=chart_start_date.date())
+            queryset = queryset.filter(data_efetiva__gte=chart_start_date.date())
 
     # If for some reason they are still None, default them
     if not chart_start_date or not chart_end_date:
@@ -461,7 +492,7 @@ def financas_dashboard_view(request):
         selected_period = 180
         # Ensure queryset is filtered if it fell through
         if not queryset.query.where: # Simplified check, might need refinement if other filters applied
-             queryset = queryset.filter(effective_date_for_filter__gte=chart_start_date.date())
+             queryset = queryset.filter(data_efetiva__gte=chart_start_date.date())
 
     # -----------------------------------------------------------------------
     # 2) Now we have a final chart_start_date and chart_end_date
@@ -469,10 +500,34 @@ def financas_dashboard_view(request):
     # -----------------------------------------------------------------------
     date_range, view_type = get_date_range(chart_start_date, chart_end_date)
 
+    # -----------------------------------------------------------------------
+    # 2b) Monthly views without procedure or anesthesiologist filters read the
+    #     precomputed monthly rollup (financas.rollup) instead of the finance
+    #     rows; surgeon and clinic filters are rollup dimensions
+    # -----------------------------------------------------------------------
+    rollup = None
+    rollup_anestesistas = None
+    if (view_type == 'monthly' and not procedimento and not selected_anestesista_id
+            and (not selected_cirurgiao_id or selected_cirurgiao_id.isdigit())):
+        # Numeric periods are open-ended, like the queryset filter above
+        rollup_end = chart_end_date.date() if selected_period in ('month', 'custom') else None
+
+        def rollup_filtered(rows):
+            if clinic:
+                rows = rows.where(tipo_clinica=clinic)
+            if selected_cirurgiao_id:
+                rows = rows.where(cirurgiao_id=int(selected_cirurgiao_id))
+            return rows
+
+        rollup = rollup_filtered(rollup_rows(user_group, chart_start_date.date(), rollup_end))
+        rollup_anestesistas = rollup_filtered(
+            rollup_rows(user_group, chart_start_date.date(), rollup_end, por_anestesista=True)
+        )
+
     # -----------------------------------------------------------------------
     # 3) Proceed with finance calculations
     # -----------------------------------------------------------------------
-    total_count = queryset.count()
+    total_count = rollup.total('quantidade') if rollup is not None else queryset.count()
 
     # Distinct procedures
     anestesias_count = queryset.values('procedimento').distinct().count()
@@ -491,38 +546,50 @@ def financas_dashboard_view(request):
     if len(included_charge_types) > 0 and len(included_charge_types) < 4:
         totals_queryset = totals_queryset.filter(tipo_cobranca__in=included_charge_types)
 
-    # Summations by status_pagamento using the new fields and statuses (filtered by selected charge types)
-    totals_by_status = totals_queryset.values('status_pagamento').annotate(
-        total=Sum('valor_faturado')
-    )
-    total_valor = sum(
-        item['total'] for item in totals_by_status if item['total'] is not None
-    ) if totals_by_status else 0
-
-    # Calculate values based on the new business logic
-    valor_pago = totals_queryset.filter(
-        status_pagamento__in=['processo_finalizado', 'recurso_de_glosa']
-    ).aggregate(
-        total=Sum(
-            Coalesce('valor_recebido', 0) + Coalesce('valor_recuperado', 0),
-            output_field=db_models.DecimalField()
+    if rollup is not None:
+        totals_rows = rollup
+        if len(included_charge_types) > 0 and len(included_charge_types) < 4:
+            totals_rows = rollup.where(tipo_cobranca__in=included_charge_types)
+        total_valor = totals_rows.total('soma_faturado')
+        paid_rows = totals_rows.where(status_pagamento__in=['processo_finalizado', 'recurso_de_glosa'])
+        valor_pago = paid_rows.total('soma_recebido') + paid_rows.total('soma_recuperado')
+        valor_pendente = totals_rows.where(
+            status_pagamento__in=['em_processamento', 'aguardando_pagamento']
+        ).total('soma_faturado')
+        valor_glosa = paid_rows.total('soma_glosa')
+    else:
+        # Summations by status_pagamento using the new fields and statuses (filtered by selected charge types)
+        totals_by_status = totals_queryset.values('status_pagamento').annotate(
+            total=Sum('valor_faturado')
         )
-    )['total'] or 0
+        total_valor = sum(
+            item['total'] for item in totals_by_status if item['total'] is not None
+        ) if totals_by_status else 0
+
+        # Calculate values based on the new business logic
+        valor_pago = totals_queryset.filter(
+            status_pagamento__in=['processo_finalizado', 'recurso_de_glosa']
+        ).aggregate(
+            total=Sum(
+                Coalesce('valor_recebido', 0) + Coalesce('valor_recuperado', 0),
+                output_field=db_models.DecimalField()
+            )
+        )['total'] or 0
     
-    valor_pendente = totals_queryset.filter(
-        status_pagamento__in=['em_processamento', 'aguardando_pagamento']
-    ).aggregate(
-        total=Sum('valor_faturado')
-    )['total'] or 0
+        valor_pendente = totals_queryset.filter(
+            status_pagamento__in=['em_processamento', 'aguardando_pagamento']
+        ).aggregate(
+            total=Sum('valor_faturado')
+        )['total'] or 0
     
-    valor_glosa = totals_queryset.filter(
-        status_pagamento__in=['processo_finalizado', 'recurso_de_glosa']
-    ).aggregate(
-        total=Sum(
-            F('valor_faturado') - Coalesce(F('valor_recebido'), 0) - Coalesce(F('valor_recuperado'), 0),
-            output_field=db_models.DecimalField()
-        )
-    )['total'] or 0
+        valor_glosa = totals_queryset.filter(
+            status_pagamento__in=['processo_finalizado', 'recurso_de_glosa']
+        ).aggregate(
+            total=Sum(
+                F('valor_faturado') - Coalesce(F('valor_recebido'), 0) - Coalesce(F('valor_recuperado'), 0),
+                output_field=db_models.DecimalField()
+            )
+        )['total'] or 0
 
     # Helper for percentage
     def percentage(part, whole):
@@ -538,12 +605,12 @@ def financas_dashboard_view(request):
     paid_procedures = queryset.filter(
         status_pagamento='processo_finalizado', # Assuming 'processo_finalizado' is the target status
         data_pagamento__isnull=False,
-        effective_date_for_filter__isnull=False
+        data_efetiva__isnull=False
     )
     avg_recebimento = None
     if paid_procedures.exists():
         avg_recebimento_diff = paid_procedures.annotate(
-            diff_duration=ExpressionWrapper(F('data_pagamento') - F('effective_date_for_filter'), output_field=DurationField())
+            diff_duration=ExpressionWrapper(F('data_pagamento') - F('data_efetiva'), output_field=DurationField())
         ).aggregate(avg_diff_duration=Avg('diff_duration'))['avg_diff_duration']
         
         if avg_recebimento_diff:
@@ -555,7 +622,11 @@ def financas_dashboard_view(request):
                 avg_recebimento = f"{avg_days} dias"
 
     # Ticket Médio
-    avg_ticket = queryset.aggregate(avg_valor=Avg('valor_faturado'))['avg_valor']
+    if rollup is not None:
+        faturados = rollup.total('quantidade_faturado')
+        avg_ticket = rollup.total('soma_faturado') / faturados if faturados else None
+    else:
+        avg_ticket = queryset.aggregate(avg_valor=Avg('valor_faturado'))['avg_valor']
 
     # -----------------------------------------------------------------------
     # 4) Build chart data (daily or monthly)
@@ -574,7 +645,7 @@ def financas_dashboard_view(request):
         }
 
         daily_data = queryset.annotate(
-            date=TruncDate('effective_date_for_filter')
+            date=F('data_efetiva')
         ).filter(
             status_pagamento__in=['processo_finalizado', 'recurso_de_glosa'] # Filter for paid/finalized statuses
         ).values('date', 'tipo_cobranca').annotate(
@@ -602,10 +673,11 @@ def financas_dashboard_view(request):
         # Calculate daily tickets and revenues
         daily_tickets = []
         daily_revenues = []
+        day_cells = faturado_by_period(queryset, 'daily')
         for d_date_obj in sorted_dates: # d is a date object from sorted_dates
-            day_procedures = queryset.filter(effective_date_for_filter=d_date_obj)
-            day_total = day_procedures.aggregate(total=Sum('valor_faturado'))['total'] or 0
-            day_count = day_procedures.count()
+            day_cell = day_cells.get(d_date_obj, {})
+            day_total = day_cell.get('total') or 0
+            day_count = day_cell.get('count', 0)
             average_for_day = day_total / day_count if day_count > 0 else 0
             daily_tickets.append(float(round(average_for_day, 2)))
             daily_revenues.append(float(round(day_total, 2)))
@@ -626,16 +698,25 @@ def financas_dashboard_view(request):
                 'cortesia': 0,
             }
 
-        monthly_data = queryset.annotate(
-            month=TruncMonth('effective_date_for_filter')
-        ).filter(
-            status_pagamento__in=['processo_finalizado', 'recurso_de_glosa'] # Filter for paid/finalized statuses
-        ).values('month', 'tipo_cobranca').annotate(
-            total_recebido_periodo=Sum( # Sum of received and recovered amounts
-                Coalesce(F('valor_recebido'), 0) + Coalesce(F('valor_recuperado'), 0),
-                output_field=db_models.DecimalField()
-            )
-        ).order_by('month')
+        if rollup is not None:
+            monthly_data = defaultdict(Decimal)
+            for row in rollup.where(status_pagamento__in=['processo_finalizado', 'recurso_de_glosa']):
+                monthly_data[row['mes'], row['tipo_cobranca']] += row['soma_recebido'] + row['soma_recuperado']
+            monthly_data = [
+                {'month': month, 'tipo_cobranca': tipo, 'total_recebido_periodo': total}
+                for (month, tipo), total in monthly_data.items()
+            ]
+        else:
+            monthly_data = queryset.annotate(
+                month=TruncMonth('data_efetiva')
+            ).filter(
+                status_pagamento__in=['processo_finalizado', 'recurso_de_glosa'] # Filter for paid/finalized statuses
+            ).values('month', 'tipo_cobranca').annotate(
+                total_recebido_periodo=Sum( # Sum of received and recovered amounts
+                    Coalesce(F('valor_recebido'), 0) + Coalesce(F('valor_recuperado'), 0),
+                    output_field=db_models.DecimalField()
+                )
+            ).order_by('month')
 
         for item in monthly_data:
             if item['month'] and item['tipo_cobranca']:
@@ -666,13 +747,16 @@ def financas_dashboard_view(request):
         # monthly tickets & revenues
         monthly_tickets = []
         monthly_revenues = []
+        if rollup is not None:
+            month_totals = rollup.totals_by('mes', 'soma_faturado')
+            month_counts = rollup.totals_by('mes', 'quantidade')
+        else:
+            month_cells = faturado_by_period(queryset, 'monthly')
+            month_totals = {mes: cell['total'] or 0 for mes, cell in month_cells.items()}
+            month_counts = {mes: cell['count'] for mes, cell in month_cells.items()}
         for m_datetime_obj in sorted_months: # m is a datetime object
-            month_procedures = queryset.filter(
-                effective_date_for_filter__year=m_datetime_obj.year,
-                effective_date_for_filter__month=m_datetime_obj.month
-            )
-            month_total = month_procedures.aggregate(total=Sum('valor_faturado'))['total'] or 0
-            month_count = month_procedures.count()
+            month_total = month_totals.get(m_datetime_obj.date(), 0)
+            month_count = month_counts.get(m_datetime_obj.date(), 0)
             monthly_tickets.append(
                 float(round(month_total / month_count if month_count > 0 else 0, 2))
             )
@@ -709,7 +793,9 @@ def financas_dashboard_view(request):
     #    Recalculate anestesista_total based on potential filtering changes
     # -----------------------------------------------------------------------
     # period_total uses the main queryset which might be filtered by date, procedure, and potentially anesthesiologist
-    if selected_graph_type == 'ticket':
+    if rollup is not None:
+        period_total = (avg_ticket or 0) if selected_graph_type == 'ticket' else rollup.total('soma_faturado')
+    elif selected_graph_type == 'ticket':
         period_total = queryset.aggregate(avg_valor=Avg('valor_faturado'))['avg_valor'] or 0
     else: # 'receitas'
         period_total = queryset.aggregate(total=Sum('valor_faturado'))['total'] or 0
@@ -723,22 +809,28 @@ def financas_dashboard_view(request):
     else:
          # If no specific anesthesiologist is filtered, calculate average across all in the group
          num_anestesistas = anestesistas_all.count()
-         if num_anestesistas > 0:
+         if num_anestesistas > 0 and rollup is not None:
+            # Whole group over the closed chart range, clinic filter only
+            group_rows = rollup_rows(user_group, chart_start_date.date(), chart_end_date.date())
+            if clinic:
+                group_rows = group_rows.where(tipo_clinica=clinic)
+            if selected_graph_type == 'ticket':
+                faturados = group_rows.total('quantidade_faturado')
+                anestesista_total = group_rows.total('soma_faturado') / faturados if faturados else 0
+            else:
+                anestesista_total = group_rows.total('soma_faturado') / num_anestesistas
+         elif num_anestesistas > 0:
             # Need to calculate total for the period *without* anesthesiologist filter if GESTOR/ADMIN chose "all"
             # Or if ANESTESISTA chose "all"
             # Apply annotation and filters to ProcedimentoFinancas directly
-            _unfiltered_base_qs = ProcedimentoFinancas.objects.annotate(
-                effective_date_for_filter=Case(
-                    When(procedimento__isnull=False, then=Cast('procedimento__data_horario', db_models.DateField())),
-                    When(procedimento__isnull=True, then='api_data_cirurgia'),
-                    output_field=db_models.DateField()
-                )
-            ).select_related('procedimento', 'procedimento__procedimento_principal', 'group')
+            _unfiltered_base_qs = ProcedimentoFinancas.objects.select_related(
+                'procedimento', 'procedimento__procedimento_principal', 'group'
+            )
             
             unfiltered_by_anest_queryset = _unfiltered_base_qs.filter(
                 group=user_group, # Filter on ProcedimentoFinancas.group
-                effective_date_for_filter__gte=chart_start_date.date(), # Use .date()
-                effective_date_for_filter__lte=chart_end_date.date()    # Use .date()
+                data_efetiva__gte=chart_start_date.date(), # Use .date()
+                data_efetiva__lte=chart_end_date.date()    # Use .date()
             )
             if procedimento: # Apply procedure filter if present
                 unfiltered_by_anest_queryset = unfiltered_by_anest_queryset.filter(procedimento__procedimento_principal__name=procedimento)
@@ -763,12 +855,27 @@ def financas_dashboard_view(request):
     # -----------------------------------------------------------------------
     clinic_type_map = dict(CLINIC_TYPE_CHOICES)
 
-    top_surgeons_qs = (
-        queryset.filter(procedimento__cirurgiao__isnull=False)
-        .values('procedimento__cirurgiao__id', 'procedimento__cirurgiao__name')
-        .annotate(total_valor=Sum('valor_faturado'))
-        .order_by('-total_valor')[:10]
-    )
+    if rollup is not None:
+        surgeon_totals = rollup.totals_by('cirurgiao_id', 'soma_faturado')
+        top_surgeons_qs = sorted(
+            ((pk, total) for pk, total in surgeon_totals.items() if pk is not None),
+            key=lambda item: item[1], reverse=True,
+        )[:10]
+        surgeon_names = dict(
+            Surgeon.objects.filter(pk__in=[pk for pk, _ in top_surgeons_qs]).values_list('pk', 'name')
+        )
+        top_surgeons_qs = [
+            {'procedimento__cirurgiao__id': pk, 'procedimento__cirurgiao__name': surgeon_names[pk], 'total_valor': total}
+            for pk, total in top_surgeons_qs
+            if pk in surgeon_names
+        ]
+    else:
+        top_surgeons_qs = (
+            queryset.filter(procedimento__cirurgiao__isnull=False)
+            .values('procedimento__cirurgiao__id', 'procedimento__cirurgiao__name')
+            .annotate(total_valor=Sum('valor_faturado'))
+            .order_by('-total_valor')[:10]
+        )
     top_surgeons = [
         {
             'id': item['procedimento__cirurgiao__id'],
@@ -778,12 +885,20 @@ def financas_dashboard_view(request):
         for item in top_surgeons_qs
     ]
 
-    top_clinics_qs = (
-        queryset.filter(procedimento__tipo_clinica__isnull=False)
-        .values('procedimento__tipo_clinica')
-        .annotate(total_valor=Sum('valor_faturado'))
-        .order_by('-total_valor')[:10]
-    )
+    if rollup is not None:
+        clinic_totals = rollup.totals_by('tipo_clinica', 'soma_faturado')
+        top_clinics_qs = [
+            {'procedimento__tipo_clinica': slug, 'total_valor': total}
+            for slug, total in sorted(clinic_totals.items(), key=lambda item: item[1], reverse=True)
+            if slug is not None
+        ][:10]
+    else:
+        top_clinics_qs = (
+            queryset.filter(procedimento__tipo_clinica__isnull=False)
+            .values('procedimento__tipo_clinica')
+            .annotate(total_valor=Sum('valor_faturado'))
+            .order_by('-total_valor')[:10]
+        )
     top_clinics = [
         {
             'slug': item['procedimento__tipo_clinica'],
@@ -799,44 +914,56 @@ def financas_dashboard_view(request):
         'total_anestesias': 0,
     })
 
-    responsaveis_qs = (
-        queryset.filter(procedimento__anestesistas_responsaveis__isnull=False)
-        .values('procedimento__anestesistas_responsaveis__id', 'procedimento__anestesistas_responsaveis__name')
-        .annotate(
-            total_valor=Sum('valor_faturado'),
-            total_anestesias=Count('procedimento__id', distinct=True),
+    if rollup_anestesistas is not None:
+        rollup_valores = rollup_anestesistas.totals_by('anestesista_id', 'soma_faturado')
+        rollup_anestesias = rollup_anestesistas.totals_by('anestesista_id', 'procedimentos')
+        anestesista_names = dict(
+            Anesthesiologist.objects.filter(pk__in=list(rollup_valores)).values_list('pk', 'name')
         )
-    )
-
-    for item in responsaveis_qs:
-        anest_id = item['procedimento__anestesistas_responsaveis__id']
-        if not anest_id:
-            continue
-        entry = anestesista_totals[anest_id]
-        entry['name'] = item['procedimento__anestesistas_responsaveis__name'] or entry['name'] or 'Não informado'
-        entry['total_valor'] += item['total_valor'] or Decimal('0')
-        entry['total_anestesias'] += item['total_anestesias'] or 0
-
-    cooperado_fallback_qs = (
-        queryset.filter(
-            procedimento__anestesistas_responsaveis__isnull=True,
-            procedimento__cooperado__isnull=False,
+        for anest_id, total_valor in rollup_valores.items():
+            entry = anestesista_totals[anest_id]
+            entry['name'] = anestesista_names.get(anest_id) or 'Não informado'
+            entry['total_valor'] += total_valor
+            entry['total_anestesias'] += rollup_anestesias[anest_id]
+    else:
+        responsaveis_qs = (
+            queryset.filter(procedimento__anestesistas_responsaveis__isnull=False)
+            .values('procedimento__anestesistas_responsaveis__id', 'procedimento__anestesistas_responsaveis__name')
+            .annotate(
+                total_valor=Sum('valor_faturado'),
+                total_anestesias=Count('procedimento__id', distinct=True),
+            )
         )
-        .values('procedimento__cooperado__id', 'procedimento__cooperado__name')
-        .annotate(
-            total_valor=Sum('valor_faturado'),
-            total_anestesias=Count('procedimento__id', distinct=True),
+
+        for item in responsaveis_qs:
+            anest_id = item['procedimento__anestesistas_responsaveis__id']
+            if not anest_id:
+                continue
+            entry = anestesista_totals[anest_id]
+            entry['name'] = item['procedimento__anestesistas_responsaveis__name'] or entry['name'] or 'Não informado'
+            entry['total_valor'] += item['total_valor'] or Decimal('0')
+            entry['total_anestesias'] += item['total_anestesias'] or 0
+
+        cooperado_fallback_qs = (
+            queryset.filter(
+                procedimento__anestesistas_responsaveis__isnull=True,
+                procedimento__cooperado__isnull=False,
+            )
+            .values('procedimento__cooperado__id', 'procedimento__cooperado__name')
+            .annotate(
+                total_valor=Sum('valor_faturado'),
+                total_anestesias=Count('procedimento__id', distinct=True),
+            )
         )
-    )
 
-    for item in cooperado_fallback_qs:
-        anest_id = item['procedimento__cooperado__id']
-        if not anest_id:
-            continue
-        entry = anestesista_totals[anest_id]
-        entry['name'] = item['procedimento__cooperado__name'] or entry['name'] or 'Não informado'
-        entry['total_valor'] += item['total_valor'] or Decimal('0')
-        entry['total_anestesias'] += item['total_anestesias'] or 0
+        for item in cooperado_fallback_qs:
+            anest_id = item['procedimento__cooperado__id']
+            if not anest_id:
+                continue
+            entry = anestesista_totals[anest_id]
+            entry['name'] = item['procedimento__cooperado__name'] or entry['name'] or 'Não informado'
+            entry['total_valor'] += item['total_valor'] or Decimal('0')
+            entry['total_anestesias'] += item['total_anestesias'] or 0
 
     anestesista_comparativo = sorted(
         [
@@ -863,68 +990,24 @@ def financas_dashboard_view(request):
         # Build month headers
         monthly_headers = [MONTH_NAMES_PT.get(m.month, str(m.month)) for m in sorted_months]
         
-        # Build monthly data for each anestesista in the top 10
+        # Build monthly data for each anestesista in the top 10, from one
+        # (anestesista, month) pivot instead of four queries per cell
         anestesista_comparativo_mensal = []
+        mensal_valores = defaultdict(Decimal)
+        mensal_anestesias = defaultdict(int)
+        if rollup_anestesistas is not None:
+            for row in rollup_anestesistas:
+                mensal_valores[row['anestesista_id'], row['mes']] += row['soma_faturado']
+                mensal_anestesias[row['anestesista_id'], row['mes']] += row['procedimentos']
+        else:
+            for key, cell in faturado_by_anestesista_month(queryset).items():
+                mensal_valores[key] = cell['total'] or Decimal('0')
+                mensal_anestesias[key] = cell['anestesias']
         
         for anest_item in anestesista_comparativo:
             anest_id = anest_item['id']
-            monthly_values = []
-            monthly_anestesias = []
-            
-            # For each month in the range, get the value for this anestesista
-            for month_date in sorted_months:
-                month_start = datetime(month_date.year, month_date.month, 1)
-                month_end = datetime(month_date.year, month_date.month, calendar.monthrange(month_date.year, month_date.month)[1])
-                
-                # Query responsaveis - valor faturado
-                month_total = Decimal('0')
-                responsaveis_monthly = (
-                    queryset.filter(
-                        procedimento__anestesistas_responsaveis__id=anest_id,
-                        effective_date_for_filter__gte=month_start.date(),
-                        effective_date_for_filter__lte=month_end.date()
-                    ).aggregate(total=Sum('valor_faturado'))
-                )
-                if responsaveis_monthly['total']:
-                    month_total += responsaveis_monthly['total']
-                
-                # Query cooperado fallback - valor faturado
-                cooperado_monthly = (
-                    queryset.filter(
-                        procedimento__anestesistas_responsaveis__isnull=True,
-                        procedimento__cooperado__id=anest_id,
-                        effective_date_for_filter__gte=month_start.date(),
-                        effective_date_for_filter__lte=month_end.date()
-                    ).aggregate(total=Sum('valor_faturado'))
-                )
-                if cooperado_monthly['total']:
-                    month_total += cooperado_monthly['total']
-                
-                monthly_values.append(month_total)
-                
-                # Query responsaveis - anesthesia count
-                month_anestesias = Decimal('0')
-                responsaveis_monthly_count = (
-                    queryset.filter(
-                        procedimento__anestesistas_responsaveis__id=anest_id,
-                        effective_date_for_filter__gte=month_start.date(),
-                        effective_date_for_filter__lte=month_end.date()
-                    ).values('procedimento').distinct().count()
-                )
-                month_anestesias += responsaveis_monthly_count
-                
-                # Query cooperado fallback - anesthesia count
-                cooperado_monthly_count = (
-                    queryset.filter(
-                        procedimento__anestesistas_responsaveis__isnull=True,
-                        procedimento__cooperado__id=anest_id,
-                        effective_date_for_filter__gte=month_start.date(),
-                        effective_date_for_filter__lte=month_end.date()
-                    ).values('procedimento').distinct().count()
-                )
-                month_anestesias += cooperado_monthly_count
-                
-                monthly_anestesias.append(month_anestesias)
+            monthly_values = [mensal_valores[anest_id, m.date()] for m in sorted_months]
+            monthly_anestesias = [mensal_anestesias[anest_id, m.date()] for m in sorted_months]
             
             anestesista_comparativo_mensal.append({
                 'id': anest_id,
@@ -975,17 +1058,17 @@ def financas_dashboard_view(request):
         'via_cirurgiao_pct': via_cirurgiao_pct,
         'cortesia_pct': cortesia_pct,
 
-        'procedimentos': procedimentos,
+        # Lists rather than querysets: the context is cached
+        'procedimentos': list(procedimentos),
         'selected_procedimento': procedimento,
 
-        'anestesistas': anestesistas_for_template, # Pass the potentially limited list for the dropdown
+        'anestesistas': list(anestesistas_for_template), # Pass the potentially limited list for the dropdown
         'selected_anestesista': selected_anestesista_id, # Pass the ID that was actually used for filtering
-        'cirurgioes': cirurgioes_all,
+        'cirurgioes': list(cirurgioes_all),
         'selected_cirurgiao': selected_cirurgiao_id,
         'period_total': period_total,
         'anestesista_total': anestesista_total,
         'selected_graph_type': selected_graph_type,
-        'active_role': request.user.get_active_role(),
         'clinic_choices': sorted(CLINIC_TYPE_CHOICES, key=lambda x: x[1]),
         'selected_clinic': clinic,
         'include_cooperativa': include_cooperativa != '0',
@@ -1000,7 +1083,7 @@ def financas_dashboard_view(request):
         'selected_anestesista_view': selected_anestesista_view,
     }
 
-    return render(request, 'dashboard_financas.html', context)
+    return context
 
 @login_required
 def export_financas_excel(request):
@@ -1039,16 +1122,9 @@ def export_financas_excel(request):
     procedimento_filter_name = request.GET.get('procedimento') # Renamed to avoid clash
     clinic = request.GET.get('clinic')
 
-    # Base queryset with annotation
+    # Base queryset
     queryset = (
         ProcedimentoFinancas.objects
-        .annotate(
-            effective_date_for_filter=Case(
-                When(procedimento__isnull=False, then=Cast('procedimento__data_horario', db_models.DateField())),
-                When(procedimento__isnull=True, then='api_data_cirurgia'),
-                output_field=db_models.DateField()
-            )
-        )
         .select_related('procedimento', 'procedimento__procedimento_principal', 'group')
         .filter(group=user_group) # Filter on ProcedimentoFinancas.group
     )
@@ -1099,8 +1175,8 @@ def export_financas_excel(request):
             export_start_date = timezone.make_aware(datetime(year, month, 1))
             export_end_date = timezone.make_aware(datetime(year, month, last_day, 23, 59, 59))
             queryset = queryset.filter(
-                effective_date_for_filter__gte=export_start_date.date(),
-                effective_date_for_filter__lte=export_end_date.date(),
+                data_efetiva__gte=export_start_date.date(),
+                data_efetiva__lte=export_end_date.date(),
             )
         except (ValueError, TypeError):
             period = 180  # fallback if month is invalid
@@ -1114,8 +1190,8 @@ def export_financas_excel(request):
             export_start_date = timezone.make_aware(custom_start)
             export_end_date = timezone.make_aware(custom_end)
             queryset = queryset.filter(
-                effective_date_for_filter__gte=export_start_date.date(),
-                effective_date_for_filter__lte=export_end_date.date()
+                data_efetiva__gte=export_start_date.date(),
+                data_efetiva__lte=export_end_date.date()
             )
         except ValueError:
              period = 180 # fallback if custom dates are invalid
@@ -1127,13 +1203,13 @@ def export_financas_excel(request):
             period_days = int(period)
             export_end_date = now
             export_start_date = now - timedelta(days=period_days) # datetime object
-            queryset = queryset.filter(effective_date_for_filter__gte=export_start_date.date())
+            queryset = queryset.filter(data_efetiva__gte=export_start_date.date())
         except (ValueError, TypeError):
             # Final fallback
             period_days = 180 # unused, just for consistency
             export_end_date = now
             export_start_date = now - timedelta(days=180) # datetime object
-            queryset = queryset.filter(effective_date_for_filter__gte=export_start_date.date())
+            queryset = queryset.filter(data_efetiva__gte=export_start_date.date())
     # --- End of replicated filtering logic ---
 
     # Write headers
@@ -1149,9 +1225,9 @@ def export_financas_excel(request):
     # Write data
     row = 1
     # Order by date for clarity in Excel
-    queryset = queryset.order_by('effective_date_for_filter') # Use annotated date
+    queryset = queryset.order_by('data_efetiva')
     for item in queryset:
-        worksheet.write(row, 0, item.effective_date_for_filter.strftime('%d/%m/%Y') if item.effective_date_for_filter else '')
+        worksheet.write(row, 0, item.data_efetiva.strftime('%d/%m/%Y') if item.data_efetiva else '')
         
         proc_principal_name = ''
         if item.procedimento and item.procedimento.procedimento_principal:
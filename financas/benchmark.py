@@ -0,0 +1,248 @@
+"""
+Benchmark harness for the conciliation engine.
+
+Builds a synthetic ``listaguias`` payload plus a matching Procedimento /
+ProcedimentoFinancas population in a throwaway group, runs the
+``engine.ConciliacaoEngine`` end to end through ``guias.iter_guias`` and
+reports wall time per phase (fetch, load, match, flush), query count and peak
+memory. Everything is written inside a transaction that is rolled back, so
+the benchmark can run against any database without leaving data behind.
+"""
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from agenda.entities import clear_entity_cache
+from agenda.models import Procedimento
+from registration.models import CustomUser, Groups
+
+from .engine import ConciliacaoEngine, JobProgressSink
+from .guias import iter_guias, month_windows
+from .models import ConciliacaoJob, ProcedimentoFinancas
+
+
+FIRST_NAMES = [
+    'Ana', 'Beatriz', 'Carlos', 'Daniela', 'Eduardo', 'Fernanda', 'Gabriel', 'Helena',
+    'Igor', 'Joana', 'Lucas', 'Mariana', 'Nelson', 'Olivia', 'Paulo', 'Renata',
+    'Sergio', 'Tatiana', 'Vinicius', 'Yara',
+]
+LAST_NAMES = [
+    'Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira',
+    'Lima', 'Gomes', 'Costa', 'Ribeiro', 'Martins', 'Carvalho', 'Almeida', 'Lopes',
+    'Soares', 'Fernandes', 'Vieira', 'Barbosa',
+]
+HOSPITALS = ['Hospital Central', 'Clinica Sao Lucas', 'Hospital Norte', 'Casa de Saude Sul']
+STATUSES = ['Em Processamento', 'Aguardando Pagamento', 'Recurso de Glosa', 'Processo Finalizado']
+
+
+class PhaseTimer:
+    """Accumulates wall time per named phase; phases may repeat."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - started
+            self.calls[name] += 1
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, charging the time spent producing items to name."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def as_dict(self):
+        return {
+            name: {'seconds': round(seconds, 4), 'calls': self.calls[name]}
+            for name, seconds in sorted(self.seconds.items())
+        }
+
+
+def _patient_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def _add_noise(name, rng):
+    """Introduce one typo: drop, swap or replace a character."""
+    chars = list(name)
+    i = rng.randrange(1, len(chars) - 1)
+    operation = rng.choice(('drop', 'swap', 'replace'))
+    if operation == 'drop':
+        del chars[i]
+    elif operation == 'swap':
+        chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    else:
+        chars[i] = rng.choice('aeiourstln')
+    return ''.join(chars)
+
+
+def generate_dataset(group, guias=1000, procedures=None, existing_ratio=0.5, noise_rate=0.1,
+                     date_spread_days=90, end_date=None, seed=0):
+    """
+    Create the procedure/finance population for group and return the synthetic
+    guides as a list of ``listaguias`` dicts.
+
+    The first ``procedures`` guides describe a stored procedure (same patient,
+    date within one day); ``existing_ratio`` of those already have a
+    ProcedimentoFinancas with the guide's CPSA, half of them unlinked.
+    ``noise_rate`` of the guide patient names carry a typo. Remaining guides
+    refer to procedures that do not exist yet.
+    """
+    rng = random.Random(seed)
+    end_date = end_date or timezone.now().date()
+    procedures = guias if procedures is None else min(procedures, guias)
+
+    procs = []
+    for i in range(procedures):
+        day = end_date - timedelta(days=rng.randrange(date_spread_days))
+        hour = rng.randrange(6, 20)
+        procs.append(Procedimento(
+            group=group,
+            nome_paciente=_patient_name(rng),
+            data_horario=timezone.make_aware(datetime(day.year, day.month, day.day, hour, 0)),
+        ))
+    procs = Procedimento.objects.bulk_create(procs)
+
+    listaguias = []
+    financas = []
+    for i in range(guias):
+        cpsa = str(900000 + i)
+        if i < procedures:
+            proc = procs[i]
+            local_start = timezone.localtime(proc.data_horario)
+            paciente = proc.nome_paciente
+            guia_date = local_start.date() + timedelta(days=rng.choice((0, 0, 0, 1, -1)))
+            hora = local_start.strftime('%H:%M')
+            if rng.random() < existing_ratio:
+                financas.append(ProcedimentoFinancas(
+                    group=group,
+                    procedimento=proc if rng.random() < 0.5 else None,
+                    tipo_cobranca='cooperativa',
+                    cpsa=cpsa,
+                    api_paciente_nome=paciente,
+                ))
+        else:
+            paciente = _patient_name(rng)
+            guia_date = end_date - timedelta(days=rng.randrange(date_spread_days))
+            hora = f"{rng.randrange(6, 20):02d}:00"
+        if rng.random() < noise_rate:
+            paciente = _add_noise(paciente, rng)
+        valor = rng.randrange(500, 5000)
+        listaguias.append({
+            'nrocpsa': cpsa,
+            'paciente': paciente,
+            'dt_cirurg': guia_date.strftime('%Y-%m-%d'),
+            'hora_inicial': hora,
+            'hospital': rng.choice(HOSPITALS),
+            'cooperado': _patient_name(rng),
+            'STATUS': rng.choice(STATUSES),
+            'valor_faturado': f"{valor}.00",
+            'valor_recebido': f"{valor - rng.randrange(0, 200)}.00",
+        })
+    ProcedimentoFinancas.objects.bulk_create(financas)
+    return listaguias
+
+
+def windowed_fetcher(listaguias):
+    """Return an iter_guias fetch_window serving listaguias by requested period."""
+    def fetch_window(connection_key, periodo_de, periodo_ate, **kwargs):
+        period = (periodo_de.strftime('%Y-%m-%d'), periodo_ate.strftime('%Y-%m-%d'))
+        return [g for g in listaguias if period[0] <= g['dt_cirurg'] <= period[1]]
+    return fetch_window
+
+
+def run_benchmark(guias=1000, procedures=None, existing_ratio=0.5, noise_rate=0.1,
+                  date_spread_days=90, seed=0, trace_memory=True):
+    """
+    Run one synthetic conciliation and return its measurements as a dict.
+    All rows created by the run are rolled back.
+    """
+    end_date = timezone.now().date()
+    start_date = end_date - timedelta(days=date_spread_days + 1)
+    params = {
+        'guias': guias, 'procedures': procedures, 'existing_ratio': existing_ratio,
+        'noise_rate': noise_rate, 'date_spread_days': date_spread_days, 'seed': seed,
+    }
+
+    with transaction.atomic():
+        group = Groups.objects.create(name=f'Benchmark {timezone.now():%Y%m%d%H%M%S}')
+        user = CustomUser.objects.create_user(
+            username=f'benchmark_{group.pk}', email=f'benchmark_{group.pk}@example.com',
+            password=None, group=group,
+        )
+        setup_started = time.perf_counter()
+        listaguias = generate_dataset(
+            group, guias=guias, procedures=procedures, existing_ratio=existing_ratio,
+            noise_rate=noise_rate, date_spread_days=date_spread_days, end_date=end_date, seed=seed,
+        )
+        setup_seconds = time.perf_counter() - setup_started
+        job = ConciliacaoJob.objects.create(group=group, requested_by=user, status='running')
+
+        timer = PhaseTimer()
+
+        def on_window(periodo_de, periodo_ate, guias_count, window_hash):
+            job.total_guias += guias_count
+
+        guias_items = timer.timed_iter('fetch', iter_guias(
+            None, start_date, end_date=end_date, on_window=on_window,
+            max_workers=1, fetch_window=windowed_fetcher(listaguias),
+        ))
+
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                engine = ConciliacaoEngine(
+                    group, start_date=start_date, sinks=[JobProgressSink(job)], phase_timer=timer,
+                ).run(guias_items)
+                total_seconds = time.perf_counter() - started
+            peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+
+        result = {
+            'params': params,
+            'windows': len(month_windows(start_date, end_date)),
+            'setup_seconds': round(setup_seconds, 4),
+            'total_seconds': round(total_seconds, 4),
+            'guides_per_second': round(job.processed_count / total_seconds, 1) if total_seconds else None,
+            'phases': timer.as_dict(),
+            'queries': len(queries),
+            'memo_hits': engine.memo_hits,
+            'peak_memory_bytes': peak_memory,
+            'job': {
+                'processed_count': job.processed_count,
+                'created_count': job.created_count,
+                'updated_count': job.updated_count,
+                'linked_count': job.linked_count,
+                'skipped_count': job.skipped_count,
+                'changed_count': job.changed_count,
+                'new_count': job.new_count,
+                'candidate_lookups': job.candidate_lookups,
+                'candidate_avg': job.candidate_avg,
+                'candidate_max': job.candidate_max,
+            },
+        }
+        transaction.set_rollback(True)
+    # Entity snapshots may now hold rows that were rolled back
+    clear_entity_cache()
+    return result
@@ -0,0 +1,1069 @@
+"""
+Conciliation engine: matches the Coopahub guides of a group against its
+procedures and ProcedimentoFinancas records.
+
+ConciliacaoEngine is the only implementation of the algorithm. Jobs run it
+through `manage.py conciliacao_worker` (see jobs.run_job); the HTTP views only
+enqueue jobs and report their progress. Progress is published to pluggable
+sinks (JobProgressSink, LogProgressSink, or any object with progress() and
+flushed() methods).
+"""
+import itertools
+import logging
+from collections import defaultdict
+from contextlib import nullcontext
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+
+import pytz
+from django.db import transaction
+from django.utils import timezone
+
+from agenda.entities import EntityResolver
+from agenda.models import Convenios, Procedimento, ProcedimentoDetalhes
+from constants import CIRURGIA_AMBULATORIAL_PROCEDIMENTO, CONSULTA_PROCEDIMENTO, STATUS_PENDING
+from dashboard.cache import bump_dashboard_generation
+from registration.models import Anesthesiologist, HospitalClinic, Surgeon
+
+from .guias import guia_fingerprint, parse_api_date, parse_api_time
+from .jobs import PREPASS_CHUNK_GUIDES, FlushScheduler, ProgressThrottle
+from .matching import NameSimilarity, ProcedureMatchIndex, first_similar
+from .models import ConciliacaoTentativa, ProcedimentoFinancas, data_efetiva_for, sync_data_efetiva
+from .rollup import mark_dirty
+from .watermark import get_watermark
+
+
+logger = logging.getLogger(__name__)
+
+# Timezone de São Paulo - usar sempre este para processar horários do Brasil
+SAO_PAULO_TZ = pytz.timezone('America/Sao_Paulo')
+
+def make_aware_sao_paulo(dt):
+    """
+    Torna um datetime naive em datetime aware no fuso de São Paulo.
+    Se já for aware, retorna sem alteração.
+    """
+    if dt is None:
+        return None
+    if timezone.is_naive(dt):
+        return timezone.make_aware(dt, SAO_PAULO_TZ)
+    return dt
+
+DATA_INICIO_PUXAR_GUIAS_API = datetime(2025, 1, 1).date()
+
+def _get_conciliation_start_date(group, force_full=False):
+    """
+    Start of the guide window: a week before the last completed run or the
+    oldest finance record still awaiting payment, whichever is earlier
+    (read from the group's watermark, see financas.watermark).
+    """
+    if force_full:
+        return DATA_INICIO_PUXAR_GUIAS_API
+    watermark = get_watermark(group)
+    buffer_candidates = []
+    if watermark.last_completed_at:
+        buffer_candidates.append((watermark.last_completed_at - timedelta(days=7)).date())
+    if watermark.oldest_pending_date:
+        buffer_candidates.append(watermark.oldest_pending_date - timedelta(days=7))
+
+    if buffer_candidates:
+        return max(DATA_INICIO_PUXAR_GUIAS_API, min(buffer_candidates))
+
+    return DATA_INICIO_PUXAR_GUIAS_API
+
+
+def _api_decimal(value):
+    """Convert API numeric (str/float/int/Decimal) to Decimal safely."""
+    if value is None or value == '':
+        return None
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, ValueError, TypeError):
+        return None
+
+
+def map_api_status(api_status_str):
+    """Maps API status string to internal status choices."""
+    if not api_status_str:
+        return 'em_processamento' # Default if status is missing
+    api_status = str(api_status_str).lower().strip()
+    status_mapping = {
+        'em processamento': 'em_processamento',
+        'aguardando pagamento': 'aguardando_pagamento',
+        'recurso de glosa': 'recurso_de_glosa',
+        'processo finalizado': 'processo_finalizado',
+        'cancelada': 'cancelada',
+        # Add other potential mappings if needed
+    }
+    return status_mapping.get(api_status, 'em_processamento') # Default if unknown status
+
+def find_or_create_anesthesiologist(group, anesthesiologist_name):
+    """Find existing anesthesiologist by similarity in the group or create a new one."""
+    if not anesthesiologist_name or not str(anesthesiologist_name).strip():
+        return None
+
+    name = str(anesthesiologist_name).strip()
+    # Try exact (case-insensitive) match first
+    exact = Anesthesiologist.objects.filter(group=group, name__iexact=name).first()
+    if exact:
+        return exact
+
+    candidates = [candidate for candidate in Anesthesiologist.objects.filter(group=group) if candidate.name]
+    best_index = NameSimilarity([candidate.name for candidate in candidates]).best(name, 0.7)
+    if best_index is not None:
+        return candidates[best_index]
+
+    # Create new when no good match found
+    return Anesthesiologist.objects.create(name=name, group=group)
+
+def find_or_create_surgeon(group, surgeon_name, surgeon_crm=None):
+    """Find existing surgeon or create new one based on name and CRM."""
+    if not surgeon_name or not surgeon_name.strip():
+        return None
+    
+    surgeon_name = surgeon_name.strip()
+    surgeon_crm = surgeon_crm.strip() if surgeon_crm else None
+    
+    # Try to find existing surgeon by CRM first (if provided)
+    if surgeon_crm:
+        surgeon = Surgeon.objects.filter(group=group, crm=surgeon_crm).first()
+        if surgeon:
+            return surgeon
+    
+    # Try to find by name similarity
+    surgeons_in_group = [surgeon for surgeon in Surgeon.objects.filter(group=group) if surgeon.name]
+    best_index = NameSimilarity([surgeon.name for surgeon in surgeons_in_group]).best(surgeon_name, 0.7)
+    
+    if best_index is not None:
+        return surgeons_in_group[best_index]
+    
+    # Create new surgeon
+    new_surgeon = Surgeon.objects.create(
+        name=surgeon_name,
+        crm=surgeon_crm,
+        group=group
+    )
+    return new_surgeon
+
+
+def update_procedimento_with_api_data_cached(procedimento, guia, group, hospital_cache, convenio_cache, 
+                                             surgeon_cache, anesthesiologist_cache, proc_detalhes_cache, 
+                                             save_immediately=True):
+    """
+    Copy the guide's schedule, patient and entity data onto procedimento,
+    resolving hospitals, surgeons, cooperados and procedure details through
+    the entity caches. Returns (updated, procedimento).
+    """
+    updated = False
+    
+    # Times and Dates
+    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
+    guia_hora_final = parse_api_time(guia.get('hora_final'))
+    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
+    
+    if guia_date and guia_hora_inicial:
+        new_data_horario = datetime.combine(guia_date, guia_hora_inicial)
+        new_data_horario = make_aware_sao_paulo(new_data_horario)
+        current_time = procedimento.data_horario.time() if procedimento.data_horario else None
+        if not current_time or current_time == time(0, 0) or current_time != guia_hora_inicial:
+            procedimento.data_horario = new_data_horario
+            updated = True
+    
+    if guia_date and guia_hora_final and guia_hora_final != guia_hora_inicial:
+        new_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
+        new_data_horario_fim = make_aware_sao_paulo(new_data_horario_fim)
+        if not procedimento.data_horario_fim or procedimento.data_horario_fim != new_data_horario_fim:
+            procedimento.data_horario_fim = new_data_horario_fim
+            updated = True
+
+    # CPF
+    api_cpf = guia.get('cpf') or guia.get('nr_cpf')
+    if api_cpf and not procedimento.cpf_paciente:
+        procedimento.cpf_paciente = api_cpf
+        updated = True
+
+    # Birth Date
+    api_nascimento = parse_api_date(guia.get('data_nascimento'))
+    if api_nascimento and not procedimento.data_nascimento:
+        procedimento.data_nascimento = api_nascimento
+        updated = True
+
+    # Accommodation
+    api_acomodacao = guia.get('tip_acomod')
+    if api_acomodacao and not procedimento.acomodacao:
+        procedimento.acomodacao = api_acomodacao
+        updated = True
+    
+    # Surgeon (Cached)
+    api_surgeon_name = guia.get('cirurgiao')
+    if api_surgeon_name and api_surgeon_name.strip():
+        name_key = api_surgeon_name.strip().lower()
+        surgeon_obj = None
+        if name_key in surgeon_cache:
+            surgeon_obj = surgeon_cache[name_key]
+        else:
+            # Fallback to create (already handles duplicate by crm/name inside)
+            surgeon_obj = find_or_create_surgeon(group, api_surgeon_name, guia.get('crm_cirurgiao'))
+            surgeon_cache[name_key] = surgeon_obj
+        
+        if surgeon_obj and procedimento.cirurgiao_id != surgeon_obj.id:
+            procedimento.cirurgiao = surgeon_obj
+            updated = True
+    
+    # Hospital (Cached)
+    api_hospital_name = guia.get('hospital')
+    if api_hospital_name and api_hospital_name.strip():
+        name_key = api_hospital_name.strip().lower()
+        hospital_obj = None
+        if name_key in hospital_cache:
+            hospital_obj = hospital_cache[name_key]
+        else:
+            hospital_obj, _ = HospitalClinic.objects.get_or_create(
+                name__iexact=api_hospital_name.strip(),
+                defaults={'name': api_hospital_name.strip(), 'group': group}
+            )
+            hospital_cache[name_key] = hospital_obj
+        
+        if hospital_obj and procedimento.hospital_id != hospital_obj.id:
+            procedimento.hospital = hospital_obj
+            updated = True
+
+    # Cooperado (Cached)
+    api_cooperado_name = guia.get('cooperado')
+    if api_cooperado_name:
+        name_key = api_cooperado_name.strip().lower()
+        anest_obj = None
+        if name_key in anesthesiologist_cache:
+            anest_obj = anesthesiologist_cache[name_key]
+        else:
+            anest_obj = find_or_create_anesthesiologist(group, api_cooperado_name)
+            anesthesiologist_cache[name_key] = anest_obj
+            
+        if anest_obj and procedimento.cooperado_id != anest_obj.id:
+            procedimento.cooperado = anest_obj
+            updated = True
+
+    # Procedure Detail (Cached)
+    api_procedimentos = guia.get('procedimentos')
+    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
+        principal = api_procedimentos[0]
+        api_codigo = principal.get('codigo')
+        api_descricao = principal.get('descricao')
+        if api_codigo and api_descricao:
+            detalhe = None
+            if api_codigo in proc_detalhes_cache:
+                detalhe = proc_detalhes_cache[api_codigo]
+            else:
+                detalhe, _ = ProcedimentoDetalhes.objects.get_or_create(
+                    codigo_procedimento=api_codigo,
+                    defaults={'name': api_descricao}
+                )
+                proc_detalhes_cache[api_codigo] = detalhe
+            
+            if detalhe and procedimento.procedimento_principal_id != detalhe.id:
+                procedimento.procedimento_principal = detalhe
+                procedimento.procedimento_type = CONSULTA_PROCEDIMENTO if api_codigo == '10101012' else CIRURGIA_AMBULATORIAL_PROCEDIMENTO
+                updated = True
+    
+    if updated and save_immediately:
+        procedimento.save()
+    
+    return (updated, procedimento)
+
+def find_comprehensive_procedure_match(candidate_procs, guia, group, anesthesiologist_names=None):
+    """
+    Find existing Procedimento that matches all key fields from the guide.
+    This prevents creating duplicate procedures for the same surgery with multiple financial charges.
+    candidate_procs should come from ProcedureMatchIndex.candidates() so only
+    procedures within ±1 day sharing a patient-name key are scored.
+    anesthesiologist_names maps procedure id -> lowercased anestesistas_responsaveis
+    names (ProcedureMatchIndex.anesthesiologist_names); no queries are made here.
+    """
+    anesthesiologist_names = anesthesiologist_names or {}
+    guia_paciente = guia.get('paciente')
+    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
+    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
+    guia_cooperado = guia.get('cooperado')
+    guia_hospital = guia.get('hospital')
+    
+    if not guia_paciente or not guia_date:
+        return None
+    
+    best_match_proc = None
+    highest_score = 0.0
+
+    # Name similarities for all candidates at once (see matching.NameSimilarity)
+    candidate_procs = list(candidate_procs)
+    name_scores = NameSimilarity([proc.nome_paciente for proc in candidate_procs]).scores(guia_paciente, 0.8)
+    if guia_hospital:
+        hospital_scores = NameSimilarity(
+            [proc.hospital.name if proc.hospital else '' for proc in candidate_procs]
+        ).scores(guia_hospital, 0.7)
+    anest_matched = set()
+    if guia_cooperado:
+        anest_owners = [i for i, proc in enumerate(candidate_procs) for _ in anesthesiologist_names.get(proc.pk, ())]
+        if anest_owners:
+            anest_scores = NameSimilarity(
+                [name for proc in candidate_procs for name in anesthesiologist_names.get(proc.pk, ())]
+            ).scores(guia_cooperado, 0.8)
+            anest_matched = {owner for owner, sim in zip(anest_owners, anest_scores) if sim > 0.8}
+    
+    for i, proc in enumerate(candidate_procs):
+        score = 0.0
+        total_factors = 0
+        
+        # 1. Patient name similarity (most important) - CASE INSENSITIVE
+        if proc.nome_paciente:
+            name_sim = float(name_scores[i])
+            if name_sim < 0.8:  # Skip if name similarity is too low
+                continue
+            score += name_sim * 0.4  # 40% weight
+            total_factors += 0.4
+        
+        # 2. Date match (essential)
+        proc_date = proc.data_horario.date() if proc.data_horario else None
+        if proc_date:
+            date_diff = abs((guia_date - proc_date).days)
+            if date_diff > 1:  # Skip if date difference is more than 1 day
+                continue
+            date_score = 1.0 if date_diff == 0 else 0.7  # Exact date match gets full score
+            score += date_score * 0.25  # 25% weight
+            total_factors += 0.25
+        
+        # 3. Time match (if available)
+        if guia_hora_inicial and proc.data_horario:
+            # Convert procedure's UTC time to local time for comparison
+            proc_local_time = timezone.localtime(proc.data_horario).time()
+            if proc_local_time != time(0, 0):  # Only compare if procedure has a real time (not midnight default)
+                time_diff_minutes = abs(
+                    (guia_hora_inicial.hour * 60 + guia_hora_inicial.minute) - 
+                    (proc_local_time.hour * 60 + proc_local_time.minute)
+                )
+                if time_diff_minutes <= 30:  # Within 30 minutes
+                    time_score = 1.0 if time_diff_minutes == 0 else 0.8
+                    score += time_score * 0.15  # 15% weight
+                    total_factors += 0.15
+                elif time_diff_minutes > 240:  # More than 4 hours difference
+                    continue  # Skip this procedure
+        
+        # 4. Hospital match (if available) - CASE INSENSITIVE
+        if guia_hospital and proc.hospital:
+            hospital_sim = float(hospital_scores[i])
+            if hospital_sim > 0.7:
+                score += hospital_sim * 0.1  # 10% weight
+                total_factors += 0.1
+        
+        # 5. Anesthesiologist match (if available) - CASE INSENSITIVE
+        if i in anest_matched:
+            score += 0.1  # 10% weight
+            total_factors += 0.1
+        
+        # Calculate final score as percentage
+        if total_factors > 0:
+            final_score = score / total_factors
+            
+            # Require minimum combined score for match
+            if final_score > 0.85 and final_score > highest_score:
+                highest_score = final_score
+                best_match_proc = proc
+    
+    return best_match_proc
+
+
+def prepare_procedimento_from_guia(guia, cpsa_id, group, hospital_cache, convenio_cache,
+                                    surgeon_cache, anesthesiologist_cache, proc_detalhes_cache):
+    """
+    Prepare a Procedimento object WITHOUT saving to database.
+    Returns the unsaved object for bulk_create.
+    """
+    guia_paciente = guia.get('paciente')
+    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
+    
+    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
+    guia_hora_final = parse_api_time(guia.get('hora_final'))
+    
+    proc_data_horario = None
+    proc_data_horario_fim = None
+    
+    if guia_date:
+        start_time = guia_hora_inicial if guia_hora_inicial else time(8, 0)
+        proc_data_horario = datetime.combine(guia_date, start_time)
+        proc_data_horario = make_aware_sao_paulo(proc_data_horario)
+        
+        if guia_hora_final:
+            proc_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
+            proc_data_horario_fim = make_aware_sao_paulo(proc_data_horario_fim)
+        else:
+            proc_data_horario_fim = proc_data_horario + timedelta(hours=2)
+    
+    # Use cache for hospital
+    hospital_obj = None
+    api_hospital_name = guia.get('hospital')
+    if api_hospital_name and api_hospital_name.strip():
+        cache_key = api_hospital_name.strip().lower()
+        if cache_key in hospital_cache:
+            hospital_obj = hospital_cache[cache_key]
+        else:
+            hospital_obj, _ = HospitalClinic.objects.get_or_create(
+                name__iexact=api_hospital_name.strip(),
+                defaults={'name': api_hospital_name.strip(), 'group': group}
+            )
+            hospital_cache[cache_key] = hospital_obj
+    
+    # Use cache for convenio
+    convenio_obj = None
+    api_convenio_name = guia.get('convenio')
+    if api_convenio_name and api_convenio_name.strip():
+        cache_key = api_convenio_name.strip().lower()
+        if cache_key in convenio_cache:
+            convenio_obj = convenio_cache[cache_key]
+        else:
+            convenio_obj, _ = Convenios.objects.get_or_create(
+                name__iexact=api_convenio_name.strip(),
+                defaults={'name': api_convenio_name.strip()}
+            )
+            convenio_cache[cache_key] = convenio_obj
+    
+    # Use cache for surgeon
+    surgeon_obj = None
+    api_surgeon_name = guia.get('cirurgiao')
+    if api_surgeon_name and api_surgeon_name.strip():
+        cache_key = api_surgeon_name.strip().lower()
+        if cache_key in surgeon_cache:
+            surgeon_obj = surgeon_cache[cache_key]
+        else:
+            surgeon_obj = first_similar(cache_key, surgeon_cache, 0.85)
+            if not surgeon_obj:
+                surgeon_obj = Surgeon.objects.create(
+                    name=api_surgeon_name.strip(),
+                    crm=guia.get('crm_cirurgiao'),
+                    group=group
+                )
+                surgeon_cache[cache_key] = surgeon_obj
+
+    paciente_nome_para_proc = guia_paciente or f"Paciente CPSA {cpsa_id}"
+
+    # Use cache for procedimento principal
+    procedimento_principal_obj = None
+    proc_type = CIRURGIA_AMBULATORIAL_PROCEDIMENTO
+    api_procedimentos = guia.get('procedimentos')
+    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
+        principal_proc_data = api_procedimentos[0]
+        api_codigo = principal_proc_data.get('codigo')
+        api_descricao = principal_proc_data.get('descricao')
+        if api_codigo and api_descricao:
+            if api_codigo in proc_detalhes_cache:
+                procedimento_principal_obj = proc_detalhes_cache[api_codigo]
+            else:
+                procedimento_principal_obj, _ = ProcedimentoDetalhes.objects.get_or_create(
+                    codigo_procedimento=api_codigo,
+                    defaults={'name': api_descricao}
+                )
+                proc_detalhes_cache[api_codigo] = procedimento_principal_obj
+            
+            if procedimento_principal_obj.codigo_procedimento == '10101012':
+                proc_type = CONSULTA_PROCEDIMENTO
+
+    # Resolve cooperado using cache
+    cooperado_obj = None
+    guia_cooperado = guia.get('cooperado')
+    if guia_cooperado:
+        cache_key = guia_cooperado.strip().lower()
+        if cache_key in anesthesiologist_cache:
+            cooperado_obj = anesthesiologist_cache[cache_key]
+        else:
+            cooperado_obj = first_similar(cache_key, anesthesiologist_cache, 0.85)
+            if not cooperado_obj:
+                cooperado_obj = Anesthesiologist.objects.create(name=guia_cooperado.strip(), group=group)
+                anesthesiologist_cache[cache_key] = cooperado_obj
+
+    # Return unsaved Procedimento object (for bulk_create)
+    return Procedimento(
+        group=group,
+        nome_paciente=paciente_nome_para_proc,
+        cpf_paciente=guia.get('cpf') or guia.get('nr_cpf'),
+        data_nascimento=parse_api_date(guia.get('data_nascimento')),
+        acomodacao=guia.get('tip_acomod'),
+        data_horario=proc_data_horario,
+        data_horario_fim=proc_data_horario_fim,
+        hospital=hospital_obj,
+        convenio=convenio_obj,
+        cirurgiao=surgeon_obj,
+        cooperado=cooperado_obj,
+        procedimento_principal=procedimento_principal_obj,
+        procedimento_type=proc_type,
+        status=STATUS_PENDING
+    )
+
+
+class JobProgressSink:
+    """
+    Mirrors the engine counters onto a ConciliacaoJob. Counters a job keeps
+    across attempts (created, updated, ...) are added to the values it had when
+    the sink was built; processed_count restarts with every run.
+    """
+    CUMULATIVE_FIELDS = (
+        'created_count', 'updated_count', 'linked_count',
+        'skipped_count', 'changed_count', 'new_count',
+    )
+    PROGRESS_FIELDS = [
+        'processed_count', 'current_step',
+        'candidate_lookups', 'candidate_total', 'candidate_max',
+        'skipped_count', 'changed_count', 'new_count',
+    ]
+    COUNTER_FIELDS = PROGRESS_FIELDS + ['created_count', 'updated_count', 'linked_count']
+
+    def __init__(self, job):
+        self.job = job
+        self._base = {field: getattr(job, field) for field in self.CUMULATIVE_FIELDS}
+
+    def _copy_counters(self, engine):
+        job = self.job
+        for field in self.CUMULATIVE_FIELDS:
+            setattr(job, field, self._base[field] + getattr(engine, field))
+        job.processed_count = engine.processed_count
+        job.current_step = f'Processando guia {engine.processed_count} de {job.total_guias}...'
+        engine.match_index.record_stats(job)
+
+    def progress(self, engine):
+        self._copy_counters(engine)
+        self.job.save(update_fields=self.PROGRESS_FIELDS)
+
+    def flushed(self, engine):
+        self._copy_counters(engine)
+        self.job.save(update_fields=self.COUNTER_FIELDS)
+
+
+class LogProgressSink:
+    """Logs a line per flush (worker logs)."""
+
+    def __init__(self, label):
+        self.label = label
+
+    def progress(self, engine):
+        pass
+
+    def flushed(self, engine):
+        logger.info(
+            "[CONCILIACAO] %s: %d guias processadas, %d criadas, %d atualizadas, %d vinculadas, %d inalteradas.",
+            self.label, engine.processed_count, engine.created_count, engine.updated_count,
+            engine.linked_count, engine.skipped_count,
+        )
+
+
+class ConciliacaoEngine:
+    """
+    Conciliation of a stream of (cpsa_id, guia) pairs for one group.
+
+    guias_items may be a generator (see guias.iter_guias): guides are consumed
+    as they arrive. Only (fingerprint, linked, status) per CPSA is read up front;
+    finance objects, procedures and entity caches are loaded once a guide needs
+    them. Linked records whose guide fingerprint is unchanged, and finalized
+    records, are skipped. Unlinked records are matched again only when their
+    guide or one of their candidate procedures changed since the last failed
+    attempt (ConciliacaoTentativa).
+
+    Guides are read PREPASS_CHUNK_GUIDES at a time: a first pass bulk-creates the
+    hospitals, convênios, surgeons, cooperados and procedure details the chunk's
+    new guides reference (EntityResolver.ensure_*), so the second pass only finds
+    them in the caches.
+
+    Buffered writes are flushed by a jobs.FlushScheduler (row count or elapsed
+    time), each flush in one transaction together with the sinks' flushed()
+    calls and the checkpoint (jobs.ConciliacaoCheckpoint), if any; guides
+    committed by a previous attempt are skipped. Sinks' progress() runs on a
+    jobs.ProgressThrottle between flushes.
+
+    phase_timer (see financas.benchmark.PhaseTimer) times the load, entities,
+    match and flush phases when given.
+    """
+    FINANCAS_UPDATE_FIELDS = [
+        'valor_faturado', 'valor_recebido', 'valor_recuperado', 'valor_acatado',
+        'status_pagamento', 'api_paciente_nome', 'api_hospital_nome', 'api_cooperado_nome',
+        'matricula', 'senha', 'api_data_cirurgia', 'plantao_eletiva', 'procedimento', 'api_fingerprint',
+        'data_efetiva'
+    ]
+    PROCEDIMENTO_UPDATE_FIELDS = [
+        'data_horario', 'data_horario_fim', 'cpf_paciente', 'data_nascimento',
+        'acomodacao', 'cirurgiao', 'hospital', 'cooperado', 'procedimento_principal', 'procedimento_type',
+        'atualizado_em'
+    ]
+    TENTATIVA_UPDATE_FIELDS = ['conciliado', 'data_tentativa', 'guia_fingerprint', 'candidatos']
+
+    def __init__(self, group, start_date=None, checkpoint=None, sinks=(), phase_timer=None):
+        self.group = group
+        self.cutoff_date = start_date or DATA_INICIO_PUXAR_GUIAS_API
+        self.checkpoint = checkpoint
+        self.sinks = list(sinks)
+        self.phase_timer = phase_timer
+
+        self.processed_count = 0
+        self.created_count = 0
+        self.updated_count = 0
+        self.linked_count = 0
+        self.skipped_count = 0
+        self.changed_count = 0
+        self.new_count = 0
+        self.memo_hits = 0
+        self.processed_cpsa_ids = set()
+
+        self.financas_qs = ProcedimentoFinancas.objects.filter(group=group)
+        self.financas_state_by_cpsa = {}
+        self.financas_by_cpsa = {}
+        self.proc_lookup_dict = defaultdict(list)
+        self.match_index = ProcedureMatchIndex()
+        self.entity_resolver = EntityResolver(group)
+        self._matching_loaded = False
+        self.tentativas = None
+
+        self.financas_to_update = []
+        self.financas_to_create = []
+        self.procedimentos_to_update = {}
+        # Updated procedures whose local date moved (their finance rows' data_efetiva follows)
+        self.procedimentos_redated = {}
+        self.procedimentos_to_create = []
+        # {id(unsaved procedure): its index in procedimentos_to_create}
+        self.pending_proc_indexes = {}
+        self.financas_pending_proc = []
+        self.tentativas_to_create = []
+        self.tentativas_to_update = []
+        self.flush_scheduler = FlushScheduler()
+        self.progress_throttle = ProgressThrottle()
+
+    def phase(self, name):
+        return self.phase_timer.phase(name) if self.phase_timer is not None else nullcontext()
+
+    # Loading
+
+    def load_financas_state(self):
+        self.financas_state_by_cpsa = {
+            cpsa: (fingerprint, procedimento_id is not None, status)
+            for cpsa, fingerprint, procedimento_id, status in self.financas_qs.values_list(
+                'cpsa', 'api_fingerprint', 'procedimento_id', 'status_pagamento'
+            )
+            if cpsa
+        }
+
+    def load_financas(self):
+        if not self.financas_by_cpsa:
+            self.financas_by_cpsa.update(
+                (f.cpsa, f) for f in self.financas_qs.select_related('procedimento') if f.cpsa
+            )
+
+    def load_matching_state(self):
+        if self._matching_loaded:
+            return
+        self._matching_loaded = True
+        with self.phase('load'):
+            all_procs_qs = Procedimento.objects.filter(
+                group=self.group,
+                data_horario__date__gte=self.cutoff_date
+            ).select_related('hospital', 'convenio').prefetch_related('financas_records')
+            for proc in all_procs_qs:
+                self.add_to_lookup(proc)
+                self.match_index.add(proc)
+            self.match_index.load_anesthesiologist_names(all_procs_qs)
+
+    def add_to_lookup(self, proc):
+        if proc.nome_paciente and proc.data_horario:
+            key = (proc.nome_paciente.strip().lower(), proc.data_horario.date())
+            self.proc_lookup_dict[key].append(proc)
+
+    def load_tentativas(self):
+        """Last match attempt of every unlinked record, by ProcedimentoFinancas id."""
+        if self.tentativas is None:
+            self.tentativas = {
+                tentativa.procedimento_financas_id: tentativa
+                for tentativa in ConciliacaoTentativa.objects.filter(
+                    procedimento_financas__in=self.financas_qs.filter(procedimento__isnull=True)
+                ).order_by('data_tentativa')
+            }
+        return self.tentativas
+
+    def entity_caches(self):
+        """Caches in the argument order of the update/prepare helpers."""
+        resolver = self.entity_resolver
+        return (
+            resolver.hospitals, resolver.convenios, resolver.surgeons,
+            resolver.anesthesiologists, resolver.procedimento_detalhes,
+        )
+
+    # Writes
+
+    def pending_rows(self):
+        return (
+            len(self.procedimentos_to_create) + len(self.procedimentos_to_update)
+            + len(self.financas_to_update) + len(self.financas_to_create)
+            + len(self.tentativas_to_create) + len(self.tentativas_to_update)
+        )
+
+    def report_progress(self):
+        for sink in self.sinks:
+            sink.progress(self)
+        self.progress_throttle.saved()
+
+    def flush(self):
+        """
+        Write every pending buffer, the sinks' counters and the checkpoint in
+        one transaction, so a committed checkpoint always matches committed rows.
+        """
+        # (group_id, data_efetiva) of every finance row written, before and
+        # after, for the monthly rollup (bulk writes send no signals)
+        rollup_marks = set()
+        with self.phase('flush'), transaction.atomic():
+            if self.procedimentos_to_create:
+                created_procs = Procedimento.objects.bulk_create(self.procedimentos_to_create)
+                # Immediately create financas records for these procedures
+                pending_financas = []
+                for financa_data, proc_idx in self.financas_pending_proc:
+                    financa_data['procedimento'] = created_procs[proc_idx]
+                    financa = ProcedimentoFinancas(**financa_data)
+                    financa.data_efetiva = financa.compute_data_efetiva()
+                    pending_financas.append(financa)
+                if pending_financas:
+                    ProcedimentoFinancas.objects.bulk_create(pending_financas)
+                    rollup_marks.update((f.group_id, f.data_efetiva) for f in pending_financas)
+                # Already in proc_lookup_dict since add_new; saved, they can now be
+                # candidates for unlinked records too
+                for proc in created_procs:
+                    self.match_index.add(proc)
+                self.created_count += len(self.procedimentos_to_create)
+            if self.procedimentos_to_update:
+                rollup_marks.update(
+                    ProcedimentoFinancas.objects
+                    .filter(procedimento_id__in=list(self.procedimentos_to_update))
+                    .values_list('group_id', 'data_efetiva').distinct()
+                )
+                Procedimento.objects.bulk_update(
+                    list(self.procedimentos_to_update.values()), self.PROCEDIMENTO_UPDATE_FIELDS
+                )
+            if self.procedimentos_redated:
+                sync_data_efetiva(self.procedimentos_redated.values())
+                rollup_marks.update(
+                    (self.group.pk, data_efetiva_for(proc, None)) for proc in self.procedimentos_redated.values()
+                )
+            # bulk writes skip ProcedimentoFinancas.save(), which derives data_efetiva
+            for financa in self.financas_to_update + self.financas_to_create:
+                financa.data_efetiva = financa.compute_data_efetiva()
+                loaded = getattr(financa, '_loaded_rollup_key', None)
+                if loaded:
+                    rollup_marks.add(loaded)
+                financa._loaded_rollup_key = (financa.group_id, financa.data_efetiva)
+                rollup_marks.add(financa._loaded_rollup_key)
+            if self.financas_to_update:
+                ProcedimentoFinancas.objects.bulk_update(self.financas_to_update, self.FINANCAS_UPDATE_FIELDS)
+                self.updated_count += len(self.financas_to_update)
+            if self.financas_to_create:
+                ProcedimentoFinancas.objects.bulk_create(self.financas_to_create)
+            if self.tentativas_to_create:
+                ConciliacaoTentativa.objects.bulk_create(self.tentativas_to_create)
+            if self.tentativas_to_update:
+                ConciliacaoTentativa.objects.bulk_update(self.tentativas_to_update, self.TENTATIVA_UPDATE_FIELDS)
+            mark_dirty(rollup_marks)
+            if rollup_marks or self.procedimentos_to_create or self.procedimentos_to_update:
+                bump_dashboard_generation(self.group.pk)
+            for sink in self.sinks:
+                sink.flushed(self)
+            if self.checkpoint is not None:
+                self.checkpoint.commit()
+        self.procedimentos_to_create.clear()
+        self.pending_proc_indexes.clear()
+        self.financas_pending_proc.clear()
+        self.procedimentos_to_update.clear()
+        self.procedimentos_redated.clear()
+        self.financas_to_update.clear()
+        self.financas_to_create.clear()
+        self.tentativas_to_create.clear()
+        self.tentativas_to_update.clear()
+        self.flush_scheduler.flushed()
+        self.progress_throttle.saved()
+
+    # First pass
+
+    def ensure_entities(self, new_guias, updating_guias=()):
+        """
+        Resolve or bulk-create the entities referenced by guides about to build
+        procedures (new_guias) or update linked ones (updating_guias). The
+        surgeons and cooperados of updating guides are matched like
+        find_or_create_surgeon/find_or_create_anesthesiologist, as the update
+        path did one guide at a time.
+        """
+        def surgeons_of(guias):
+            surgeons = {}
+            for guia in guias:
+                surgeon_name = (guia.get('cirurgiao') or '').strip()
+                if surgeon_name:
+                    surgeons.setdefault(surgeon_name, guia.get('crm_cirurgiao'))
+            return surgeons
+
+        def cooperados_of(guias):
+            return dict.fromkeys(guia['cooperado'].strip() for guia in guias if (guia.get('cooperado') or '').strip())
+
+        codes = {}
+        for guia in itertools.chain(new_guias, updating_guias):
+            api_procedimentos = guia.get('procedimentos')
+            if api_procedimentos and isinstance(api_procedimentos, list):
+                principal = api_procedimentos[0]
+                if principal.get('codigo') and principal.get('descricao'):
+                    codes.setdefault(principal['codigo'], principal['descricao'])
+        resolver = self.entity_resolver
+        with self.phase('entities'):
+            resolver.ensure_hospitals(guia.get('hospital') for guia in itertools.chain(new_guias, updating_guias))
+            resolver.ensure_convenios(guia.get('convenio') for guia in new_guias)
+            resolver.resolve_surgeons(surgeons_of(updating_guias))
+            resolver.resolve_anesthesiologists(cooperados_of(updating_guias))
+            resolver.ensure_surgeons(surgeons_of(new_guias))
+            resolver.ensure_anesthesiologists(cooperados_of(new_guias))
+            resolver.ensure_procedimento_detalhes(codes)
+
+    def prepared_items(self, guias_items):
+        """
+        Yield (cpsa_id, guia, resumed) a chunk at a time, after ensure_entities
+        ran for the chunk. Only the guides that always end up building or
+        updating a procedure are collected: new CPSAs with patient and date, and
+        changed guides of linked records. The checkpoint decides resumed guides
+        as they are read, while their window is current.
+        """
+        chunk = []
+
+        def writes_procedure(cpsa_id, guia):
+            """'new', 'update' or None: how the guide will write a procedure."""
+            state = self.financas_state_by_cpsa.get(cpsa_id)
+            if state is None:
+                if guia.get('paciente') and parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa'))):
+                    return 'new'
+                return None
+            stored_fingerprint, linked, status_pagamento = state
+            if linked and status_pagamento != 'processo_finalizado' and stored_fingerprint != guia_fingerprint(guia):
+                return 'update'
+            return None
+
+        def release():
+            guias_by_write = {'new': [], 'update': []}
+            for cpsa_id, guia, resumed in chunk:
+                write = None if resumed else writes_procedure(cpsa_id, guia)
+                if write:
+                    guias_by_write[write].append(guia)
+            if guias_by_write['new'] or guias_by_write['update']:
+                self.ensure_entities(guias_by_write['new'], guias_by_write['update'])
+            items = list(chunk)
+            chunk.clear()
+            return items
+
+        for cpsa_id, guia in guias_items:
+            resumed = self.checkpoint is not None and self.checkpoint.should_skip(cpsa_id)
+            chunk.append((cpsa_id, guia, resumed))
+            if len(chunk) >= PREPASS_CHUNK_GUIDES:
+                yield from release()
+        yield from release()
+
+    # Second pass
+
+    def run(self, guias_items):
+        self.load_financas_state()
+        if any(not linked for _, linked, _ in self.financas_state_by_cpsa.values()):
+            self.load_matching_state()
+
+        for cpsa_id, guia, resumed in self.prepared_items(guias_items):
+            # Every previous guide is fully buffered here, so a flush (and the
+            # checkpoint it commits) never splits a guide's writes.
+            if self.flush_scheduler.due(self.pending_rows()):
+                self.flush()
+            elif self.progress_throttle.due():
+                self.report_progress()
+
+            self.processed_cpsa_ids.add(cpsa_id)
+            self.processed_count += 1
+
+            if resumed:
+                continue
+            if self.checkpoint is not None:
+                self.checkpoint.mark_processed(cpsa_id)
+
+            if cpsa_id in self.financas_state_by_cpsa:
+                self.update_existing(cpsa_id, guia)
+            else:
+                self.add_new(cpsa_id, guia)
+
+        self.flush()
+        return self
+
+    def update_existing(self, cpsa_id, guia):
+        fingerprint = guia_fingerprint(guia)
+        stored_fingerprint, linked, status_pagamento = self.financas_state_by_cpsa[cpsa_id]
+
+        # Skip records that are already finalized - no need to update them.
+        # Linked records whose guide content is unchanged are skipped too.
+        if status_pagamento == 'processo_finalizado' or (linked and stored_fingerprint == fingerprint):
+            self.skipped_count += 1
+            return
+
+        self.load_financas()
+        financa = self.financas_by_cpsa[cpsa_id]
+        # Unlinked records are retried even when their guide is unchanged
+        if stored_fingerprint != fingerprint:
+            self.changed_count += 1
+
+        updated = financa.api_fingerprint != fingerprint
+        financa.api_fingerprint = fingerprint
+        guia_valor_faturado = _api_decimal(guia.get('valor_faturado'))
+        guia_valor_recebido = _api_decimal(guia.get('valor_recebido'))
+        guia_valor_recuperado = _api_decimal(guia.get('valor_receuperado', guia.get('valor_recuperado')))
+        guia_valor_acatado = _api_decimal(guia.get('valor_acatado'))
+
+        if guia_valor_faturado is not None and financa.valor_faturado != guia_valor_faturado:
+            financa.valor_faturado = guia_valor_faturado; updated = True
+        if guia_valor_recebido is not None and financa.valor_recebido != guia_valor_recebido:
+            financa.valor_recebido = guia_valor_recebido; updated = True
+        if guia_valor_recuperado is not None and financa.valor_recuperado != guia_valor_recuperado:
+            financa.valor_recuperado = guia_valor_recuperado; updated = True
+        if guia_valor_acatado is not None and financa.valor_acatado != guia_valor_acatado:
+            financa.valor_acatado = guia_valor_acatado; updated = True
+
+        api_status = map_api_status(guia.get('STATUS'))
+        if financa.status_pagamento != api_status:
+            financa.status_pagamento = api_status; updated = True
+        if financa.api_paciente_nome != guia.get('paciente'):
+            financa.api_paciente_nome = guia.get('paciente'); updated = True
+        if financa.api_hospital_nome != guia.get('hospital'):
+            financa.api_hospital_nome = guia.get('hospital'); updated = True
+        if financa.api_cooperado_nome != guia.get('cooperado'):
+            financa.api_cooperado_nome = guia.get('cooperado'); updated = True
+        if financa.matricula != guia.get('matricula'):
+            financa.matricula = guia.get('matricula'); updated = True
+        if financa.senha != guia.get('senha'):
+            financa.senha = guia.get('senha'); updated = True
+        guia_api_date_parsed = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
+        if financa.api_data_cirurgia != guia_api_date_parsed:
+            financa.api_data_cirurgia = guia_api_date_parsed; updated = True
+        if financa.plantao_eletiva != guia.get('classificacao'):
+            financa.plantao_eletiva = guia.get('classificacao'); updated = True
+        if updated:
+            if financa not in self.financas_to_update: self.financas_to_update.append(financa)
+
+        if financa.procedimento:
+            # The guide changed: bring the linked procedure up to date too
+            self.update_procedimento(financa.procedimento, guia)
+        else:
+            self.load_matching_state()
+            with self.phase('match'):
+                best_match_proc = self.match_unlinked(financa, cpsa_id, guia, guia_api_date_parsed, fingerprint)
+            if best_match_proc:
+                self.update_procedimento(best_match_proc, guia)
+                financa.procedimento = best_match_proc
+                self.linked_count += 1
+                if financa not in self.financas_to_update: self.financas_to_update.append(financa)
+
+    def match_unlinked(self, financa, cpsa_id, guia, guia_date, fingerprint):
+        """
+        find_comprehensive_procedure_match for an unlinked record, skipped when
+        the last attempt failed for the same guide and the same candidates,
+        each with the same atualizado_em. The outcome is recorded either way.
+        """
+        candidates = self.match_index.candidates(guia.get('paciente'), guia_date)
+        stamps = {
+            str(proc.pk): proc.atualizado_em.isoformat() if proc.atualizado_em else None
+            for proc in candidates
+        }
+        tentativa = self.load_tentativas().get(financa.pk)
+        if (
+            tentativa is not None and tentativa.conciliado is False
+            and tentativa.guia_fingerprint == fingerprint and tentativa.candidatos == stamps
+        ):
+            self.memo_hits += 1
+            return None
+
+        best_match_proc = find_comprehensive_procedure_match(
+            candidates, guia, self.group, self.match_index.anesthesiologist_names
+        )
+        if tentativa is None:
+            tentativa = ConciliacaoTentativa(procedimento_financas=financa, cpsa_id=cpsa_id)
+            self.tentativas[financa.pk] = tentativa
+            self.tentativas_to_create.append(tentativa)
+        elif tentativa not in self.tentativas_to_update:
+            tentativa.data_tentativa = timezone.now()
+            self.tentativas_to_update.append(tentativa)
+        tentativa.conciliado = best_match_proc is not None
+        tentativa.guia_fingerprint = fingerprint
+        tentativa.candidatos = stamps
+        return best_match_proc
+
+    def update_procedimento(self, procedimento, guia):
+        data_efetiva = data_efetiva_for(procedimento, None)
+        was_updated, updated_proc = update_procedimento_with_api_data_cached(
+            procedimento, guia, self.group, *self.entity_caches(), save_immediately=False
+        )
+        if was_updated:
+            # bulk_update does not apply auto_now
+            updated_proc.atualizado_em = timezone.now()
+            self.procedimentos_to_update[updated_proc.id] = updated_proc
+            if data_efetiva_for(updated_proc, None) != data_efetiva:
+                self.procedimentos_redated[updated_proc.id] = updated_proc
+
+    def find_new_guia_match(self, guia_paciente, guia_date):
+        """Procedure of the same patient within ±1 day, by name similarity above 0.85."""
+        lookup_key = (guia_paciente.strip().lower(), guia_date)
+        candidate_procs = self.proc_lookup_dict.get(lookup_key, [])
+        if not candidate_procs:
+            next_day = guia_date + timedelta(days=1)
+            prev_day = guia_date - timedelta(days=1)
+            candidate_procs = (
+                self.proc_lookup_dict.get((guia_paciente.strip().lower(), next_day), []) +
+                self.proc_lookup_dict.get((guia_paciente.strip().lower(), prev_day), [])
+            )
+
+        best_match_proc = None
+        highest_similarity = 0.7
+        name_scores = NameSimilarity([proc.nome_paciente for proc in candidate_procs]).scores(guia_paciente, 0.85)
+        for proc, name_similarity in zip(candidate_procs, name_scores):
+            proc_date = proc.data_horario.date() if proc.data_horario else None
+            date_diff = abs((guia_date - proc_date).days) if proc_date else float('inf')
+            if name_similarity > 0.85 and date_diff <= 1 and name_similarity > highest_similarity:
+                highest_similarity = name_similarity
+                best_match_proc = proc
+        return best_match_proc
+
+    def add_new(self, cpsa_id, guia):
+        guia_paciente = guia.get('paciente')
+        guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
+        financa_data = {
+            'group': self.group, 'tipo_cobranca': 'cooperativa', 'cpsa': cpsa_id,
+            'valor_faturado': guia.get('valor_faturado'), 'valor_recebido': guia.get('valor_recebido'),
+            'valor_recuperado': guia.get('valor_receuperado', guia.get('valor_recuperado')),
+            'valor_acatado': guia.get('valor_acatado'),
+            'status_pagamento': map_api_status(guia.get('STATUS')), 'api_paciente_nome': guia_paciente,
+            'api_data_cirurgia': guia_date, 'api_hospital_nome': guia.get('hospital'),
+            'api_cooperado_nome': guia.get('cooperado'), 'matricula': guia.get('matricula'),
+            'senha': guia.get('senha'), 'plantao_eletiva': guia.get('classificacao'),
+            'api_fingerprint': guia_fingerprint(guia),
+        }
+        if not (guia_paciente and guia_date):
+            return
+        self.new_count += 1
+        self.load_matching_state()
+
+        with self.phase('match'):
+            best_match_proc = self.find_new_guia_match(guia_paciente, guia_date)
+
+        if best_match_proc and best_match_proc.pk is None:
+            # Another charge of a surgery created earlier in this run, not flushed yet
+            self.financas_pending_proc.append((financa_data, self.pending_proc_indexes[id(best_match_proc)]))
+            self.linked_count += 1
+            return
+        if best_match_proc:
+            self.update_procedimento(best_match_proc, guia)
+            self.financas_to_create.append(ProcedimentoFinancas(procedimento=best_match_proc, **financa_data))
+            self.linked_count += 1
+            return
+
+        try:
+            proc_obj = prepare_procedimento_from_guia(guia, cpsa_id, self.group, *self.entity_caches())
+        except Exception as e:
+            logger.warning("Error preparing proc for CPSA %s: %s", cpsa_id, e)
+            return
+        if proc_obj:
+            self.procedimentos_to_create.append(proc_obj)
+            self.pending_proc_indexes[id(proc_obj)] = len(self.procedimentos_to_create) - 1
+            self.financas_pending_proc.append((financa_data, len(self.procedimentos_to_create) - 1))
+            # Later guides of the same surgery link to it instead of creating another
+            self.add_to_lookup(proc_obj)
@@ -0,0 +1,237 @@
+"""
+Guide source for the Coopahub ``ajaxGuias.php`` endpoint.
+
+Instead of one POST covering the whole conciliation period, guides are
+fetched in month-sized ``periodo_de``/``periodo_ate`` windows (newest first)
+and yielded one by one. Windows are pulled concurrently by a small bounded
+thread pool, each with its own retries, so a slow window does not restart the
+whole fetch and only a few windows are held in memory at a time.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time as time_module
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+GUIAS_ENDPOINT = '/portal/guias/ajaxGuias.php'
+GUIAS_REQUEST_TIMEOUT = 120
+GUIAS_FETCH_WORKERS = 4
+GUIAS_FETCH_RETRIES = 3
+GUIAS_RETRY_BACKOFF_SECONDS = 2
+# Guide fields read when an existing ProcedimentoFinancas and its linked
+# Procedimento are updated (financas.engine.update_procedimento_with_api_data_cached)
+GUIA_FINGERPRINT_FIELDS = (
+    'valor_faturado', 'valor_recebido', 'valor_receuperado', 'valor_recuperado', 'valor_acatado',
+    'STATUS', 'paciente', 'hospital', 'cooperado', 'matricula', 'senha',
+    'dt_cirurg', 'dt_cpsa', 'classificacao',
+    'hora_inicial', 'hora_final', 'cirurgiao', 'crm_cirurgiao', 'procedimentos',
+    'cpf', 'nr_cpf', 'data_nascimento', 'tip_acomod', 'convenio',
+)
+
+_thread_local = threading.local()
+
+
+class GuiasAPIError(Exception):
+    """Raised when ajaxGuias.php answers with an error code other than '000'."""
+
+
+def parse_api_date(date_str):
+    """Safely parses date string from API format YYYY-MM-DD."""
+    if not date_str:
+        return None
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        logger.warning("Could not parse date '%s'", date_str)
+        return None
+
+
+def parse_api_time(time_str):
+    """Safely parses time string from API format HH:MM."""
+    if not time_str:
+        return None
+    try:
+        # Handle various time formats (HH:MM, H:MM, etc.)
+        time_str = str(time_str).strip()
+        if ':' in time_str:
+            parts = time_str.split(':')
+            hour = int(parts[0])
+            minute = int(parts[1]) if len(parts) > 1 else 0
+            return time(hour=hour, minute=minute)
+        else:
+            # Handle cases where only hour is provided
+            hour = int(time_str)
+            return time(hour=hour, minute=0)
+    except (ValueError, TypeError):
+        logger.warning("Could not parse time '%s'", time_str)
+        return None
+
+
+def _sorted_guias_newest_first(guias_dict):
+    def _guias_sort_key(item):
+        _, guia = item
+        guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
+        guia_time = parse_api_time(guia.get('hora_inicial'))
+        if guia_date:
+            guia_time = guia_time or time(0, 0)
+            return datetime.combine(guia_date, guia_time)
+        return datetime.min
+
+    return sorted(guias_dict.items(), key=_guias_sort_key, reverse=True)
+
+
+def month_windows(start_date, end_date):
+    """
+    Split [start_date, end_date] into calendar-month windows, newest first.
+    The first and last windows are clipped to the requested period.
+    """
+    windows = []
+    window_start = date(start_date.year, start_date.month, 1)
+    while window_start <= end_date:
+        if window_start.month == 12:
+            next_month = date(window_start.year + 1, 1, 1)
+        else:
+            next_month = date(window_start.year, window_start.month + 1, 1)
+        windows.append((max(window_start, start_date), min(next_month - timedelta(days=1), end_date)))
+        window_start = next_month
+    windows.reverse()
+    return windows
+
+
+def guias_by_cpsa(guias):
+    """Index guides by nrocpsa, dropping the ones without a usable CPSA."""
+    return {
+        str(g['nrocpsa']): g for g in guias
+        if g.get('nrocpsa') and str(g.get('nrocpsa')).strip()
+    }
+
+
+def payload_hash(guias):
+    """Stable SHA-256 of a window's guides, independent of key order."""
+    return hashlib.sha256(json.dumps(guias, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def guia_fingerprint(guia):
+    """
+    SHA-256 of the guide fields the conciliation consumes. Stored on
+    ProcedimentoFinancas.api_fingerprint so unchanged guides can be skipped
+    without comparing them field by field.
+    """
+    return payload_hash([guia.get(field) for field in GUIA_FINGERPRINT_FIELDS])
+
+
+def fetch_guias_window(connection_key, periodo_de, periodo_ate, session=None, base_url=None):
+    """POST one window to ajaxGuias.php and return its ``listaguias``."""
+    base_url = base_url or settings.COOPAHUB_API['BASE_URL']
+    api_payload = {
+        "conexao": connection_key,
+        "periodo_de": periodo_de.strftime('%Y-%m-%d'),
+        "periodo_ate": periodo_ate.strftime('%Y-%m-%d'),
+        "status": "Listagem Geral",
+        "coopahub": "S"
+    }
+    poster = session or requests
+    response = poster.post(f"{base_url}{GUIAS_ENDPOINT}", json=api_payload, timeout=GUIAS_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    api_response_data = response.json()
+    if api_response_data.get('erro') != '000':
+        raise GuiasAPIError(f"API Error: {api_response_data.get('msg', 'Unknown API error')}")
+    return api_response_data.get('listaguias', [])
+
+
+def _thread_session():
+    """One requests.Session per fetch thread (sessions are not thread-safe)."""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _thread_local.session = session
+    return session
+
+
+def fetch_guias_window_with_retry(connection_key, periodo_de, periodo_ate, base_url=None,
+                                  retries=None, retry_backoff=None):
+    """
+    fetch_guias_window with per-window retries on network/HTTP failures.
+    API error codes (GuiasAPIError) are not retried.
+    """
+    coopahub_api = settings.COOPAHUB_API
+    retries = coopahub_api.get('GUIAS_FETCH_RETRIES', GUIAS_FETCH_RETRIES) if retries is None else retries
+    if retry_backoff is None:
+        retry_backoff = coopahub_api.get('GUIAS_RETRY_BACKOFF_SECONDS', GUIAS_RETRY_BACKOFF_SECONDS)
+    attempt = 0
+    while True:
+        try:
+            return fetch_guias_window(
+                connection_key, periodo_de, periodo_ate, session=_thread_session(), base_url=base_url
+            )
+        except requests.exceptions.RequestException as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warning(
+                "[GUIAS] Window %s - %s failed (%s); retry %d/%d", periodo_de, periodo_ate, e, attempt, retries
+            )
+            time_module.sleep(retry_backoff * attempt)
+
+
+def iter_guias(connection_key, start_date, end_date=None, on_window=None, base_url=None,
+               max_workers=None, retries=None, retry_backoff=None, fetch_window=None):
+    """
+    Yield (cpsa_id, guia) pairs for the period, one month window at a time,
+    newest first. Up to max_workers windows are fetched concurrently ahead of
+    the consumer; each window is parsed and sorted on its own. Guides are
+    merged by nrocpsa: a CPSA already yielded by a newer window is skipped.
+
+    on_window(periodo_de, periodo_ate, guias_count, window_hash) is called
+    after each window is fetched, before its guides are yielded; window_hash
+    is the payload_hash() of the window as returned by the API.
+
+    fetch_window(connection_key, periodo_de, periodo_ate, **kwargs) replaces the
+    HTTP fetch (used by the benchmark harness to serve synthetic windows).
+    """
+    end_date = end_date or timezone.now().date()
+    if max_workers is None:
+        max_workers = settings.COOPAHUB_API.get('GUIAS_FETCH_WORKERS', GUIAS_FETCH_WORKERS)
+    fetch_window = fetch_window or fetch_guias_window_with_retry
+    windows = iter(month_windows(start_date, end_date))
+    seen_cpsa_ids = set()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='guias-fetch')
+    in_flight = deque()
+
+    def submit_next():
+        window = next(windows, None)
+        if window:
+            in_flight.append((window, executor.submit(
+                fetch_window, connection_key, *window,
+                base_url=base_url, retries=retries, retry_backoff=retry_backoff,
+            )))
+
+    try:
+        for _ in range(max_workers):
+            submit_next()
+        while in_flight:
+            (periodo_de, periodo_ate), future = in_flight.popleft()
+            guias = future.result()
+            window_hash = payload_hash(guias)
+            guias_dict = guias_by_cpsa(guias)
+            del guias
+            submit_next()
+            for cpsa_id in seen_cpsa_ids.intersection(guias_dict):
+                del guias_dict[cpsa_id]
+            if on_window:
+                on_window(periodo_de, periodo_ate, len(guias_dict), window_hash)
+            for cpsa_id, guia in _sorted_guias_newest_first(guias_dict):
+                seen_cpsa_ids.add(cpsa_id)
+                yield cpsa_id, guia
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,430 @@
+"""
+Database-backed queue for ConciliacaoJob.
+
+The web process only enqueues jobs (status 'pending'). Separate worker
+processes (``python manage.py conciliacao_worker``) claim them with
+``SELECT ... FOR UPDATE SKIP LOCKED``, keep ``heartbeat_at`` fresh while the
+job runs, and re-queue jobs whose worker stopped sending heartbeats.
+
+The nightly scheduler (``python manage.py conciliacao_scheduler``) enqueues
+an incremental job for every group with a usable connection key and runs
+them under a global limit on concurrently running jobs.
+"""
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+
+from constants import GESTOR_USER
+from registration.models import CustomUser, Groups
+
+from .models import ConciliacaoJob
+
+
+HEARTBEAT_INTERVAL_SECONDS = 15
+# A running job whose heartbeat is older than this is considered abandoned
+STALE_AFTER_SECONDS = 120
+MAX_ATTEMPTS = 3
+# pg_advisory_xact_lock key serializing claims under a global running limit
+RUNNING_LIMIT_LOCK_KEY = 0x436F6E63  # 'Conc'
+# A failed job's checkpoint is carried over to a new job enqueued within this window
+CHECKPOINT_RESUME_HOURS = 24
+# Engine writes are flushed after this many buffered rows or seconds, whichever comes first
+FLUSH_MAX_ROWS = 500
+FLUSH_MAX_SECONDS = 2.0
+# Minimum interval between progress-only saves of the job row
+PROGRESS_MIN_SECONDS = 1.0
+# Guides read ahead per entity pre-pass (bulk creation of hospitals, surgeons, ...)
+PREPASS_CHUNK_GUIDES = 500
+# Upper bound for a request waiting on a job (conciliar_financas ?wait=), and its poll interval
+WAIT_MAX_SECONDS = 60
+WAIT_POLL_SECONDS = 1.0
+# Scheduler: jobs running at once (across all workers), random delay before each
+# job starts so groups do not hit the Coopahub API together, and queue poll interval
+SCHEDULER_MAX_RUNNING = 2
+SCHEDULER_JITTER_SECONDS = 30
+SCHEDULER_POLL_SECONDS = 5.0
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def active_job_for_group(group):
+    return (
+        ConciliacaoJob.objects
+        .filter(group=group, status__in=['pending', 'running'])
+        .order_by('started_at')
+        .first()
+    )
+
+
+def enqueue_conciliacao(group, user, force_full=False, trigger='manual'):
+    """
+    Create a pending job for the group; a worker will pick it up.
+    If the group's last job failed recently with a checkpoint, the new job
+    inherits it and resumes instead of starting over.
+    """
+    job = ConciliacaoJob(
+        group=group,
+        requested_by=user,
+        force_full=force_full,
+        trigger=trigger,
+        status='pending',
+        current_step='Aguardando processamento...'
+    )
+    last_job = ConciliacaoJob.objects.filter(group=group).order_by('-started_at').first()
+    resume_cutoff = timezone.now() - timedelta(hours=CHECKPOINT_RESUME_HOURS)
+    if (
+        last_job and last_job.status == 'failed' and last_job.has_checkpoint
+        and last_job.force_full == force_full and last_job.started_at >= resume_cutoff
+    ):
+        job.checkpoint_batch = last_job.checkpoint_batch
+        job.checkpoint_cpsas = last_job.checkpoint_cpsas
+        job.checkpoint_windows = last_job.checkpoint_windows
+        job.payload_hash = last_job.payload_hash
+        job.current_step = f'Aguardando processamento (retomando job {last_job.id})...'
+    job.save()
+    return job
+
+
+def wait_for_job(job, timeout, poll_interval=None):
+    """
+    Reload job until it is completed or failed, or timeout seconds have
+    passed (capped at WAIT_MAX_SECONDS). Returns the refreshed job.
+    """
+    poll_interval = WAIT_POLL_SECONDS if poll_interval is None else poll_interval
+    deadline = time.monotonic() + min(max(timeout, 0), WAIT_MAX_SECONDS)
+    while True:
+        job.refresh_from_db()
+        if job.status in ('completed', 'failed') or time.monotonic() >= deadline:
+            return job
+        time.sleep(poll_interval)
+
+
+def _begin_immediate_sqlite():
+    """
+    Turn the current SQLite transaction into a write transaction now, as
+    BEGIN IMMEDIATE would; call it inside transaction.atomic().
+
+    Django 5.0 opens atomic blocks with a deferred BEGIN (the SQLite
+    transaction_mode option only arrives in 5.1), and SQLite takes its
+    database-wide write lock at a transaction's first write statement, even
+    one that changes no row. This UPDATE matches no job (ids are positive) and
+    is only that statement: other writers then wait until this transaction
+    ends, up to the connection's busy timeout.
+    """
+    ConciliacaoJob.objects.filter(pk__lt=0).update(worker_id='')
+
+
+def _lock_running_limit():
+    """
+    Serialize the claims made under a running limit until the transaction
+    ends, so the running count a claimer reads already includes every job
+    claimed before it. PostgreSQL takes an advisory lock; SQLite, which has no
+    row or advisory locks, takes its database write lock.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [RUNNING_LIMIT_LOCK_KEY])
+    else:
+        _begin_immediate_sqlite()
+
+
+def claim_next_job(worker_id, job_ids=None, max_running=None, triggers=None):
+    """
+    Atomically claim the oldest pending job. Rows locked by another worker are
+    skipped, so several workers can poll the queue concurrently.
+
+    job_ids restricts the claim to those jobs, and triggers to jobs with one
+    of those triggers; with max_running, nothing is claimed while that many
+    jobs are already running, counted and claimed under one lock shared by
+    every worker.
+    """
+    with transaction.atomic():
+        if max_running:
+            _lock_running_limit()
+            if ConciliacaoJob.objects.filter(status='running').count() >= max_running:
+                return None
+        pending = ConciliacaoJob.objects.select_for_update(skip_locked=True).filter(status='pending')
+        if job_ids is not None:
+            pending = pending.filter(pk__in=job_ids)
+        if triggers is not None:
+            pending = pending.filter(trigger__in=triggers)
+        job = pending.order_by('started_at').first()
+        if job is None:
+            return None
+        job.status = 'running'
+        job.worker_id = worker_id
+        job.heartbeat_at = timezone.now()
+        job.attempts += 1
+        job.current_step = 'Buscando dados da API...'
+        job.save(update_fields=['status', 'worker_id', 'heartbeat_at', 'attempts', 'current_step'])
+        return job
+
+
+def claim_worker_job(worker_id, max_running=None):
+    """
+    Claim the next job for a conciliacao_worker: the oldest job a user
+    requested, else a scheduler-triggered one under the scheduler's running
+    limit (max_running, SCHEDULER_MAX_RUNNING by default), so always-on
+    workers do not start every nightly job as soon as it is enqueued.
+    """
+    max_running = SCHEDULER_MAX_RUNNING if max_running is None else max_running
+    job = claim_next_job(worker_id, triggers=['manual'])
+    if job is None:
+        job = claim_next_job(worker_id, max_running=max_running, triggers=['scheduled'])
+    return job
+
+
+def requeue_abandoned_jobs(stale_after_seconds=STALE_AFTER_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """
+    Put running jobs with a stale heartbeat back in the queue, or mark them
+    failed once they have used up max_attempts. Returns (requeued, failed).
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after_seconds)
+    requeued = failed = 0
+    with transaction.atomic():
+        stale_jobs = (
+            ConciliacaoJob.objects
+            .select_for_update(skip_locked=True)
+            .filter(status='running', heartbeat_at__lt=cutoff)
+        )
+        for job in stale_jobs:
+            if job.attempts >= max_attempts:
+                job.status = 'failed'
+                job.completed_at = timezone.now()
+                job.error_message = (
+                    f'Job abandonado pelo worker {job.worker_id} após {job.attempts} tentativas.'
+                )
+                failed += 1
+            else:
+                job.status = 'pending'
+                job.current_step = 'Reenfileirado após falha do worker...'
+                requeued += 1
+            job.worker_id = ''
+            job.save(update_fields=['status', 'completed_at', 'error_message', 'current_step', 'worker_id'])
+    return requeued, failed
+
+
+def job_run_stats(job, seconds):
+    """Set the run's duration and guide throughput on job (not saved)."""
+    job.duration_seconds = round(seconds, 3)
+    job.guias_per_second = round(job.processed_count / seconds, 2) if seconds > 0 else None
+
+
+def scheduler_candidates():
+    """
+    [(group, user)] for every group with a validated gestor holding a
+    connection key, the key checked most recently against the API being
+    preferred. Groups whose last completed job is oldest come first (never
+    conciliated ones before all others), so a run cut short still reaches the
+    most overdue groups and no group is starved.
+    """
+    users = (
+        CustomUser.objects
+        .filter(
+            validado=True, connection_key__gt='',
+            memberships__role=GESTOR_USER, memberships__validado=True,
+        )
+        .annotate(membership_group_id=F('memberships__group_id'))
+        .order_by(F('last_token_check').desc(nulls_last=True), 'pk')
+    )
+    user_by_group = {}
+    for user in users:
+        user_by_group.setdefault(user.membership_group_id, user)
+
+    groups = (
+        Groups.objects
+        .filter(pk__in=list(user_by_group))
+        .annotate(last_completed=Max('conciliacao_jobs__completed_at', filter=Q(conciliacao_jobs__status='completed')))
+        .order_by(F('last_completed').asc(nulls_first=True), 'pk')
+    )
+    return [(group, user_by_group[group.pk]) for group in groups]
+
+
+def schedule_conciliacoes():
+    """
+    Enqueue one incremental, scheduler-triggered job per candidate group,
+    skipping groups that already have a pending or running job.
+    Returns (enqueued jobs in fairness order, skipped groups).
+    """
+    jobs, skipped = [], []
+    for group, user in scheduler_candidates():
+        if active_job_for_group(group):
+            skipped.append(group)
+            continue
+        jobs.append(enqueue_conciliacao(group, user, force_full=False, trigger='scheduled'))
+    return jobs, skipped
+
+
+def run_scheduled_job(job_ids, worker_id, max_running=None, jitter_seconds=None, poll_seconds=None,
+                      should_stop=None, sleep=time.sleep, rng=random):
+    """
+    Claim and run one of job_ids once fewer than max_running jobs run anywhere,
+    after a random delay of up to jitter_seconds. Returns the finished job, or
+    None when none of job_ids is pending any more (or should_stop() is true).
+    """
+    max_running = SCHEDULER_MAX_RUNNING if max_running is None else max_running
+    jitter_seconds = SCHEDULER_JITTER_SECONDS if jitter_seconds is None else jitter_seconds
+    poll_seconds = SCHEDULER_POLL_SECONDS if poll_seconds is None else poll_seconds
+    if jitter_seconds:
+        sleep(rng.uniform(0, jitter_seconds))
+    while not (should_stop and should_stop()):
+        job = claim_next_job(worker_id, job_ids=job_ids, max_running=max_running)
+        if job is not None:
+            run_job(job)
+            job.refresh_from_db()
+            return job
+        if not ConciliacaoJob.objects.filter(pk__in=job_ids, status='pending').exists():
+            return None
+        sleep(poll_seconds)
+    return None
+
+
+class FlushScheduler:
+    """
+    Decides when the conciliation engine should flush its write buffers:
+    once max_rows rows are buffered or max_seconds have passed since the
+    last flush, so batches grow with throughput instead of a fixed size.
+    """
+
+    def __init__(self, max_rows=None, max_seconds=None, clock=time.monotonic):
+        self.max_rows = FLUSH_MAX_ROWS if max_rows is None else max_rows
+        self.max_seconds = FLUSH_MAX_SECONDS if max_seconds is None else max_seconds
+        self.clock = clock
+        self.flushes = 0
+        self._last_flush = clock()
+
+    def due(self, pending_rows):
+        return pending_rows >= self.max_rows or self.clock() - self._last_flush >= self.max_seconds
+
+    def flushed(self):
+        self.flushes += 1
+        self._last_flush = self.clock()
+
+
+class ProgressThrottle:
+    """Rate-limits progress-only job saves between flushes."""
+
+    def __init__(self, min_seconds=None, clock=time.monotonic):
+        self.min_seconds = PROGRESS_MIN_SECONDS if min_seconds is None else min_seconds
+        self.clock = clock
+        self._last_save = clock()
+
+    def due(self):
+        return self.clock() - self._last_save >= self.min_seconds
+
+    def saved(self):
+        self._last_save = self.clock()
+
+
+class ConciliacaoCheckpoint:
+    """
+    Resume state of a job, persisted on the ConciliacaoJob row.
+
+    The engine calls mark_processed() for every guide and commit() inside the
+    transaction that flushes the buffered writes, so checkpoint_cpsas only ever
+    holds CPSAs whose results are in the database. On a retry, a CPSA is skipped only if
+    it was committed and its window's payload hash is unchanged; windows whose
+    payload changed are processed again in full.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self._resume_cpsas = set(job.checkpoint_cpsas or [])
+        self._resume_windows = dict(job.checkpoint_windows or {})
+        self._window_resumable = False
+        self.batch = job.checkpoint_batch
+        self.windows = {}
+        self.committed = set()
+        self.pending = []
+        self.skipped = 0
+
+    @property
+    def resuming(self):
+        return bool(self._resume_cpsas)
+
+    def on_window(self, periodo_de, periodo_ate, guias_count, window_hash):
+        key = periodo_de.isoformat()
+        self.windows[key] = window_hash
+        self._window_resumable = self._resume_windows.get(key) == window_hash
+
+    def should_skip(self, cpsa_id):
+        if self._window_resumable and cpsa_id in self._resume_cpsas:
+            self.committed.add(cpsa_id)
+            self.skipped += 1
+            return True
+        return False
+
+    def mark_processed(self, cpsa_id):
+        self.pending.append(cpsa_id)
+
+    def commit(self):
+        """Persist the checkpoint; call in the transaction that flushes the buffered writes."""
+        self.committed.update(self.pending)
+        self.pending = []
+        self.batch += 1
+        self.job.checkpoint_batch = self.batch
+        self.job.checkpoint_cpsas = sorted(self.committed)
+        self.job.checkpoint_windows = self.windows
+        self.job.payload_hash = hashlib.sha256(
+            ''.join(f'{key}:{value}' for key, value in sorted(self.windows.items())).encode()
+        ).hexdigest()
+        self.job.save(update_fields=['checkpoint_batch', 'checkpoint_cpsas', 'checkpoint_windows', 'payload_hash'])
+
+    def clear(self):
+        """Drop the resume state once the run completes (payload_hash is kept)."""
+        self.job.checkpoint_batch = 0
+        self.job.checkpoint_cpsas = []
+        self.job.checkpoint_windows = {}
+        self.job.save(update_fields=['checkpoint_batch', 'checkpoint_cpsas', 'checkpoint_windows'])
+
+
+class JobHeartbeat:
+    """
+    Context manager that refreshes job.heartbeat_at from a background thread
+    while the job runs, independently of how long a single guide window or
+    flush takes.
+    """
+
+    def __init__(self, job, interval=HEARTBEAT_INTERVAL_SECONDS):
+        self.job_id = job.pk
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                ConciliacaoJob.objects.filter(pk=self.job_id, status='running').update(
+                    heartbeat_at=timezone.now()
+                )
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def run_job(job):
+    """Execute a claimed job, keeping its heartbeat alive."""
+    from .views import _run_conciliacao_background
+
+    close_old_connections()
+    with JobHeartbeat(job):
+        _run_conciliacao_background(job.pk, job.requested_by_id, force_full=job.force_full)
+    close_old_connections()
@@ -0,0 +1,82 @@
+"""
+Benchmark the conciliation engine against a synthetic guide payload.
+
+Usage:
+    python manage.py benchmark_conciliacao                                  # 1000 guides, JSON to stdout
+    python manage.py benchmark_conciliacao --guias 20000 --noise-rate 0.2
+    python manage.py benchmark_conciliacao --repeat 3 --output bench.json   # Keep results between releases
+
+All synthetic rows are created in a throwaway group inside a transaction that
+is rolled back at the end of each run.
+"""
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from financas.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time the conciliation engine on synthetic guides and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guias', type=int, default=1000, help='Number of synthetic guides')
+        parser.add_argument(
+            '--procedures',
+            type=int,
+            help='Guides backed by an existing Procedimento (default: all)',
+        )
+        parser.add_argument(
+            '--existing-ratio',
+            type=float,
+            default=0.5,
+            help='Fraction of backed guides that already have a ProcedimentoFinancas',
+        )
+        parser.add_argument('--noise-rate', type=float, default=0.1, help='Fraction of patient names with a typo')
+        parser.add_argument('--date-spread', type=int, default=90, help='Days covered by the guides')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed')
+        parser.add_argument('--repeat', type=int, default=1, help='Number of runs')
+        parser.add_argument(
+            '--no-memory',
+            action='store_true',
+            help='Skip tracemalloc (peak memory) to avoid its timing overhead',
+        )
+        parser.add_argument('--output', type=str, help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        runs = []
+        for run in range(options['repeat']):
+            result = run_benchmark(
+                guias=options['guias'],
+                procedures=options['procedures'],
+                existing_ratio=options['existing_ratio'],
+                noise_rate=options['noise_rate'],
+                date_spread_days=options['date_spread'],
+                seed=options['seed'],
+                trace_memory=not options['no_memory'],
+            )
+            runs.append(result)
+            self.stderr.write(
+                f"Run {run + 1}: {result['total_seconds']}s, "
+                f"{result['guides_per_second']} guides/s, {result['queries']} queries"
+            )
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'runs': runs,
+            'best_total_seconds': min(r['total_seconds'] for r in runs),
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Benchmark report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
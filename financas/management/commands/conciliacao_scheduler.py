@@ -0,0 +1,127 @@
+"""
+Nightly incremental conciliation for every group.
+
+Enqueues one incremental job per group with a validated gestor holding a
+connection key (groups with a queued or running job are skipped), least
+recently conciliated groups first, then runs them with a bounded thread
+pool. A job is only started while fewer than --max-running jobs are running
+anywhere (conciliacao_worker processes included), after a random delay of up
+to --jitter seconds so groups do not hit the Coopahub API at the same time.
+
+Outcome, duration and guide throughput of each group are stored on its
+ConciliacaoJob (status, duration_seconds, guias_per_second; trigger='scheduled').
+
+Usage:
+    python manage.py conciliacao_scheduler                  # Enqueue and run all groups
+    python manage.py conciliacao_scheduler --max-running 4 --jitter 60
+    python manage.py conciliacao_scheduler --enqueue-only   # Leave the jobs to conciliacao_worker
+    python manage.py conciliacao_scheduler --dry-run        # List the groups that would be scheduled
+
+Typical crontab entry (off business hours):
+    0 2 * * * cd /app && python manage.py conciliacao_scheduler
+"""
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from financas.jobs import (
+    SCHEDULER_JITTER_SECONDS, SCHEDULER_MAX_RUNNING, SCHEDULER_POLL_SECONDS, active_job_for_group,
+    default_worker_id, requeue_abandoned_jobs, run_scheduled_job, schedule_conciliacoes, scheduler_candidates,
+)
+
+
+def _run_in_thread(*args, **kwargs):
+    try:
+        return run_scheduled_job(*args, **kwargs)
+    finally:
+        # Pool threads do not go through the request cycle that closes connections
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Enqueue and run incremental conciliation for all groups with a connection key'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-running',
+            type=int,
+            default=SCHEDULER_MAX_RUNNING,
+            help='Maximum conciliation jobs running at once, across all workers',
+        )
+        parser.add_argument(
+            '--jitter',
+            type=float,
+            default=SCHEDULER_JITTER_SECONDS,
+            help='Maximum random delay in seconds before each job starts',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=SCHEDULER_POLL_SECONDS,
+            help='Seconds to wait while the concurrency limit is reached',
+        )
+        parser.add_argument(
+            '--enqueue-only',
+            action='store_true',
+            help='Only enqueue the jobs; conciliacao_worker processes run them',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='List the groups that would be scheduled and exit',
+        )
+
+    def handle(self, *args, **options):
+        max_running = max(options['max_running'], 1)
+
+        if options['dry_run']:
+            for group, user in scheduler_candidates():
+                note = ' (skipped: job already queued or running)' if active_job_for_group(group) else ''
+                self.stdout.write(f'{group.name}: key of {user.email}{note}')
+            return
+
+        requeued, failed = requeue_abandoned_jobs()
+        if requeued or failed:
+            self.stdout.write(self.style.WARNING(
+                f'Requeued {requeued} and failed {failed} abandoned job(s).'
+            ))
+
+        jobs, skipped = schedule_conciliacoes()
+        for group in skipped:
+            self.stdout.write(self.style.WARNING(f'Skipped group "{group.name}": job already queued or running'))
+        self.stdout.write(self.style.SUCCESS(f'Enqueued {len(jobs)} incremental job(s).'))
+        if options['enqueue_only'] or not jobs:
+            return
+
+        stopping = threading.Event()
+
+        def request_stop(signum, frame):
+            self.stdout.write(self.style.WARNING('Stop requested; finishing running jobs...'))
+            stopping.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        job_ids = [job.pk for job in jobs]
+        worker_id = default_worker_id()
+        with ThreadPoolExecutor(max_workers=min(max_running, len(jobs)), thread_name_prefix='scheduler') as executor:
+            futures = [
+                executor.submit(
+                    _run_in_thread, job_ids, f'{worker_id}:scheduler',
+                    max_running=max_running, jitter_seconds=options['jitter'],
+                    poll_seconds=options['poll_interval'], should_stop=stopping.is_set,
+                )
+                for _ in jobs
+            ]
+            for future in futures:
+                job = future.result()
+                if job is None:
+                    continue
+                style = self.style.SUCCESS if job.status == 'completed' else self.style.ERROR
+                self.stdout.write(style(
+                    f'Group "{job.group.name}": {job.status} in {job.duration_seconds or 0:.1f}s, '
+                    f'{job.processed_count} guides ({job.guias_per_second or 0:.1f}/s)'
+                ))
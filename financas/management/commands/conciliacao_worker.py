@@ -0,0 +1,97 @@
+"""
+Worker process for queued conciliation jobs.
+
+Usage:
+    python manage.py conciliacao_worker                 # Run forever, polling the queue
+    python manage.py conciliacao_worker --once          # Process at most one job and exit
+    python manage.py conciliacao_worker --max-jobs 10   # Exit after 10 jobs
+    python manage.py conciliacao_worker --poll-interval 2
+
+Run several workers (one per process) to conciliate many groups in parallel.
+Jobs requested by users are claimed first; jobs enqueued by
+conciliacao_scheduler only while fewer than --max-running jobs run anywhere
+(the scheduler's own limit), so the workers do not start them all at once.
+"""
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from financas.jobs import (
+    SCHEDULER_MAX_RUNNING, claim_worker_job, default_worker_id, requeue_abandoned_jobs, run_job,
+)
+
+
+class Command(BaseCommand):
+    help = 'Process queued conciliation jobs (ConciliacaoJob)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Process at most one job and exit',
+        )
+        parser.add_argument(
+            '--max-jobs',
+            type=int,
+            default=0,
+            help='Exit after processing this many jobs (0 = no limit)',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5.0,
+            help='Seconds to wait when the queue is empty',
+        )
+        parser.add_argument(
+            '--max-running',
+            type=int,
+            default=SCHEDULER_MAX_RUNNING,
+            help='Scheduled jobs are only claimed while fewer jobs than this are running',
+        )
+        parser.add_argument(
+            '--worker-id',
+            type=str,
+            help='Identifier stored on claimed jobs (default: hostname:pid)',
+        )
+
+    def handle(self, *args, **options):
+        worker_id = options.get('worker_id') or default_worker_id()
+        max_jobs = 1 if options['once'] else options['max_jobs']
+        poll_interval = options['poll_interval']
+        self._stopping = False
+
+        def request_stop(signum, frame):
+            self.stdout.write(self.style.WARNING('Stop requested; finishing current job...'))
+            self._stopping = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        self.stdout.write(self.style.SUCCESS(f'Conciliation worker {worker_id} started.'))
+        processed = 0
+        while not self._stopping:
+            requeued, failed = requeue_abandoned_jobs()
+            if requeued or failed:
+                self.stdout.write(self.style.WARNING(
+                    f'Requeued {requeued} and failed {failed} abandoned job(s).'
+                ))
+
+            job = claim_worker_job(worker_id, max_running=max(options['max_running'], 1))
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            self.stdout.write(f'Claimed job {job.id} for group "{job.group.name}" (attempt {job.attempts})')
+            run_job(job)
+            job.refresh_from_db()
+            style = self.style.SUCCESS if job.status == 'completed' else self.style.ERROR
+            self.stdout.write(style(f'Job {job.id} finished with status "{job.status}"'))
+
+            processed += 1
+            if max_jobs and processed >= max_jobs:
+                break
+
+        self.stdout.write(f'Worker {worker_id} stopped after {processed} job(s).')
@@ -0,0 +1,239 @@
+import re
+import unicodedata
+from collections import defaultdict
+from datetime import timedelta
+from difflib import SequenceMatcher
+
+import numpy as np
+
+
+# Particles that appear in most Brazilian names and carry no blocking value
+NAME_STOPWORDS = {'de', 'da', 'do', 'das', 'dos', 'e'}
+
+# Ordered digraph/letter substitutions for the phonetic key (Portuguese spelling)
+_PHONETIC_RULES = [
+    (re.compile(r'ph'), 'f'),
+    (re.compile(r'lh'), 'li'),
+    (re.compile(r'nh'), 'ni'),
+    (re.compile(r'ch'), 'x'),
+    (re.compile(r'sh'), 'x'),
+    (re.compile(r'qu'), 'k'),
+    (re.compile(r'g(?=[ei])'), 'j'),
+    (re.compile(r'gu(?=[ei])'), 'g'),
+    (re.compile(r'sc(?=[ei])'), 's'),
+    (re.compile(r'c(?=[ei])'), 's'),
+    (re.compile(r'ss'), 's'),
+    (re.compile(r'z'), 's'),
+    (re.compile(r'[ckq]'), 'k'),
+    (re.compile(r'w'), 'v'),
+    (re.compile(r'y'), 'i'),
+    (re.compile(r'h'), ''),
+]
+
+
+def normalize_name(name):
+    """Lowercase, strip accents/punctuation and collapse whitespace."""
+    if not name:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    ascii_name = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', ascii_name.lower()).split())
+
+
+def name_tokens(name):
+    """Normalized name tokens, without particles and single letters."""
+    return {
+        token for token in normalize_name(name).split()
+        if len(token) > 1 and token not in NAME_STOPWORDS
+    }
+
+
+def phonetic_key(token):
+    """
+    Rough Portuguese phonetic key for a single normalized token.
+    Similar-sounding spellings (e.g. "souza"/"sousa", "felipe"/"phelipe")
+    collapse to the same key; repeated letters are collapsed.
+    """
+    if not token:
+        return ''
+    key = token
+    for pattern, replacement in _PHONETIC_RULES:
+        key = pattern.sub(replacement, key)
+    return re.sub(r'(.)\1+', r'\1', key)
+
+
+def name_keys(name):
+    """Blocking keys for a name: its tokens plus their phonetic keys."""
+    keys = set()
+    for token in name_tokens(name):
+        keys.add(token)
+        phonetic = phonetic_key(token)
+        if phonetic:
+            keys.add('#' + phonetic)
+    return keys
+
+
+class ProcedureMatchIndex:
+    """
+    Blocked candidate index for guide-to-procedure matching.
+
+    Built once per conciliation run. Procedures are keyed by (date, name key),
+    where a name key is a normalized patient-name token or its phonetic key, so
+    each guide is only scored against procedures within ±1 day that share at
+    least one key with the guide's patient name. Procedures without a patient
+    name are kept in a per-date bucket so they stay reachable by date alone,
+    as in the full scan.
+    """
+
+    def __init__(self, procs=()):
+        self._blocks = defaultdict(list)
+        self._order = {}
+        self.anesthesiologist_names = {}
+        self.lookups = 0
+        self.candidates_total = 0
+        self.candidates_max = 0
+        for proc in procs:
+            self.add(proc)
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, proc):
+        if not proc.data_horario or id(proc) in self._order:
+            return
+        self._order[id(proc)] = len(self._order)
+        proc_date = proc.data_horario.date()
+        for key in name_keys(proc.nome_paciente) or {None}:
+            self._blocks[(proc_date, key)].append(proc)
+
+    def load_anesthesiologist_names(self, procs_qs):
+        """
+        Preload lowercased anestesistas_responsaveis names for every procedure
+        in procs_qs with a single query, so scoring never touches the M2M.
+        """
+        from agenda.models import Procedimento
+        through = Procedimento.anestesistas_responsaveis.through
+        rows = (
+            through.objects
+            .filter(procedimento_id__in=procs_qs.values('pk'))
+            .exclude(anesthesiologist__name='')
+            .values_list('procedimento_id', 'anesthesiologist__name')
+        )
+        names = defaultdict(list)
+        for proc_id, name in rows:
+            if name:
+                names[proc_id].append(name.lower())
+        self.anesthesiologist_names = {proc_id: tuple(values) for proc_id, values in names.items()}
+
+    def candidates(self, paciente, guia_date):
+        """Procedures within ±1 day of guia_date sharing a name key with paciente."""
+        if not guia_date:
+            return []
+        keys = name_keys(paciente)
+        keys.add(None)
+        found = {}
+        for delta in (-1, 0, 1):
+            day = guia_date + timedelta(days=delta)
+            for key in keys:
+                for proc in self._blocks.get((day, key), ()):
+                    found[id(proc)] = proc
+        # Preserve the original queryset order so tie-breaking matches a full scan
+        result = sorted(found.values(), key=lambda proc: self._order[id(proc)])
+
+        self.lookups += 1
+        self.candidates_total += len(result)
+        self.candidates_max = max(self.candidates_max, len(result))
+        return result
+
+    def record_stats(self, job):
+        """Copy candidate-set counters onto a ConciliacaoJob (not saved)."""
+        job.candidate_lookups = self.lookups
+        job.candidate_total = self.candidates_total
+        job.candidate_max = self.candidates_max
+
+
+def similar(a, b):
+    """SequenceMatcher ratio of the lowercased names; 0 when either is empty."""
+    if not a or not b:
+        return 0
+    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+
+
+class NameSimilarity:
+    """
+    Batch version of similar() for one query against many names.
+
+    Each name is stored as a row of character counts in a NumPy matrix, which
+    gives difflib's quick_ratio() (2 * shared characters / total length) for
+    every name in one vectorized step. quick_ratio is an upper bound of
+    SequenceMatcher.ratio(), so names whose bound is below the threshold are
+    pruned and only the survivors are scored exactly: the scores, and every
+    threshold comparison made on them, are identical to similar().
+    """
+
+    def __init__(self, names):
+        self.names = [(name or '').lower() for name in names]
+        self.lengths = np.fromiter((len(name) for name in self.names), dtype=np.int64, count=len(self.names))
+        codes = np.frombuffer(''.join(self.names).encode('utf-32-le'), dtype=np.uint32)
+        self.vocab, char_ids = np.unique(codes, return_inverse=True)
+        self.counts = np.zeros((len(self.names), len(self.vocab)), dtype=np.int32)
+        rows = np.repeat(np.arange(len(self.names)), self.lengths)
+        np.add.at(self.counts, (rows, char_ids), 1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def upper_bounds(self, query):
+        """quick_ratio of query against every name (0 for empty strings, like similar())."""
+        query = (query or '').lower()
+        if not query or not len(self.names):
+            return np.zeros(len(self.names))
+        codes = np.frombuffer(query.encode('utf-32-le'), dtype=np.uint32)
+        positions = np.searchsorted(self.vocab, codes)
+        known = positions < len(self.vocab)
+        known[known] = self.vocab[positions[known]] == codes[known]
+        query_counts = np.bincount(positions[known], minlength=len(self.vocab))
+        shared = np.minimum(self.counts, query_counts).sum(axis=1)
+        bounds = 2.0 * shared / (self.lengths + len(query))
+        bounds[self.lengths == 0] = 0.0
+        return bounds
+
+    def _candidates(self, query, threshold):
+        bounds = self.upper_bounds(query)
+        return np.flatnonzero((bounds >= threshold) & (bounds > 0))
+
+    def scores(self, query, threshold):
+        """
+        Exact similar() scores; names that cannot reach threshold are reported as 0.0.
+        """
+        query = (query or '').lower()
+        scores = np.zeros(len(self.names))
+        for i in self._candidates(query, threshold):
+            scores[i] = SequenceMatcher(None, query, self.names[i]).ratio()
+        return scores
+
+    def best(self, query, threshold):
+        """Index of the highest score strictly above threshold (first on ties), or None."""
+        scores = self.scores(query, threshold)
+        if not len(scores):
+            return None
+        index = int(scores.argmax())
+        return index if scores[index] > threshold else None
+
+    def first(self, query, threshold):
+        """Index of the first name scoring strictly above threshold, or None."""
+        query = (query or '').lower()
+        for i in self._candidates(query, threshold):
+            if SequenceMatcher(None, query, self.names[i]).ratio() > threshold:
+                return int(i)
+        return None
+
+
+def first_similar(query, named_objects, threshold):
+    """
+    First value of a {lowercased name: object} cache whose name is similar()
+    to query above threshold, in insertion order; None if there is none.
+    """
+    names = list(named_objects)
+    index = NameSimilarity(names).first(query, threshold)
+    return named_objects[names[index]] if index is not None else None
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0020_conciliacao_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='candidate_lookups',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='candidate_max',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='candidate_total',
+            field=models.IntegerField(default=0),
+        ),
+    ]
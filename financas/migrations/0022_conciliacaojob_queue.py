@@ -0,0 +1,46 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0021_conciliacaojob_candidate_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='force_full',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='requested_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='conciliacao_jobs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='worker_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='conciliacaojob',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pendente'), ('running', 'Em Execução'), ('completed', 'Concluído'), ('failed', 'Falhou')], db_index=True, default='pending', max_length=20),
+        ),
+    ]
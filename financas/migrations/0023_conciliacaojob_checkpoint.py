@@ -0,0 +1,33 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0022_conciliacaojob_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='checkpoint_batch',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='checkpoint_cpsas',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='checkpoint_windows',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='payload_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
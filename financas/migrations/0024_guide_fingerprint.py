@@ -0,0 +1,33 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0023_conciliacaojob_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='changed_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='new_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='skipped_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='procedimentofinancas',
+            name='api_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Fingerprint da guia (API)'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0024_guide_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciliacaotentativa',
+            name='candidatos',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='conciliacaotentativa',
+            name='guia_fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
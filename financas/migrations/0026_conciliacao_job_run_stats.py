@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0025_conciliacao_tentativa_memo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='duration_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='guias_per_second',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conciliacaojob',
+            name='trigger',
+            field=models.CharField(choices=[('manual', 'Manual'), ('scheduled', 'Agendado')], default='manual', max_length=20),
+        ),
+    ]
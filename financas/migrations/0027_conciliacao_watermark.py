@@ -0,0 +1,24 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0026_conciliacao_job_run_stats'),
+        ('registration', '0017_remove_customuser_user_type_membership_role'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConciliacaoWatermark',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='conciliacao_watermark', serialize=False, to='registration.groups')),
+                ('last_completed_at', models.DateTimeField(blank=True, null=True)),
+                ('oldest_pending_date', models.DateField(blank=True, null=True)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
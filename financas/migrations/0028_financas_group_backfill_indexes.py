@@ -0,0 +1,35 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:17
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_group(apps, schema_editor):
+    """Give finance rows linked to a procedure but without a group the procedure's group."""
+    Procedimento = apps.get_model('agenda', 'Procedimento')
+    ProcedimentoFinancas = apps.get_model('financas', 'ProcedimentoFinancas')
+    ProcedimentoFinancas.objects.filter(
+        group__isnull=True, procedimento__group__isnull=False,
+    ).update(
+        group=Subquery(Procedimento.objects.filter(pk=OuterRef('procedimento_id')).values('group_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0077_procedimento_atualizado_em'),
+        ('financas', '0027_conciliacao_watermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_group, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='procedimentofinancas',
+            index=models.Index(fields=['group', 'status_pagamento'], name='financas_group_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='procedimentofinancas',
+            index=models.Index(fields=['group', 'cpsa'], name='financas_group_cpsa_idx'),
+        ),
+    ]
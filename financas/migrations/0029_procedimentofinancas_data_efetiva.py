@@ -0,0 +1,50 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:19
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_data_efetiva(apps, schema_editor):
+    """Local date of the linked procedure, or the API surgery date (see data_efetiva_for)."""
+    ProcedimentoFinancas = apps.get_model('financas', 'ProcedimentoFinancas')
+    batch = []
+    rows = ProcedimentoFinancas.objects.select_related('procedimento').only(
+        'pk', 'api_data_cirurgia', 'procedimento__data_horario'
+    )
+    for financa in rows.iterator(chunk_size=2000):
+        if financa.procedimento_id is None:
+            financa.data_efetiva = financa.api_data_cirurgia
+        elif financa.procedimento.data_horario is None:
+            continue
+        else:
+            data_horario = financa.procedimento.data_horario
+            if timezone.is_aware(data_horario):
+                data_horario = timezone.localtime(data_horario)
+            financa.data_efetiva = data_horario.date()
+        batch.append(financa)
+        if len(batch) >= 2000:
+            ProcedimentoFinancas.objects.bulk_update(batch, ['data_efetiva'])
+            batch = []
+    if batch:
+        ProcedimentoFinancas.objects.bulk_update(batch, ['data_efetiva'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0077_procedimento_atualizado_em'),
+        ('financas', '0028_financas_group_backfill_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='procedimentofinancas',
+            name='data_efetiva',
+            field=models.DateField(blank=True, editable=False, help_text='Data local do procedimento vinculado, ou a data da cirurgia informada pela API', null=True, verbose_name='Data efetiva'),
+        ),
+        migrations.RunPython(backfill_data_efetiva, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='procedimentofinancas',
+            index=models.Index(fields=['group', 'data_efetiva'], name='financas_group_data_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.0.7 on 2026-10-18 13:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import TruncMonth
+
+
+def mark_existing_months(apps, schema_editor):
+    """Every month with finance rows is built on its group's first read (financas.rollup)."""
+    ProcedimentoFinancas = apps.get_model('financas', 'ProcedimentoFinancas')
+    ResumoFinanceiroPendente = apps.get_model('financas', 'ResumoFinanceiroPendente')
+    months = (
+        ProcedimentoFinancas.objects
+        .filter(group__isnull=False, data_efetiva__isnull=False)
+        .values_list('group_id', TruncMonth('data_efetiva'))
+        .distinct()
+    )
+    ResumoFinanceiroPendente.objects.bulk_create(
+        [ResumoFinanceiroPendente(group_id=group_id, mes=mes) for group_id, mes in months],
+        batch_size=2000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('financas', '0029_procedimentofinancas_data_efetiva'),
+        ('registration', '0017_remove_customuser_user_type_membership_role'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResumoFinanceiroMensal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mes', models.DateField()),
+                ('tipo_cobranca', models.CharField(blank=True, max_length=20, null=True)),
+                ('status_pagamento', models.CharField(blank=True, max_length=20, null=True)),
+                ('cirurgiao_id', models.IntegerField(blank=True, null=True)),
+                ('tipo_clinica', models.CharField(blank=True, max_length=50, null=True)),
+                ('por_anestesista', models.BooleanField(default=False)),
+                ('anestesista_id', models.IntegerField(blank=True, null=True)),
+                ('quantidade', models.IntegerField(default=0)),
+                ('quantidade_faturado', models.IntegerField(default=0)),
+                ('procedimentos', models.IntegerField(default=0)),
+                ('soma_faturado', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('soma_recebido', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('soma_recuperado', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('soma_glosa', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resumos_financeiros', to='registration.groups')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', 'por_anestesista', 'mes'], name='resumo_group_mes_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ResumoFinanceiroPendente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mes', models.DateField()),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registration.groups')),
+            ],
+            options={
+                'unique_together': {('group', 'mes')},
+            },
+        ),
+        migrations.RunPython(mark_existing_months, migrations.RunPython.noop),
+    ]
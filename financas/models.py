@@ -1,9 +1,25 @@
 from django.db import models
+from django.utils import timezone
 from agenda.models import Procedimento
 from django.db.models import Sum, F, Value
 from django.db.models.functions import Coalesce
 from registration.models import Groups
 
+def data_efetiva_for(procedimento, api_data_cirurgia):
+    """
+    Date a finance row is reported under: the local date of its procedure,
+    or the API surgery date when it is not linked (ProcedimentoFinancas.data_efetiva).
+    """
+    if procedimento is not None:
+        data_horario = procedimento.data_horario
+        if data_horario is None:
+            return None
+        if timezone.is_aware(data_horario):
+            data_horario = timezone.localtime(data_horario)
+        return data_horario.date()
+    return api_data_cirurgia
+
+
 class ProcedimentoFinancas(models.Model):
     COBRANCA_CHOICES = [
         ('cooperativa', 'Cooperativa'),
@@ -148,10 +164,29 @@ class ProcedimentoFinancas(models.Model):
         null=True,
         blank=True
     )
+    data_efetiva = models.DateField(
+        verbose_name='Data efetiva',
+        null=True,
+        blank=True,
+        editable=False,
+        help_text='Data local do procedimento vinculado, ou a data da cirurgia informada pela API'
+    )
+    api_fingerprint = models.CharField(
+        max_length=64,
+        verbose_name='Fingerprint da guia (API)',
+        null=True,
+        blank=True,
+        editable=False
+    )
 
     class Meta:
         verbose_name = "Financeiro do Procedimento"
         verbose_name_plural = "Financeiro dos Procedimentos"
+        indexes = [
+            models.Index(fields=['group', 'status_pagamento'], name='financas_group_status_idx'),
+            models.Index(fields=['group', 'cpsa'], name='financas_group_cpsa_idx'),
+            models.Index(fields=['group', 'data_efetiva'], name='financas_group_data_idx'),
+        ]
         constraints = [
             models.UniqueConstraint(
                 fields=['procedimento', 'cpsa'], 
@@ -160,6 +195,29 @@ class ProcedimentoFinancas(models.Model):
             )
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Rollup month the row was read under, rebuilt too if a save moves it
+        instance._loaded_rollup_key = (instance.__dict__.get('group_id'), instance.__dict__.get('data_efetiva'))
+        return instance
+
+    def compute_data_efetiva(self):
+        return data_efetiva_for(self.procedimento if self.procedimento_id else None, self.api_data_cirurgia)
+
+    def save(self, *args, **kwargs):
+        derived = ['data_efetiva']
+        # group is the single filter of every finance query: rows linked to a
+        # procedure inherit its group when none was given
+        if self.group_id is None and self.procedimento_id is not None:
+            self.group_id = self.procedimento.group_id
+            derived.append('group')
+        self.data_efetiva = self.compute_data_efetiva()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = list(set(update_fields).union(derived))
+        super().save(*args, **kwargs)
+
     def __str__(self):
         if self.procedimento:
             return f"Finanças (Vinculado) - {self.procedimento} - CPSA: {self.cpsa or 'N/A'}"
@@ -188,6 +246,21 @@ class ProcedimentoFinancas(models.Model):
             return glosa if glosa > 0 else 0
         return 0
 
+def sync_data_efetiva(procedimentos):
+    """
+    Refresh data_efetiva of the finance rows linked to procedimentos, with one
+    UPDATE per distinct date (queryset updates and bulk_update skip save()).
+    """
+    ids_by_date = {}
+    for procedimento in procedimentos:
+        ids_by_date.setdefault(data_efetiva_for(procedimento, None), []).append(procedimento.pk)
+    for day, ids in ids_by_date.items():
+        financas = ProcedimentoFinancas.objects.filter(procedimento_id__in=ids)
+        if day is not None:
+            financas = financas.exclude(data_efetiva=day)
+        financas.update(data_efetiva=day)
+
+
 class Despesas(models.Model):
     group = models.ForeignKey(
         'registration.Groups',
@@ -279,28 +352,62 @@ class DespesasRecorrentes(models.Model):
         return mapping.get(self.periodicidade, self.get_periodicidade_display())
 
 class ConciliacaoTentativa(models.Model):
+    """
+    Outcome of the last attempt to match an unlinked ProcedimentoFinancas.
+    candidatos maps each candidate procedure id to its atualizado_em at the
+    time; a failed attempt is not repeated while the guide fingerprint and
+    the candidates are unchanged.
+    """
     procedimento_financas = models.ForeignKey(ProcedimentoFinancas, on_delete=models.CASCADE)
     cpsa_id = models.CharField(max_length=255)
     conciliado = models.BooleanField(null=True)
     data_tentativa = models.DateTimeField(auto_now_add=True)
+    guia_fingerprint = models.CharField(max_length=64, blank=True)
+    candidatos = models.JSONField(default=dict, blank=True)
 
     class Meta:
         unique_together = ('procedimento_financas', 'cpsa_id')
 
 
 class ConciliacaoJob(models.Model):
-    """Tracks background conciliation jobs for async processing."""
+    """
+    Tracks background conciliation jobs for async processing.
+    Jobs are queued as 'pending' (by a gestor or by `manage.py conciliacao_scheduler`)
+    and claimed by `manage.py conciliacao_worker`.
+    """
     STATUS_CHOICES = [
         ('pending', 'Pendente'),
         ('running', 'Em Execução'),
         ('completed', 'Concluído'),
         ('failed', 'Falhou'),
     ]
+    TRIGGER_CHOICES = [
+        ('manual', 'Manual'),
+        ('scheduled', 'Agendado'),
+    ]
     
     group = models.ForeignKey(Groups, on_delete=models.CASCADE, related_name='conciliacao_jobs')
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    requested_by = models.ForeignKey(
+        'registration.CustomUser',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='conciliacao_jobs'
+    )
+    force_full = models.BooleanField(default=False)
+    trigger = models.CharField(max_length=20, choices=TRIGGER_CHOICES, default='manual')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', db_index=True)
     started_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
+
+    # Queue / worker bookkeeping
+    worker_id = models.CharField(max_length=255, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+    # Outcome of the last attempt: wall time and guide throughput
+    duration_seconds = models.FloatField(null=True, blank=True)
+    guias_per_second = models.FloatField(null=True, blank=True)
     
     # Progress tracking
     total_guias = models.IntegerField(default=0)
@@ -308,6 +415,22 @@ class ConciliacaoJob(models.Model):
     created_count = models.IntegerField(default=0)
     updated_count = models.IntegerField(default=0)
     linked_count = models.IntegerField(default=0)
+
+    # Incremental run: guides skipped by fingerprint, changed, and new CPSAs
+    skipped_count = models.IntegerField(default=0)
+    changed_count = models.IntegerField(default=0)
+    new_count = models.IntegerField(default=0)
+
+    # Matching index counters (candidate-set sizes scored per guide)
+    candidate_lookups = models.IntegerField(default=0)
+    candidate_total = models.IntegerField(default=0)
+    candidate_max = models.IntegerField(default=0)
+    
+    # Resume checkpoint: CPSAs whose writes are committed, per-window payload hashes
+    checkpoint_batch = models.IntegerField(default=0)
+    checkpoint_cpsas = models.JSONField(default=list, blank=True)
+    checkpoint_windows = models.JSONField(default=dict, blank=True)
+    payload_hash = models.CharField(max_length=64, blank=True)
     
     # Status message for UI
     current_step = models.CharField(max_length=255, default='Iniciando...')
@@ -325,3 +448,77 @@ class ConciliacaoJob(models.Model):
             return 0
         return int((self.processed_count / self.total_guias) * 100)
 
+    @property
+    def has_checkpoint(self):
+        return bool(self.checkpoint_cpsas)
+
+    @property
+    def candidate_avg(self):
+        if self.candidate_lookups == 0:
+            return 0
+        return round(self.candidate_total / self.candidate_lookups, 1)
+
+
+class ConciliacaoWatermark(models.Model):
+    """
+    Per-group inputs of the incremental conciliation start date, so a job
+    start reads one row instead of scanning ProcedimentoFinancas.
+    Maintained by financas.watermark.
+    """
+    group = models.OneToOneField(Groups, on_delete=models.CASCADE, primary_key=True, related_name='conciliacao_watermark')
+    last_completed_at = models.DateTimeField(null=True, blank=True)
+    # Oldest surgery date (local) of the group's finance rows still awaiting payment
+    oldest_pending_date = models.DateField(null=True, blank=True)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Watermark {self.group_id}: {self.last_completed_at} / {self.oldest_pending_date}"
+
+
+class ResumoFinanceiroMensal(models.Model):
+    """
+    Monthly rollup of ProcedimentoFinancas per (group, month, charge type,
+    payment status, surgeon, clinic type), read by the financial dashboard.
+
+    Rows with por_anestesista=False count every finance row once
+    (anestesista_id is null); rows with por_anestesista=True attribute each
+    row to every responsible anesthesiologist of its procedure, or to the
+    cooperado when there is none, as the anesthesiologist ranking does, and
+    leave charge type and status out (null) so that their procedure counts
+    add up across rows. Months are rebuilt from the finance rows by
+    financas.rollup.
+    """
+    group = models.ForeignKey(Groups, on_delete=models.CASCADE, related_name='resumos_financeiros')
+    mes = models.DateField()
+    tipo_cobranca = models.CharField(max_length=20, null=True, blank=True)
+    status_pagamento = models.CharField(max_length=20, null=True, blank=True)
+    cirurgiao_id = models.IntegerField(null=True, blank=True)
+    tipo_clinica = models.CharField(max_length=50, null=True, blank=True)
+    por_anestesista = models.BooleanField(default=False)
+    anestesista_id = models.IntegerField(null=True, blank=True)
+
+    quantidade = models.IntegerField(default=0)
+    quantidade_faturado = models.IntegerField(default=0)
+    procedimentos = models.IntegerField(default=0)
+    soma_faturado = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    soma_recebido = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    soma_recuperado = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    # valor_faturado minus received and recovered, over rows with valor_faturado
+    soma_glosa = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'por_anestesista', 'mes'], name='resumo_group_mes_idx'),
+        ]
+
+    def __str__(self):
+        return f"Resumo {self.group_id} {self.mes:%m/%Y} ({self.tipo_cobranca}, {self.status_pagamento})"
+
+
+class ResumoFinanceiroPendente(models.Model):
+    """(group, month) whose ResumoFinanceiroMensal rows must be rebuilt."""
+    group = models.ForeignKey(Groups, on_delete=models.CASCADE)
+    mes = models.DateField()
+
+    class Meta:
+        unique_together = ('group', 'mes')
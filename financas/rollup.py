@@ -0,0 +1,177 @@
+"""
+Monthly finance rollup (ResumoFinanceiroMensal) behind the financial dashboard.
+
+A (group, month) is always rebuilt as a whole from its ProcedimentoFinancas
+rows, one GROUP BY per scope, after it is marked dirty
+(ResumoFinanceiroPendente):
+
+- finance row saves and deletes, and edits of the linked procedures, mark
+  the months they touch (financas.signals);
+- the conciliation engine marks the months of its bulk writes in the flush
+  transaction, and the job rebuilds them when it finishes;
+- readers go through rollup_rows(), which rebuilds the group's dirty months
+  first.
+
+rollup_rows() serves any date range: whole months come from the rollup, the
+partial months at its edges are aggregated from the finance rows on the fly.
+Procedure counts are distinct per rollup row, so a procedure whose finance
+rows differ in charge type or status is counted once per row of the
+total scope; per-anesthesiologist rows leave charge type and status out, so
+their counts add up exactly.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+from .models import ProcedimentoFinancas, ResumoFinanceiroMensal, ResumoFinanceiroPendente
+
+
+DIMENSIONS = ('mes', 'tipo_cobranca', 'status_pagamento', 'cirurgiao_id', 'tipo_clinica', 'anestesista_id')
+MEASURES = (
+    'quantidade', 'quantidade_faturado', 'procedimentos',
+    'soma_faturado', 'soma_recebido', 'soma_recuperado', 'soma_glosa',
+)
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def _money(expression):
+    money = DecimalField(max_digits=15, decimal_places=2)
+    return Coalesce(Sum(expression, output_field=money), Value(Decimal('0')), output_field=money)
+
+
+def _aggregate(queryset, por_anestesista):
+    """Rollup-shaped dicts for the dated finance rows of queryset."""
+    queryset = queryset.filter(data_efetiva__isnull=False)
+    dimensions = {
+        'mes': TruncMonth('data_efetiva'),
+        'cirurgiao_id': F('procedimento__cirurgiao_id'),
+        'tipo_clinica': F('procedimento__tipo_clinica'),
+    }
+    measures = {
+        'quantidade': Count('id'),
+        'quantidade_faturado': Count('valor_faturado'),
+        'procedimentos': Count('procedimento', distinct=True),
+        'soma_faturado': _money('valor_faturado'),
+        'soma_recebido': _money('valor_recebido'),
+        'soma_recuperado': _money('valor_recuperado'),
+        # Null valor_faturado leaves the row out, as in the dashboard's glosa total
+        'soma_glosa': _money(F('valor_faturado') - Coalesce('valor_recebido', 0) - Coalesce('valor_recuperado', 0)),
+    }
+    if por_anestesista:
+        scopes = [
+            (queryset.filter(procedimento__anestesistas_responsaveis__isnull=False),
+             F('procedimento__anestesistas_responsaveis__id')),
+            (queryset.filter(procedimento__anestesistas_responsaveis__isnull=True, procedimento__cooperado__isnull=False),
+             F('procedimento__cooperado_id')),
+        ]
+    else:
+        scopes = [(queryset, None)]
+
+    rows = []
+    for scope, anestesista in scopes:
+        if anestesista is None:
+            grouped = scope.values('tipo_cobranca', 'status_pagamento', **dimensions)
+        else:
+            grouped = scope.values(**dimensions, anestesista_id=anestesista)
+        for row in grouped.annotate(**measures).order_by():
+            for dimension in DIMENSIONS:
+                row.setdefault(dimension, None)
+            row['por_anestesista'] = por_anestesista
+            rows.append(row)
+    return rows
+
+
+def rebuild_month(group_id, mes):
+    """Replace the rollup rows of one (group, month) with a fresh aggregation."""
+    finance = ProcedimentoFinancas.objects.filter(
+        group_id=group_id, data_efetiva__gte=mes, data_efetiva__lt=mes + relativedelta(months=1),
+    )
+    with transaction.atomic():
+        rows = _aggregate(finance, False) + _aggregate(finance, True)
+        ResumoFinanceiroMensal.objects.filter(group_id=group_id, mes=mes).delete()
+        ResumoFinanceiroMensal.objects.bulk_create([ResumoFinanceiroMensal(group_id=group_id, **row) for row in rows])
+    return len(rows)
+
+
+def mark_dirty(marks):
+    """marks: iterable of (group_id, date); the month of each date is rebuilt on the next read."""
+    pending = {(group_id, month_start(day)) for group_id, day in marks if group_id and day}
+    if pending:
+        ResumoFinanceiroPendente.objects.bulk_create(
+            [ResumoFinanceiroPendente(group_id=group_id, mes=mes) for group_id, mes in pending],
+            ignore_conflicts=True,
+        )
+
+
+def refresh_rollup(group):
+    """Rebuild the group's dirty months; returns how many were rebuilt."""
+    rebuilt = 0
+    for pendente in ResumoFinanceiroPendente.objects.filter(group=group).order_by('mes'):
+        with transaction.atomic():
+            # A concurrent reader may have taken this month already
+            deleted, _ = ResumoFinanceiroPendente.objects.filter(pk=pendente.pk).delete()
+            if deleted:
+                rebuild_month(pendente.group_id, pendente.mes)
+                rebuilt += 1
+    return rebuilt
+
+
+class RollupRows(list):
+    """Rollup dicts with in-memory filtering and totals."""
+
+    def where(self, **conditions):
+        """Keep rows matching every condition; 'dimension__in' takes a collection."""
+        def matches(row):
+            for key, value in conditions.items():
+                if key.endswith('__in'):
+                    if row[key[:-4]] not in value:
+                        return False
+                elif row[key] != value:
+                    return False
+            return True
+        return RollupRows(row for row in self if matches(row))
+
+    def total(self, measure):
+        return sum((row[measure] for row in self), Decimal('0') if measure.startswith('soma_') else 0)
+
+    def totals_by(self, dimension, measure):
+        totals = {}
+        for row in self:
+            totals[row[dimension]] = totals.get(row[dimension], 0) + row[measure]
+        return totals
+
+
+def rollup_rows(group, start, end=None, por_anestesista=False):
+    """
+    RollupRows for the finance rows of group dated from start to end,
+    inclusive (end=None leaves the range open).
+    """
+    refresh_rollup(group)
+    finance = ProcedimentoFinancas.objects.filter(group=group)
+    rows = RollupRows()
+
+    first_full = start if start.day == 1 else month_start(start) + relativedelta(months=1)
+    if start < first_full:
+        edge_end = first_full - timedelta(days=1)
+        if end is not None and end < edge_end:
+            edge_end = end
+        rows.extend(_aggregate(finance.filter(data_efetiva__range=(start, edge_end)), por_anestesista))
+
+    stored = ResumoFinanceiroMensal.objects.filter(group=group, por_anestesista=por_anestesista, mes__gte=first_full)
+    if end is not None:
+        after_full = month_start(end + timedelta(days=1))
+        stored = stored.filter(mes__lt=after_full)
+        edge_start = max(after_full, first_full)
+        if edge_start <= end:
+            rows.extend(_aggregate(finance.filter(data_efetiva__range=(edge_start, end)), por_anestesista))
+        if after_full <= first_full:
+            return rows
+    rows.extend(stored.values(*DIMENSIONS, *MEASURES))
+    return rows
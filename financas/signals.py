@@ -0,0 +1,115 @@
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+
+from agenda.models import Procedimento
+from registration.models import Anesthesiologist, Surgeon
+
+from .models import ProcedimentoFinancas, sync_data_efetiva
+from .rollup import mark_dirty
+from .watermark import PENDING_STATUSES, local_date, lower_oldest_pending
+
+
+def _rollup_marks(**lookup):
+    """(group_id, data_efetiva) of the finance rows matching lookup."""
+    return list(ProcedimentoFinancas.objects.filter(**lookup).values_list('group_id', 'data_efetiva').distinct())
+
+
+def financas_pending_watermark(sender, instance, **kwargs):
+    """A pending finance row may be older than its groups' watermarks."""
+    if instance.status_pagamento not in PENDING_STATUSES:
+        return
+    days = [day for day in (instance.api_data_cirurgia, instance.data_efetiva) if day]
+    if days:
+        lower_oldest_pending([instance.group_id], min(days))
+
+
+def financas_rollup(sender, instance, **kwargs):
+    """The month a finance row is reported under, and the one it was read under."""
+    marks = [(instance.group_id, instance.data_efetiva)]
+    loaded = getattr(instance, '_loaded_rollup_key', None)
+    if loaded:
+        marks.append(loaded)
+    mark_dirty(marks)
+
+
+def financas_deleted_rollup(sender, instance, **kwargs):
+    """The month stored for a deleted finance row (the instance may be stale)."""
+    mark_dirty(_rollup_marks(pk=instance.pk) + [(instance.group_id, instance.data_efetiva)])
+
+
+def procedimento_pending_watermark(sender, instance, **kwargs):
+    """Moving a procedure with pending finance rows may move the watermark back."""
+    if not instance.data_horario or kwargs.get('created'):
+        return
+    group_ids = set(
+        ProcedimentoFinancas.objects
+        .filter(procedimento=instance, status_pagamento__in=PENDING_STATUSES)
+        .values_list('group_id', flat=True)
+    )
+    if group_ids:
+        lower_oldest_pending(group_ids, local_date(instance.data_horario))
+
+
+def procedimento_data_efetiva(sender, instance, created=False, **kwargs):
+    """
+    Linked finance rows report under the procedure's date; their rollup months
+    before and after the save are rebuilt (surgeon, clinic type and cooperado
+    are rollup dimensions too).
+    """
+    if created:
+        return
+    marks = _rollup_marks(procedimento=instance)
+    if not marks:
+        return
+    sync_data_efetiva([instance])
+    new_day = local_date(instance.data_horario) if instance.data_horario else None
+    mark_dirty(marks + [(group_id, new_day) for group_id, _ in marks])
+
+
+def procedimento_deleted_data_efetiva(sender, instance, **kwargs):
+    """Finance rows unlinked by the delete (SET_NULL) fall back to the API date."""
+    marks = _rollup_marks(procedimento=instance)
+    if not marks:
+        return
+    financas = ProcedimentoFinancas.objects.filter(procedimento=instance)
+    marks += financas.values_list('group_id', 'api_data_cirurgia').distinct()
+    financas.update(data_efetiva=F('api_data_cirurgia'))
+    mark_dirty(marks)
+
+
+def responsaveis_rollup(sender, instance, action, reverse, pk_set, **kwargs):
+    """Responsible anesthesiologists split the per-anesthesiologist rollup."""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        mark_dirty(_rollup_marks(procedimento=instance))
+    elif action == 'pre_clear':
+        mark_dirty(_rollup_marks(procedimento__anestesistas_responsaveis=instance))
+    elif pk_set:
+        mark_dirty(_rollup_marks(procedimento_id__in=pk_set))
+
+
+def anesthesiologist_deleted_rollup(sender, instance, **kwargs):
+    """The delete drops responsibilities and cooperado links without m2m or save signals."""
+    mark_dirty(
+        _rollup_marks(procedimento__anestesistas_responsaveis=instance)
+        + _rollup_marks(procedimento__cooperado=instance)
+    )
+
+
+def surgeon_deleted_rollup(sender, instance, **kwargs):
+    """The delete clears Procedimento.cirurgiao (SET_NULL) without save signals."""
+    mark_dirty(_rollup_marks(procedimento__cirurgiao=instance))
+
+
+post_save.connect(financas_pending_watermark, sender=ProcedimentoFinancas, dispatch_uid='conciliacao_watermark_financas')
+post_save.connect(financas_rollup, sender=ProcedimentoFinancas, dispatch_uid='rollup_financas')
+pre_delete.connect(financas_deleted_rollup, sender=ProcedimentoFinancas, dispatch_uid='rollup_financas_delete')
+post_save.connect(procedimento_pending_watermark, sender=Procedimento, dispatch_uid='conciliacao_watermark_procedimento')
+post_save.connect(procedimento_data_efetiva, sender=Procedimento, dispatch_uid='data_efetiva_procedimento')
+pre_delete.connect(procedimento_deleted_data_efetiva, sender=Procedimento, dispatch_uid='data_efetiva_procedimento_delete')
+m2m_changed.connect(
+    responsaveis_rollup, sender=Procedimento.anestesistas_responsaveis.through, dispatch_uid='rollup_responsaveis',
+)
+pre_delete.connect(anesthesiologist_deleted_rollup, sender=Anesthesiologist, dispatch_uid='rollup_anesthesiologist_delete')
+pre_delete.connect(surgeon_deleted_rollup, sender=Surgeon, dispatch_uid='rollup_surgeon_delete')
@@ -1,10 +1,42 @@
-from django.test import TestCase
-from datetime import datetime, time
+import unittest
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from datetime import date, datetime, time, timedelta
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import itertools
+import json
+import threading
+from django.urls import reverse
 from django.utils import timezone
+from constants import GESTOR_USER
 import pytz
+from decimal import Decimal
 
-# Import the helper function from financas.views
-from financas.views import make_aware_sao_paulo, SAO_PAULO_TZ
+from financas.engine import (
+    SAO_PAULO_TZ, ConciliacaoEngine, JobProgressSink, _get_conciliation_start_date, find_comprehensive_procedure_match,
+    make_aware_sao_paulo,
+)
+from financas import views as financas_views
+from financas.matching import NameSimilarity, ProcedureMatchIndex, first_similar, similar
+from financas import guias as guias_source
+from financas.guias import guia_fingerprint
+from financas.benchmark import run_benchmark
+from financas import jobs as conciliacao_jobs
+from financas.jobs import ConciliacaoCheckpoint
+from financas.models import (
+    ConciliacaoJob, ConciliacaoTentativa, ProcedimentoFinancas, ResumoFinanceiroMensal, ResumoFinanceiroPendente,
+)
+from financas.rollup import refresh_rollup, rollup_rows
+from financas.watermark import get_watermark, refresh_watermark
+from agenda.entities import clear_entity_cache
+from agenda.models import Procedimento
+from registration.models import Groups, Anesthesiologist, HospitalClinic, CustomUser, Membership, Surgeon
 
 
 class TimezoneHelperTest(TestCase):
@@ -56,3 +88,1129 @@ class TimezoneHelperTest(TestCase):
         utc_time = aware_time.astimezone(pytz.UTC)
         self.assertEqual(utc_time.hour, 13)  # 10:30 - (-3h) = 13:30 UTC
         self.assertEqual(utc_time.minute, 30)
+
+
+class ProcedureMatchIndexTest(TestCase):
+    """
+    Testes do índice de candidatos usado na conciliação guia -> procedimento.
+    """
+
+    def _proc(self, nome, dt):
+        return Procedimento(nome_paciente=nome, data_horario=make_aware_sao_paulo(dt))
+
+    def test_candidates_limited_to_date_window_and_name_keys(self):
+        mesmo_dia = self._proc('Maria da Silva', datetime(2025, 3, 10, 10, 0))
+        dia_seguinte = self._proc('Maria Silva', datetime(2025, 3, 11, 10, 0))
+        longe = self._proc('Maria da Silva', datetime(2025, 3, 20, 10, 0))
+        outro_nome = self._proc('João Pereira', datetime(2025, 3, 10, 10, 0))
+        index = ProcedureMatchIndex([mesmo_dia, dia_seguinte, longe, outro_nome])
+
+        candidates = index.candidates('MARIA DA SILVA', datetime(2025, 3, 10).date())
+
+        self.assertEqual(candidates, [mesmo_dia, dia_seguinte])
+        self.assertEqual(index.lookups, 1)
+        self.assertEqual(index.candidates_max, 2)
+
+    def test_phonetic_key_bridges_spelling_variants(self):
+        proc = self._proc('Thiago Souza', datetime(2025, 3, 10, 10, 0))
+        index = ProcedureMatchIndex([proc])
+
+        self.assertEqual(index.candidates('Tiago Sousa', datetime(2025, 3, 10).date()), [proc])
+
+    def test_record_stats_copies_counters_to_job(self):
+        index = ProcedureMatchIndex([self._proc('Ana Lima', datetime(2025, 3, 10, 10, 0))])
+        index.candidates('Ana Lima', datetime(2025, 3, 10).date())
+        index.candidates('Ana Lima', datetime(2025, 5, 10).date())
+
+        job = ConciliacaoJob()
+        index.record_stats(job)
+
+        self.assertEqual(job.candidate_lookups, 2)
+        self.assertEqual(job.candidate_total, 1)
+        self.assertEqual(job.candidate_max, 1)
+        self.assertEqual(job.candidate_avg, 0.5)
+
+
+class NameSimilarityTest(TestCase):
+    """
+    Similaridade em lote: mesmos scores de similar() e poda pelo limite superior.
+    """
+
+    NAMES = ['Joana Prado', 'joana prada', 'Pedro Alves', '', 'Maria da Silva', 'Maria Silva']
+
+    def test_scores_match_similar_above_threshold(self):
+        engine = NameSimilarity(self.NAMES)
+        for query in ['Joana Prado', 'MARIA SILVA', 'Pedro Alvez', '']:
+            scores = engine.scores(query, 0.7)
+            for name, score in zip(self.NAMES, scores):
+                expected = similar(query, name)
+                if expected >= 0.7:
+                    self.assertEqual(score, expected)
+                else:
+                    self.assertLess(score, 0.7)
+
+    def test_upper_bounds_never_below_exact_score(self):
+        engine = NameSimilarity(self.NAMES)
+        bounds = engine.upper_bounds('Maria Prado')
+        for name, bound in zip(self.NAMES, bounds):
+            self.assertGreaterEqual(bound, similar('Maria Prado', name))
+
+    def test_best_and_first_follow_loop_semantics(self):
+        engine = NameSimilarity(self.NAMES)
+        self.assertEqual(engine.best('joana prado', 0.8), 0)
+        self.assertEqual(engine.first('maria silva', 0.85), 4)
+        self.assertIsNone(engine.first('Xavier', 0.85))
+        self.assertIsNone(NameSimilarity([]).best('Joana', 0.7))
+        self.assertEqual(first_similar('pedro alvez', {'joana prado': 1, 'pedro alves': 2}, 0.85), 2)
+
+
+class ComprehensiveMatchQueryCountTest(TestCase):
+    """
+    O laço de pontuação da conciliação não deve fazer nenhuma consulta ao banco:
+    nomes dos anestesistas são pré-carregados pelo índice em uma única consulta.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Conciliação')
+        self.hospital = HospitalClinic.objects.create(name='Hospital Central', group=self.group)
+        self.anest = Anesthesiologist.objects.create(name='Carlos Mendes', group=self.group)
+        for hora in (3, 10, 18):
+            proc = Procedimento.objects.create(
+                group=self.group,
+                nome_paciente='Paciente Teste',
+                hospital=self.hospital,
+                data_horario=make_aware_sao_paulo(datetime(2025, 4, 2, hora, 0)),
+            )
+            proc.anestesistas_responsaveis.add(self.anest)
+
+    def test_scoring_loop_makes_no_queries(self):
+        procs_qs = Procedimento.objects.filter(group=self.group).select_related('hospital', 'convenio')
+        procs = list(procs_qs)
+        index = ProcedureMatchIndex(procs)
+        with self.assertNumQueries(1):
+            index.load_anesthesiologist_names(procs_qs)
+
+        guia = {
+            'paciente': 'PACIENTE TESTE',
+            'dt_cirurg': '2025-04-02',
+            'hora_inicial': '10:00',
+            'hospital': 'Hospital Central',
+            'cooperado': 'CARLOS MENDES',
+        }
+        with self.assertNumQueries(0):
+            match = find_comprehensive_procedure_match(
+                index.candidates('PACIENTE TESTE', datetime(2025, 4, 2).date()),
+                guia, self.group, index.anesthesiologist_names,
+            )
+
+        self.assertEqual(match, procs[1])
+        self.assertEqual(index.anesthesiologist_names[match.pk], ('carlos mendes',))
+
+
+class GuiasSourceTest(TestCase):
+    """
+    Testes da fonte de guias paginada por mês (ajaxGuias.php).
+    """
+
+    def test_month_windows_newest_first_and_clipped(self):
+        windows = guias_source.month_windows(date(2025, 1, 15), date(2025, 3, 10))
+        self.assertEqual(windows, [
+            (date(2025, 3, 1), date(2025, 3, 10)),
+            (date(2025, 2, 1), date(2025, 2, 28)),
+            (date(2025, 1, 15), date(2025, 1, 31)),
+        ])
+
+    def test_unparseable_dates_and_times_are_logged(self):
+        with self.assertLogs('financas.guias', level='WARNING') as logs:
+            self.assertIsNone(guias_source.parse_api_date('03/02/2025'))
+            self.assertIsNone(guias_source.parse_api_time('manhã'))
+        self.assertEqual(len(logs.records), 2)
+
+    def test_iter_guias_streams_windows_and_skips_repeated_cpsa(self):
+        pages = {
+            date(2025, 2, 1): [
+                {'nrocpsa': '2', 'dt_cirurg': '2025-02-03'},
+                {'nrocpsa': '3', 'dt_cirurg': '2025-02-10'},
+            ],
+            date(2025, 1, 1): [
+                {'nrocpsa': '1', 'dt_cirurg': '2025-01-05'},
+                {'nrocpsa': '2', 'dt_cirurg': '2025-01-31'},
+                {'nrocpsa': '', 'dt_cirurg': '2025-01-20'},
+            ],
+        }
+        windows_seen = []
+
+        def fake_fetch(connection_key, periodo_de, periodo_ate, session=None, base_url=None):
+            return pages[periodo_de]
+
+        with mock.patch.object(guias_source, 'fetch_guias_window', side_effect=fake_fetch):
+            items = guias_source.iter_guias(
+                'chave', date(2025, 1, 1), date(2025, 2, 28),
+                on_window=lambda de, ate, count, window_hash: windows_seen.append((de, count)),
+            )
+            self.assertEqual(windows_seen, [])  # nothing fetched until consumed
+            cpsa_ids = [cpsa_id for cpsa_id, _ in items]
+
+        self.assertEqual(cpsa_ids, ['3', '2', '1'])
+        self.assertEqual(windows_seen, [(date(2025, 2, 1), 2), (date(2025, 1, 1), 1)])
+
+
+class _StubGuiasHandler(BaseHTTPRequestHandler):
+    """ajaxGuias.php falso: responde por periodo_de e falha uma vez na janela configurada."""
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.requests_seen.append(payload['periodo_de'])
+            fail = payload['periodo_de'] in server.fail_once
+            server.fail_once.discard(payload['periodo_de'])
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({'erro': '000', 'listaguias': server.pages.get(payload['periodo_de'], [])}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ParallelGuiasFetchTest(TestCase):
+    """
+    Busca paralela por janelas contra um servidor HTTP local.
+    """
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubGuiasHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests_seen = []
+        self.server.fail_once = {'2025-02-01'}
+        self.server.pages = {
+            '2025-03-01': [{'nrocpsa': '30', 'dt_cirurg': '2025-03-02'}],
+            '2025-02-01': [{'nrocpsa': '20', 'dt_cirurg': '2025-02-02'}, {'nrocpsa': '30', 'dt_cirurg': '2025-02-28'}],
+            '2025-01-01': [{'nrocpsa': '10', 'dt_cirurg': '2025-01-02'}],
+        }
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_windows_fetched_concurrently_retried_and_merged_by_cpsa(self):
+        items = list(guias_source.iter_guias(
+            'chave', date(2025, 1, 1), date(2025, 3, 31), base_url=self.base_url,
+            max_workers=3, retries=2, retry_backoff=0,
+        ))
+
+        self.assertEqual([cpsa_id for cpsa_id, _ in items], ['30', '20', '10'])
+        self.assertEqual(items[0][1]['dt_cirurg'], '2025-03-02')
+        self.assertEqual(self.server.requests_seen.count('2025-02-01'), 2)
+
+    def test_exhausted_retries_raise(self):
+        self.server.fail_once = {'2025-01-01'}
+        with self.assertRaises(guias_source.requests.exceptions.HTTPError):
+            list(guias_source.iter_guias(
+                'chave', date(2025, 1, 1), date(2025, 1, 31), base_url=self.base_url,
+                max_workers=1, retries=0, retry_backoff=0,
+            ))
+
+
+class ExecuteConciliationLogicTest(TestCase):
+    """
+    Teste ponta a ponta do motor de conciliação em background com guias em memória.
+    """
+
+    def setUp(self):
+        clear_entity_cache()
+        self.group = Groups.objects.create(name='Grupo Motor')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_motor', email='gestor_motor@teste.com', password='x', group=self.group
+        )
+        self.proc = Procedimento.objects.create(
+            group=self.group,
+            nome_paciente='Joana Prado',
+            data_horario=make_aware_sao_paulo(datetime(2025, 5, 6, 9, 0)),
+        )
+        self.existing = ProcedimentoFinancas.objects.create(
+            group=self.group, procedimento=self.proc, tipo_cobranca='cooperativa',
+            cpsa='100', valor_faturado=Decimal('100.00'),
+        )
+
+    def _run(self, job, guias_items, **kwargs):
+        return ConciliacaoEngine(self.group, sinks=[JobProgressSink(job)], **kwargs).run(guias_items)
+
+    def _guia(self, cpsa, paciente, dt, **extra):
+        guia = {
+            'nrocpsa': cpsa, 'paciente': paciente, 'dt_cirurg': dt, 'hora_inicial': '09:00',
+            'hospital': 'Hospital Motor', 'cooperado': 'Ana Coop', 'STATUS': 'Aguardando Pagamento',
+            'valor_faturado': '150.00',
+        }
+        guia.update(extra)
+        return guia
+
+    def test_updates_existing_and_creates_new_from_generator(self):
+        guias = [
+            ('100', self._guia('100', 'Joana Prado', '2025-05-06')),
+            ('200', self._guia('200', 'Pedro Alves', '2025-05-07')),
+        ]
+        job = ConciliacaoJob.objects.create(group=self.group)
+
+        self._run(job, iter(guias), start_date=date(2025, 1, 1))
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.valor_faturado, Decimal('150.00'))
+        self.assertEqual(self.existing.status_pagamento, 'aguardando_pagamento')
+        novo = ProcedimentoFinancas.objects.get(cpsa='200')
+        self.assertEqual(novo.procedimento.nome_paciente, 'Pedro Alves')
+        self.assertEqual(novo.group, self.group)
+        job.refresh_from_db()
+        self.assertEqual(job.processed_count, 2)
+
+    def _run_charges_of_one_surgery(self):
+        guias = [
+            ('200', self._guia('200', 'Pedro Alves', '2025-05-07')),
+            ('201', self._guia('201', 'Pedro Alves', '2025-05-07', valor_faturado='80.00')),
+        ]
+        job = ConciliacaoJob.objects.create(group=self.group)
+        self._run(job, iter(guias), start_date=date(2025, 1, 1))
+        job.refresh_from_db()
+        return job
+
+    def test_charges_of_one_new_surgery_share_its_procedure(self):
+        job = self._run_charges_of_one_surgery()
+
+        procs = Procedimento.objects.filter(group=self.group, nome_paciente='Pedro Alves')
+        self.assertEqual(procs.count(), 1)
+        self.assertEqual(
+            set(ProcedimentoFinancas.objects.filter(cpsa__in=['200', '201']).values_list('procedimento', flat=True)),
+            {procs.get().pk},
+        )
+        self.assertEqual((job.created_count, job.linked_count), (1, 1))
+
+    def test_charges_of_one_new_surgery_share_its_procedure_across_flushes(self):
+        with mock.patch.object(conciliacao_jobs, 'FLUSH_MAX_ROWS', 1):
+            self._run_charges_of_one_surgery()
+
+        procs = Procedimento.objects.filter(group=self.group, nome_paciente='Pedro Alves')
+        self.assertEqual(procs.count(), 1)
+        self.assertEqual(ProcedimentoFinancas.objects.filter(procedimento=procs.get()).count(), 2)
+
+    def test_unchanged_unlinked_guides_are_not_counted_as_changed(self):
+        orphan = ProcedimentoFinancas.objects.create(
+            group=self.group, tipo_cobranca='cooperativa', cpsa='300', valor_faturado=Decimal('150.00'),
+        )
+        guias = [('300', self._guia('300', 'Sem Procedimento', '2025-05-08'))]
+        orphan.api_fingerprint = guia_fingerprint(guias[0][1])
+        orphan.save()
+        job = ConciliacaoJob.objects.create(group=self.group)
+
+        self._run(job, iter(guias), start_date=date(2025, 1, 1))
+
+        job.refresh_from_db()
+        self.assertEqual((job.skipped_count, job.changed_count, job.new_count), (0, 0, 0))
+        self.assertEqual(job.processed_count, 1)
+
+    def test_changed_guide_updates_linked_procedure(self):
+        guias = [('100', self._guia('100', 'Joana Prado', '2025-05-06', hora_inicial='14:30', cirurgiao='Carlos Mendes'))]
+        job = ConciliacaoJob.objects.create(group=self.group)
+
+        self._run(job, iter(guias), start_date=date(2025, 1, 1))
+
+        self.proc.refresh_from_db()
+        self.assertEqual(self.proc.data_horario, make_aware_sao_paulo(datetime(2025, 5, 6, 14, 30)))
+        self.assertEqual(self.proc.cirurgiao.name, 'Carlos Mendes')
+        self.assertEqual(self.proc.cooperado.name, 'Ana Coop')
+
+    def test_guide_changes_read_only_by_the_procedure_update_are_not_skipped(self):
+        guias = [('100', self._guia('100', 'Joana Prado', '2025-05-06'))]
+        self._run(ConciliacaoJob.objects.create(group=self.group), iter(guias), start_date=date(2025, 1, 1))
+
+        guias[0][1].update(
+            hora_inicial='15:45', cirurgiao='Carlos Mendes',
+            procedimentos=[{'codigo': '31005497', 'descricao': 'Colecistectomia'}],
+        )
+        job = ConciliacaoJob.objects.create(group=self.group)
+        self._run(job, iter(guias), start_date=date(2025, 1, 1))
+
+        self.assertEqual((job.skipped_count, job.changed_count), (0, 1))
+        self.proc.refresh_from_db()
+        self.assertEqual(self.proc.data_horario, make_aware_sao_paulo(datetime(2025, 5, 6, 15, 45)))
+        self.assertEqual(self.proc.cirurgiao.name, 'Carlos Mendes')
+        self.assertEqual(self.proc.procedimento_principal.codigo_procedimento, '31005497')
+
+    def test_changed_linked_guides_match_people_like_find_or_create(self):
+        surgeon = Surgeon.objects.create(name='Dr. Joao Carlos da Silva Pereira', crm='555', group=self.group)
+        cooperado = Anesthesiologist.objects.create(name='Ana Beatriz Coop', group=self.group)
+        guias = [('100', self._guia(
+            '100', 'Joana Prado', '2025-05-06', cirurgiao='Joao C. Silva Pereira', crm_cirurgiao='555',
+            cooperado='Ana B. Coop',
+        ))]
+
+        self._run(ConciliacaoJob.objects.create(group=self.group), iter(guias), start_date=date(2025, 1, 1))
+
+        self.proc.refresh_from_db()
+        self.assertEqual(self.proc.cirurgiao, surgeon)
+        self.assertEqual(self.proc.cooperado, cooperado)
+        self.assertEqual(Surgeon.objects.filter(group=self.group).count(), 1)
+        self.assertEqual(Anesthesiologist.objects.filter(group=self.group).count(), 1)
+
+    def test_new_guides_without_patient_or_date_are_not_counted_as_new(self):
+        guias = [
+            ('400', self._guia('400', '', '2025-05-09')),
+            ('401', self._guia('401', 'Sem Data', '')),
+            ('402', self._guia('402', 'Rita Lima', '2025-05-09')),
+        ]
+        job = ConciliacaoJob.objects.create(group=self.group)
+
+        self._run(job, iter(guias), start_date=date(2025, 1, 1))
+
+        job.refresh_from_db()
+        self.assertEqual((job.processed_count, job.new_count), (3, 1))
+
+    def test_unchanged_guides_skipped_by_fingerprint(self):
+        guias = [
+            ('100', self._guia('100', 'Joana Prado', '2025-05-06')),
+            ('200', self._guia('200', 'Pedro Alves', '2025-05-07')),
+        ]
+        first = ConciliacaoJob.objects.create(group=self.group)
+        self._run(first, iter(guias), start_date=date(2025, 1, 1))
+        self.assertEqual((first.skipped_count, first.changed_count, first.new_count), (0, 1, 1))
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.api_fingerprint, guia_fingerprint(guias[0][1]))
+
+        guias[1][1]['STATUS'] = 'Processo Finalizado'
+        second = ConciliacaoJob.objects.create(group=self.group)
+        self._run(second, iter(guias), start_date=date(2025, 1, 1))
+
+        self.assertEqual((second.skipped_count, second.changed_count, second.new_count), (1, 1, 0))
+        self.assertEqual(second.updated_count, 1)
+        self.assertEqual(second.processed_count, 2)
+        self.assertEqual(ProcedimentoFinancas.objects.get(cpsa='200').status_pagamento, 'processo_finalizado')
+
+    def test_small_flush_threshold_flushes_between_guides(self):
+        guias = [
+            ('100', self._guia('100', 'Joana Prado', '2025-05-06')),
+            ('200', self._guia('200', 'Pedro Alves', '2025-05-07')),
+            ('300', self._guia('300', 'Rita Lopes', '2025-05-08')),
+        ]
+        job = ConciliacaoJob.objects.create(group=self.group)
+
+        with mock.patch.object(conciliacao_jobs, 'FLUSH_MAX_ROWS', 1):
+            self._run(job, iter(guias), start_date=date(2025, 1, 1))
+
+        job.refresh_from_db()
+        self.assertEqual(job.created_count, 2)
+        self.assertEqual(job.updated_count, 1)
+        self.assertEqual(job.processed_count, 3)
+        self.assertEqual(ProcedimentoFinancas.objects.filter(group=self.group).count(), 3)
+
+    def _resume_job(self, saved_hash, current_hash):
+        guias = [
+            ('100', self._guia('100', 'Joana Prado', '2025-05-06')),
+            ('200', self._guia('200', 'Pedro Alves', '2025-05-07')),
+        ]
+        job = ConciliacaoJob.objects.create(
+            group=self.group, checkpoint_batch=1, checkpoint_cpsas=['100'],
+            checkpoint_windows={'2025-05-01': saved_hash},
+        )
+        checkpoint = ConciliacaoCheckpoint(job)
+        checkpoint.on_window(date(2025, 5, 1), date(2025, 5, 31), len(guias), current_hash)
+        self._run(job, iter(guias), start_date=date(2025, 1, 1), checkpoint=checkpoint)
+        job.refresh_from_db()
+        return job, checkpoint
+
+    def test_checkpoint_skips_committed_guides_of_unchanged_window(self):
+        job, checkpoint = self._resume_job('hash-a', 'hash-a')
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.valor_faturado, Decimal('100.00'))
+        self.assertTrue(ProcedimentoFinancas.objects.filter(cpsa='200').exists())
+        self.assertEqual(checkpoint.skipped, 1)
+        self.assertEqual(job.processed_count, 2)
+        self.assertEqual(job.checkpoint_cpsas, ['100', '200'])
+        self.assertEqual(job.checkpoint_batch, 2)
+        self.assertEqual(job.checkpoint_windows, {'2025-05-01': 'hash-a'})
+
+    def test_checkpoint_reprocesses_window_whose_payload_changed(self):
+        job, checkpoint = self._resume_job('hash-a', 'hash-b')
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.valor_faturado, Decimal('150.00'))
+        self.assertEqual(checkpoint.skipped, 0)
+        self.assertEqual(job.checkpoint_windows, {'2025-05-01': 'hash-b'})
+
+    def test_entities_of_new_guides_created_in_first_pass(self):
+        procedimentos = [{'codigo': '31005497', 'descricao': 'Colecistectomia'}]
+        guias = [
+            (cpsa, self._guia(
+                cpsa, paciente, dt, hospital='Hospital Novo', cirurgiao=cirurgiao,
+                crm_cirurgiao='1234', procedimentos=procedimentos,
+            ))
+            for cpsa, paciente, dt, cirurgiao in [
+                ('200', 'Pedro Alves', '2025-05-07', 'Carlos Mendes'),
+                ('300', 'Rita Lopes', '2025-05-08', 'Carlos Mendez'),
+                ('400', 'Luis Souza', '2025-05-09', 'carlos mendes'),
+            ]
+        ]
+        job = ConciliacaoJob.objects.create(group=self.group)
+
+        with mock.patch('financas.engine.Surgeon.objects.create') as create_surgeon:
+            self._run(job, iter(guias), start_date=date(2025, 1, 1))
+        create_surgeon.assert_not_called()
+
+        procs = Procedimento.objects.filter(financas_records__cpsa__in=['200', '300', '400'])
+        self.assertEqual(procs.count(), 3)
+        self.assertEqual({p.cirurgiao.name for p in procs}, {'Carlos Mendes'})
+        self.assertEqual({p.hospital.name for p in procs}, {'Hospital Novo'})
+        self.assertEqual({p.procedimento_principal.codigo_procedimento for p in procs}, {'31005497'})
+        self.assertEqual(HospitalClinic.objects.filter(name='Hospital Novo').count(), 1)
+        self.assertEqual(Anesthesiologist.objects.filter(group=self.group, name='Ana Coop').count(), 1)
+        self.assertEqual(
+            set(ProcedimentoFinancas.objects.filter(cpsa__in=['200', '300', '400']).values_list('data_efetiva', flat=True)),
+            {date(2025, 5, 7), date(2025, 5, 8), date(2025, 5, 9)},
+        )
+
+    def test_failed_match_not_repeated_until_candidate_changes(self):
+        proc = Procedimento.objects.create(
+            group=self.group, nome_paciente='Marcos Lima',
+            data_horario=make_aware_sao_paulo(datetime(2025, 5, 10, 15, 0)),
+        )
+        unlinked = ProcedimentoFinancas.objects.create(group=self.group, tipo_cobranca='cooperativa', cpsa='500')
+        guias = [('500', self._guia('500', 'Marcos Lima', '2025-05-10'))]
+
+        def run():
+            job = ConciliacaoJob.objects.create(group=self.group)
+            with mock.patch(
+                'financas.engine.find_comprehensive_procedure_match', wraps=find_comprehensive_procedure_match
+            ) as match:
+                engine = self._run(job, iter(guias), start_date=date(2025, 1, 1))
+            return engine, match.call_count
+
+        engine, calls = run()
+        self.assertEqual((calls, engine.memo_hits), (1, 0))
+        tentativa = ConciliacaoTentativa.objects.get(procedimento_financas=unlinked)
+        self.assertFalse(tentativa.conciliado)
+        self.assertEqual(list(tentativa.candidatos), [str(proc.pk)])
+
+        engine, calls = run()
+        self.assertEqual((calls, engine.memo_hits), (0, 1))
+
+        proc.data_horario = make_aware_sao_paulo(datetime(2025, 5, 10, 9, 0))
+        proc.save()
+        engine, calls = run()
+        self.assertEqual(calls, 1)
+        unlinked.refresh_from_db()
+        self.assertEqual(unlinked.procedimento, proc)
+        self.assertTrue(ConciliacaoTentativa.objects.get(procedimento_financas=unlinked).conciliado)
+
+
+class FlushSchedulerTest(TestCase):
+    """
+    Agendador de flush por linhas/tempo e limitador de gravações de progresso.
+    """
+
+    def setUp(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def test_due_by_row_count_or_elapsed_time(self):
+        scheduler = conciliacao_jobs.FlushScheduler(max_rows=500, max_seconds=2, clock=self.clock)
+        self.assertFalse(scheduler.due(499))
+        self.assertTrue(scheduler.due(500))
+
+        self.now = 2.0
+        self.assertTrue(scheduler.due(1))
+        scheduler.flushed()
+        self.assertFalse(scheduler.due(1))
+        self.assertEqual(scheduler.flushes, 1)
+
+    def test_progress_throttle(self):
+        throttle = conciliacao_jobs.ProgressThrottle(min_seconds=1, clock=self.clock)
+        self.assertFalse(throttle.due())
+        self.now = 1.5
+        self.assertTrue(throttle.due())
+        throttle.saved()
+        self.assertFalse(throttle.due())
+
+
+class ConciliacaoBenchmarkTest(TestCase):
+    """
+    Harness de benchmark: gera guias sintéticas e mede a conciliação sem deixar dados.
+    """
+
+    def test_run_benchmark_reports_phases_and_rolls_back(self):
+        groups_before = Groups.objects.count()
+
+        result = run_benchmark(guias=40, existing_ratio=0.5, noise_rate=0.2, date_spread_days=40, seed=1)
+
+        self.assertEqual(result['job']['processed_count'], 40)
+        self.assertEqual(
+            result['job']['skipped_count'] + result['job']['changed_count'] + result['job']['new_count'], 40
+        )
+        self.assertIn('fetch', result['phases'])
+        self.assertIn('flush', result['phases'])
+        self.assertGreater(result['queries'], 0)
+        self.assertGreater(result['peak_memory_bytes'], 0)
+        json.dumps(result)
+        self.assertEqual(Groups.objects.count(), groups_before)
+        self.assertFalse(ProcedimentoFinancas.objects.filter(cpsa__startswith='9000').exists())
+
+
+class ConciliacaoJobQueueTest(TestCase):
+    """
+    Fila de jobs de conciliação: claim, heartbeat vencido e reenfileiramento.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Fila')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_fila', email='gestor_fila@teste.com', password='x', group=self.group
+        )
+
+    def test_claim_marks_job_running_and_is_exclusive(self):
+        job = conciliacao_jobs.enqueue_conciliacao(self.group, self.user, force_full=True)
+
+        claimed = conciliacao_jobs.claim_next_job('worker-a')
+
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.status, 'running')
+        self.assertEqual(claimed.worker_id, 'worker-a')
+        self.assertEqual(claimed.attempts, 1)
+        self.assertTrue(claimed.force_full)
+        self.assertIsNone(conciliacao_jobs.claim_next_job('worker-b'))
+
+    def test_stale_heartbeat_requeues_then_fails_after_max_attempts(self):
+        job = conciliacao_jobs.enqueue_conciliacao(self.group, self.user)
+        conciliacao_jobs.claim_next_job('worker-a')
+        ConciliacaoJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(minutes=10))
+
+        self.assertEqual(conciliacao_jobs.requeue_abandoned_jobs(max_attempts=2), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(job.worker_id, '')
+
+        conciliacao_jobs.claim_next_job('worker-b')
+        ConciliacaoJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(conciliacao_jobs.requeue_abandoned_jobs(max_attempts=2), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+
+    def test_fresh_heartbeat_is_left_alone(self):
+        conciliacao_jobs.enqueue_conciliacao(self.group, self.user)
+        conciliacao_jobs.claim_next_job('worker-a')
+        self.assertEqual(conciliacao_jobs.requeue_abandoned_jobs(), (0, 0))
+        self.assertEqual(conciliacao_jobs.active_job_for_group(self.group).status, 'running')
+
+    def test_enqueue_inherits_checkpoint_of_recent_failed_job(self):
+        ConciliacaoJob.objects.create(
+            group=self.group, status='failed', checkpoint_batch=3,
+            checkpoint_cpsas=['1', '2'], checkpoint_windows={'2025-05-01': 'hash-a'},
+        )
+
+        job = conciliacao_jobs.enqueue_conciliacao(self.group, self.user)
+        self.assertEqual(job.checkpoint_cpsas, ['1', '2'])
+        self.assertEqual(job.checkpoint_batch, 3)
+
+        full = conciliacao_jobs.enqueue_conciliacao(self.group, self.user, force_full=True)
+        self.assertFalse(full.has_checkpoint)
+
+    def test_wait_for_job_returns_when_finished_or_timed_out(self):
+        job = conciliacao_jobs.enqueue_conciliacao(self.group, self.user)
+        self.assertEqual(conciliacao_jobs.wait_for_job(job, 0).status, 'pending')
+
+        ConciliacaoJob.objects.filter(pk=job.pk).update(status='completed')
+        self.assertEqual(conciliacao_jobs.wait_for_job(job, 30, poll_interval=0).status, 'completed')
+
+
+class ConciliacaoSchedulerTest(TestCase):
+    """
+    Agendador noturno: grupos elegíveis, ordem justa, limite global e métricas do job.
+    """
+
+    def _group_with_gestor(self, name, validado=True, connection_key='chave'):
+        group = Groups.objects.create(name=name)
+        user = CustomUser.objects.create_user(
+            username=f'gestor_{name}', email=f'gestor_{name}@teste.com', password='x', group=group,
+            validado=validado, connection_key=connection_key,
+        )
+        Membership.objects.create(user=user, group=group, role=GESTOR_USER, validado=True)
+        return group, user
+
+    def test_schedules_groups_with_valid_key_least_recently_conciliated_first(self):
+        recent, _ = self._group_with_gestor('Recente')
+        old, _ = self._group_with_gestor('Antigo')
+        never, never_user = self._group_with_gestor('Nunca')
+        busy, _ = self._group_with_gestor('Ocupado')
+        self._group_with_gestor('Sem Chave', connection_key='')
+        self._group_with_gestor('Nao Validado', validado=False)
+        ConciliacaoJob.objects.create(group=recent, status='completed', completed_at=timezone.now())
+        ConciliacaoJob.objects.create(group=old, status='completed', completed_at=timezone.now() - timedelta(days=3))
+        ConciliacaoJob.objects.create(group=busy, status='running')
+
+        jobs, skipped = conciliacao_jobs.schedule_conciliacoes()
+
+        self.assertEqual([job.group for job in jobs], [never, old, recent])
+        self.assertEqual(skipped, [busy])
+        self.assertEqual(jobs[0].requested_by, never_user)
+        self.assertTrue(all(job.trigger == 'scheduled' and not job.force_full for job in jobs))
+        self.assertEqual(conciliacao_jobs.schedule_conciliacoes()[0], [])
+
+    def test_claim_respects_job_ids_and_global_running_limit(self):
+        group_a, user_a = self._group_with_gestor('A')
+        group_b, user_b = self._group_with_gestor('B')
+        manual = conciliacao_jobs.enqueue_conciliacao(group_a, user_a)
+        scheduled = conciliacao_jobs.enqueue_conciliacao(group_b, user_b, trigger='scheduled')
+
+        self.assertEqual(conciliacao_jobs.claim_next_job('w', job_ids=[scheduled.pk]).pk, scheduled.pk)
+        self.assertIsNone(conciliacao_jobs.claim_next_job('w', max_running=1))
+        self.assertEqual(conciliacao_jobs.claim_next_job('w', max_running=2).pk, manual.pk)
+
+    def test_worker_alongside_the_scheduler_keeps_its_running_limit(self):
+        for name in ('Noite A', 'Noite B', 'Noite C'):
+            self._group_with_gestor(name)
+        scheduled, _ = conciliacao_jobs.schedule_conciliacoes()
+        # The scheduler has started one job, which is its limit
+        self.assertIsNotNone(
+            conciliacao_jobs.claim_next_job('scheduler', job_ids=[job.pk for job in scheduled], max_running=1)
+        )
+
+        ran = []
+        worker = 'financas.management.commands.conciliacao_worker'
+        with mock.patch(f'{worker}.run_job', side_effect=ran.append), mock.patch(f'{worker}.signal'):
+            call_command('conciliacao_worker', '--once', '--max-running', '1', stdout=io.StringIO())
+            self.assertEqual(ran, [])
+            self.assertEqual(ConciliacaoJob.objects.filter(status='pending', trigger='scheduled').count(), 2)
+
+            # A job a user requested is not held back by the nightly limit
+            group, user = self._group_with_gestor('Manual')
+            manual = conciliacao_jobs.enqueue_conciliacao(group, user)
+            call_command('conciliacao_worker', '--once', '--max-running', '1', stdout=io.StringIO())
+            self.assertEqual([job.pk for job in ran], [manual.pk])
+
+    def test_running_limit_is_locked_before_counting(self):
+        group, user = self._group_with_gestor('Trava')
+        conciliacao_jobs.enqueue_conciliacao(group, user, trigger='scheduled')
+        calls = []
+        count = QuerySet.count
+
+        def tracked_count(queryset):
+            calls.append('count')
+            return count(queryset)
+
+        with mock.patch.object(conciliacao_jobs, '_lock_running_limit', side_effect=lambda: calls.append('lock')), \
+                mock.patch.object(QuerySet, 'count', tracked_count):
+            conciliacao_jobs.claim_next_job('w', max_running=1)
+            self.assertEqual(calls, ['lock', 'count'])
+            calls.clear()
+            conciliacao_jobs.claim_next_job('w')
+            self.assertEqual(calls, [])
+
+    def test_sqlite_running_limit_lock_writes_no_job(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite write lock')
+        group, user = self._group_with_gestor('Sqlite')
+        job = conciliacao_jobs.enqueue_conciliacao(group, user, trigger='scheduled')
+
+        with CaptureQueriesContext(connection) as queries:
+            conciliacao_jobs._lock_running_limit()
+
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('UPDATE'))
+        self.assertEqual(ConciliacaoJob.objects.get(pk=job.pk).status, 'pending')
+
+    def test_run_scheduled_job_waits_for_a_free_slot_after_jitter(self):
+        group, user = self._group_with_gestor('Agendado')
+        other, other_user = self._group_with_gestor('Outro')
+        job = conciliacao_jobs.enqueue_conciliacao(group, user, trigger='scheduled')
+        running = ConciliacaoJob.objects.create(group=other, requested_by=other_user, status='running')
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                ConciliacaoJob.objects.filter(pk=running.pk).update(status='completed')
+
+        def finish(claimed):
+            ConciliacaoJob.objects.filter(pk=claimed.pk).update(status='completed', duration_seconds=2.0)
+
+        rng = mock.Mock(uniform=mock.Mock(return_value=7.5))
+        with mock.patch('financas.jobs.run_job', side_effect=finish) as run_job:
+            finished = conciliacao_jobs.run_scheduled_job(
+                [job.pk], 'w', max_running=1, jitter_seconds=30, poll_seconds=4, sleep=sleep, rng=rng,
+            )
+
+        rng.uniform.assert_called_once_with(0, 30)
+        self.assertEqual(sleeps, [7.5, 4])
+        run_job.assert_called_once()
+        self.assertEqual((finished.pk, finished.status), (job.pk, 'completed'))
+        self.assertIsNone(conciliacao_jobs.run_scheduled_job([job.pk], 'w', jitter_seconds=0))
+
+    def test_background_run_records_duration_and_throughput(self):
+        group, user = self._group_with_gestor('Metricas')
+        job = conciliacao_jobs.enqueue_conciliacao(group, user, trigger='scheduled')
+        guias = [{'nrocpsa': '501', 'paciente': 'Paciente Metricas', 'dt_cirurg': '2025-06-01'}]
+
+        with mock.patch('financas.views.iter_guias', return_value=iter(guias_source.guias_by_cpsa(guias).items())), \
+                mock.patch('financas.views.time_module.monotonic', side_effect=itertools.chain([100.0], itertools.repeat(104.0))):
+            financas_views._run_conciliacao_background(job.pk, user.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.processed_count, 1)
+        self.assertEqual((job.duration_seconds, job.guias_per_second), (4.0, 0.25))
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'needs row-level and advisory locks')
+class ConciliacaoRunningLimitConcurrencyTest(TransactionTestCase):
+    """
+    Limite global de jobs: dois claims simultâneos não passam juntos pelo limite.
+    """
+
+    def test_concurrent_claims_respect_the_running_limit(self):
+        for name in ('A', 'B'):
+            group = Groups.objects.create(name=f'Concorrente {name}')
+            user = CustomUser.objects.create_user(
+                username=f'gestor_conc_{name}', email=f'conc_{name}@teste.com', password='x', group=group
+            )
+            conciliacao_jobs.enqueue_conciliacao(group, user, trigger='scheduled')
+        # Both claimers wait here after counting; without the lock both see a free slot
+        counted = threading.Barrier(2, timeout=1)
+        count = QuerySet.count
+
+        def count_then_wait(queryset):
+            result = count(queryset)
+            try:
+                counted.wait()
+            except threading.BrokenBarrierError:
+                pass
+            return result
+
+        claimed = []
+
+        def claim(worker_id):
+            try:
+                claimed.append(conciliacao_jobs.claim_next_job(worker_id, max_running=1))
+            finally:
+                connection.close()
+
+        with mock.patch.object(QuerySet, 'count', count_then_wait):
+            threads = [threading.Thread(target=claim, args=(f'w{i}',)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len([job for job in claimed if job is not None]), 1)
+        self.assertEqual(ConciliacaoJob.objects.filter(status='running').count(), 1)
+
+
+class ProcedimentoFinancasGroupTest(TestCase):
+    """
+    Grupo sempre preenchido: registros vinculados herdam o grupo do procedimento.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Efetivo')
+        self.procedimento = Procedimento.objects.create(
+            group=self.group, nome_paciente='Paciente Grupo',
+            data_horario=timezone.make_aware(datetime(2025, 5, 2, 9, 0)),
+        )
+
+    def test_linked_row_without_group_inherits_procedure_group(self):
+        financa = ProcedimentoFinancas.objects.create(procedimento=self.procedimento)
+        self.assertEqual(financa.group, self.group)
+
+        unlinked = ProcedimentoFinancas.objects.create(api_paciente_nome='Sem Vinculo')
+        unlinked.procedimento = self.procedimento
+        unlinked.save(update_fields=['procedimento'])
+        unlinked.refresh_from_db()
+        self.assertEqual(unlinked.group, self.group)
+        self.assertEqual(ProcedimentoFinancas.objects.filter(group=self.group).count(), 2)
+
+    def test_explicit_group_is_kept(self):
+        other = Groups.objects.create(name='Outro Grupo Efetivo')
+        financa = ProcedimentoFinancas.objects.create(procedimento=self.procedimento, group=other)
+        self.assertEqual(financa.group, other)
+
+
+class DataEfetivaTest(TestCase):
+    """
+    Data efetiva armazenada: data local do procedimento vinculado ou data da API.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Data Efetiva')
+        # 22:30 in São Paulo is already the next day in UTC
+        self.procedimento = Procedimento.objects.create(
+            group=self.group, nome_paciente='Paciente Data',
+            data_horario=make_aware_sao_paulo(datetime(2025, 5, 2, 22, 30)),
+        )
+
+    def test_follows_link_procedure_date_and_delete(self):
+        financa = ProcedimentoFinancas.objects.create(group=self.group, api_data_cirurgia=date(2025, 4, 30))
+        self.assertEqual(financa.data_efetiva, date(2025, 4, 30))
+
+        financa.procedimento = self.procedimento
+        financa.save(update_fields=['procedimento'])
+        financa.refresh_from_db()
+        self.assertEqual(financa.data_efetiva, date(2025, 5, 2))
+
+        self.procedimento.data_horario = make_aware_sao_paulo(datetime(2025, 5, 6, 8, 0))
+        self.procedimento.save()
+        financa.refresh_from_db()
+        self.assertEqual(financa.data_efetiva, date(2025, 5, 6))
+
+        self.procedimento.delete()
+        financa.refresh_from_db()
+        self.assertIsNone(financa.procedimento)
+        self.assertEqual(financa.data_efetiva, date(2025, 4, 30))
+
+
+class ConciliacaoWatermarkTest(TestCase):
+    """
+    Watermark por grupo: data inicial da conciliação lida de uma única linha.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Watermark')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_watermark', email='gestor_watermark@teste.com', password='x', group=self.group,
+        )
+
+    def test_start_date_is_one_primary_key_read_once_computed(self):
+        completed_at = timezone.make_aware(datetime(2025, 6, 20, 12, 0))
+        ConciliacaoJob.objects.create(group=self.group, status='completed', completed_at=completed_at)
+        ProcedimentoFinancas.objects.create(
+            group=self.group, status_pagamento='recurso_de_glosa', api_data_cirurgia=date(2025, 5, 10),
+        )
+
+        self.assertEqual(_get_conciliation_start_date(self.group), date(2025, 5, 3))
+        with self.assertNumQueries(1):
+            self.assertEqual(_get_conciliation_start_date(self.group), date(2025, 5, 3))
+        self.assertEqual(_get_conciliation_start_date(self.group, force_full=True), date(2025, 1, 1))
+
+    def test_pending_finance_and_procedure_edits_move_watermark_back(self):
+        refresh_watermark(self.group)
+        ProcedimentoFinancas.objects.create(
+            group=self.group, status_pagamento='processo_finalizado', api_data_cirurgia=date(2025, 2, 1),
+        )
+        self.assertIsNone(get_watermark(self.group).oldest_pending_date)
+
+        ProcedimentoFinancas.objects.create(
+            group=self.group, status_pagamento='aguardando_pagamento', api_data_cirurgia=date(2025, 4, 1),
+        )
+        self.assertEqual(get_watermark(self.group).oldest_pending_date, date(2025, 4, 1))
+
+        procedimento = Procedimento.objects.create(
+            group=self.group, nome_paciente='Paciente Watermark',
+            data_horario=timezone.make_aware(datetime(2025, 4, 15, 10, 0)),
+        )
+        ProcedimentoFinancas.objects.create(procedimento=procedimento, status_pagamento='em_processamento')
+        procedimento.data_horario = timezone.make_aware(datetime(2025, 3, 5, 10, 0))
+        procedimento.save()
+        self.assertEqual(get_watermark(self.group).oldest_pending_date, date(2025, 3, 5))
+
+    def test_finished_job_refreshes_watermark(self):
+        ProcedimentoFinancas.objects.create(
+            group=self.group, status_pagamento='em_processamento', api_data_cirurgia=date(2025, 3, 1),
+        )
+        refresh_watermark(self.group)
+        ProcedimentoFinancas.objects.filter(group=self.group).update(status_pagamento='processo_finalizado')
+        job = conciliacao_jobs.enqueue_conciliacao(self.group, self.user)
+
+        with mock.patch('financas.views.iter_guias', return_value=iter([])):
+            financas_views._run_conciliacao_background(job.pk, self.user.pk)
+
+        job.refresh_from_db()
+        watermark = get_watermark(self.group)
+        self.assertEqual(watermark.last_completed_at, job.completed_at)
+        self.assertIsNone(watermark.oldest_pending_date)
+
+
+class ResumoFinanceiroMensalTest(TestCase):
+    """
+    Resumo financeiro mensal: meses reconstruídos após gravações e lidos com bordas parciais.
+    """
+
+    def setUp(self):
+        clear_entity_cache()
+        self.group = Groups.objects.create(name='Grupo Resumo')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_resumo', email='gestor_resumo@teste.com', password='x', group=self.group,
+        )
+        self.anestesista = Anesthesiologist.objects.create(name='Ana Resumo', group=self.group)
+        self.procedimento = Procedimento.objects.create(
+            group=self.group, nome_paciente='Paciente Resumo', cooperado=self.anestesista,
+            data_horario=make_aware_sao_paulo(datetime(2025, 3, 10, 9, 0)),
+        )
+
+    def _financa(self, day, valor, **extra):
+        return ProcedimentoFinancas.objects.create(
+            group=self.group, api_data_cirurgia=day, valor_faturado=Decimal(valor), **extra
+        )
+
+    def test_rollup_rows_match_finance_rows_with_partial_edge_months(self):
+        for day, valor, status in [
+            (date(2025, 1, 20), '100.00', 'em_processamento'),
+            (date(2025, 1, 5), '999.00', 'em_processamento'),
+            (date(2025, 2, 14), '200.00', 'processo_finalizado'),
+            (date(2025, 2, 15), '50.00', 'processo_finalizado'),
+            (date(2025, 3, 3), '300.00', 'em_processamento'),
+            (date(2025, 3, 28), '999.00', 'em_processamento'),
+        ]:
+            self._financa(day, valor, status_pagamento=status, tipo_cobranca='cooperativa')
+
+        rows = rollup_rows(self.group, date(2025, 1, 15), date(2025, 3, 20))
+
+        self.assertEqual(rows.total('quantidade'), 4)
+        self.assertEqual(rows.total('soma_faturado'), Decimal('650.00'))
+        self.assertEqual(rows.totals_by('mes', 'soma_faturado'), {
+            date(2025, 1, 1): Decimal('100.00'), date(2025, 2, 1): Decimal('250.00'), date(2025, 3, 1): Decimal('300.00'),
+        })
+        # February is whole and served from the table
+        self.assertTrue(ResumoFinanceiroMensal.objects.filter(group=self.group, mes=date(2025, 2, 1)).exists())
+        self.assertEqual(rows.where(status_pagamento='processo_finalizado').total('quantidade'), 2)
+        self.assertEqual(rollup_rows(self.group, date(2025, 2, 1)).total('quantidade'), 4)
+
+    def test_saves_and_procedure_edits_rebuild_affected_months(self):
+        financa = ProcedimentoFinancas.objects.create(
+            procedimento=self.procedimento, valor_faturado=Decimal('80.00'), tipo_cobranca='hospital',
+        )
+        refresh_rollup(self.group)
+        rows = rollup_rows(self.group, date(2025, 3, 1), por_anestesista=True)
+        self.assertEqual(rows.totals_by('anestesista_id', 'procedimentos'), {self.anestesista.pk: 1})
+
+        self.procedimento.data_horario = make_aware_sao_paulo(datetime(2025, 4, 2, 9, 0))
+        self.procedimento.save()
+        self.assertEqual(
+            set(ResumoFinanceiroPendente.objects.filter(group=self.group).values_list('mes', flat=True)),
+            {date(2025, 3, 1), date(2025, 4, 1)},
+        )
+        outro = Anesthesiologist.objects.create(name='Bruno Resumo', group=self.group)
+        self.procedimento.anestesistas_responsaveis.add(outro)
+
+        rows = rollup_rows(self.group, date(2025, 3, 1), por_anestesista=True)
+        self.assertEqual(rows.totals_by('mes', 'soma_faturado'), {date(2025, 4, 1): Decimal('80.00')})
+        self.assertEqual(rows.totals_by('anestesista_id', 'procedimentos'), {outro.pk: 1})
+
+        financa.delete()
+        self.assertEqual(rollup_rows(self.group, date(2025, 3, 1)).total('quantidade'), 0)
+
+    def test_conciliation_job_rebuilds_months_it_wrote(self):
+        refresh_rollup(self.group)
+        guias = [('500', {
+            'nrocpsa': '500', 'paciente': 'Outro Paciente', 'dt_cirurg': '2025-06-04', 'hora_inicial': '09:00',
+            'hospital': 'Hospital Resumo', 'cooperado': 'Ana Resumo', 'STATUS': 'Aguardando Pagamento',
+            'valor_faturado': '150.00',
+        })]
+        job = conciliacao_jobs.enqueue_conciliacao(self.group, self.user)
+
+        with mock.patch('financas.views.iter_guias', return_value=iter(guias)):
+            financas_views._run_conciliacao_background(job.pk, self.user.pk)
+
+        self.assertFalse(ResumoFinanceiroPendente.objects.filter(group=self.group).exists())
+        resumo = ResumoFinanceiroMensal.objects.get(group=self.group, mes=date(2025, 6, 1), por_anestesista=False)
+        self.assertEqual((resumo.status_pagamento, resumo.soma_faturado), ('aguardando_pagamento', Decimal('150.00')))
+
+
+class ConciliacaoStreamTest(TestCase):
+    """
+    Stream SSE de progresso: status completo, depois apenas os campos alterados.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Stream')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_stream', email='gestor_stream@teste.com', password='x', group=self.group,
+            validado=True,
+        )
+        self.job = ConciliacaoJob.objects.create(group=self.group, status='running', total_guias=10)
+
+    @staticmethod
+    def _data(event):
+        return json.loads(event.split('data: ', 1)[1])
+
+    async def test_events_send_snapshot_then_deltas_until_done(self):
+        events = financas_views._conciliacao_events(self.job.pk, poll_seconds=0)
+        self.assertTrue((await anext(events)).startswith('retry:'))
+        snapshot = self._data(await anext(events))
+        self.assertEqual((snapshot['status'], snapshot['total_guias']), ('running', 10))
+
+        await ConciliacaoJob.objects.filter(pk=self.job.pk).aupdate(processed_count=5)
+        self.assertEqual(self._data(await anext(events)), {'processed_count': 5, 'progress_percent': 50})
+
+        await ConciliacaoJob.objects.filter(pk=self.job.pk).aupdate(status='completed')
+        self.assertEqual(self._data(await anext(events)), {'status': 'completed'})
+        done = await anext(events)
+        self.assertTrue(done.startswith('event: done'))
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
+
+    async def test_stream_requires_job_of_users_group(self):
+        outsider_group = await Groups.objects.acreate(name='Outro Grupo Stream')
+        outsider = await CustomUser.objects.acreate(
+            username='outro_stream', email='outro_stream@teste.com', group=outsider_group, validado=True,
+        )
+        url = reverse('stream_conciliacao', args=[self.job.pk])
+
+        await self.async_client.aforce_login(outsider)
+        self.assertEqual((await self.async_client.get(url)).status_code, 403)
+
+        await ConciliacaoJob.objects.filter(pk=self.job.pk).aupdate(status='failed')
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertIn('event: progress', body)
+        self.assertTrue(body.endswith('event: done\ndata: {"status": "failed"}\n\n'))
+
+
+class ConciliarFinancasViewTest(TestCase):
+    """
+    Endpoint síncrono: apenas enfileira (ou reaproveita) o job e opcionalmente aguarda.
+    """
+
+    def setUp(self):
+        self.group = Groups.objects.create(name='Grupo Sync')
+        self.user = CustomUser.objects.create_user(
+            username='gestor_sync', email='gestor_sync@teste.com', password='x', group=self.group,
+            validado=True, connection_key='chave',
+        )
+        Membership.objects.create(user=self.user, group=self.group, role=GESTOR_USER, validado=True)
+        self.client.force_login(self.user)
+
+    def test_enqueues_without_running_conciliation_in_request(self):
+        with mock.patch('financas.guias.fetch_guias_window') as fetch:
+            response = self.client.get(reverse('conciliar_financas'))
+            again = self.client.get(reverse('conciliar_financas'))
+        fetch.assert_not_called()
+
+        self.assertEqual(response.status_code, 202)
+        job = ConciliacaoJob.objects.get(pk=response.json()['job_id'])
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(again.json()['job_id'], job.pk)
+        self.assertEqual(ConciliacaoJob.objects.filter(group=self.group).count(), 1)
+
+    def test_wait_returns_summary_of_finished_job(self):
+        def finish(job, timeout):
+            self.assertEqual(timeout, 5)
+            job.status = 'completed'
+            job.updated_count = 2
+            job.created_count = 1
+            return job
+
+        with mock.patch('financas.views.wait_for_job', side_effect=finish):
+            response = self.client.get(reverse('conciliar_financas'), {'wait': '5'})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['updated_count'], data['created_count']), (2, 1))
+        self.assertIn('2 registros atualizados.', data['message'])
@@ -13,6 +13,7 @@ urlpatterns = [
     # Background conciliation (async)
     path('financas/conciliar-async/', views.iniciar_conciliacao_async, name='iniciar_conciliacao_async'),
     path('financas/conciliar-status/<int:job_id>/', views.status_conciliacao, name='status_conciliacao'),
+    path('financas/conciliar-stream/<int:job_id>/', views.stream_conciliacao, name='stream_conciliacao'),
     # Despesas Recorrentes URLs
     path('financas/get-despesa-recorrente/<int:id>/', views.get_despesa_recorrente_item, name='get-despesa-recorrente-item'),
     path('financas/create-despesa-recorrente/', views.create_despesa_recorrente_item, name='create_despesa_recorrente_item'),
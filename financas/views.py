@@ -1,92 +1,37 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout
-from agenda.models import Procedimento, Convenios, ProcedimentoDetalhes
-from constants import GESTOR_USER, ADMIN_USER, ANESTESISTA_USER, STATUS_FINISHED, STATUS_PENDING, CONSULTA_PROCEDIMENTO, CIRURGIA_AMBULATORIAL_PROCEDIMENTO
-from registration.models import Groups, Membership, Anesthesiologist, HospitalClinic, Surgeon
+from django.urls import reverse
+from constants import GESTOR_USER, ADMIN_USER, ANESTESISTA_USER, STATUS_FINISHED
+from registration.models import Groups, Membership
 from .models import ProcedimentoFinancas, Despesas, DespesasRecorrentes, ConciliacaoTentativa, ConciliacaoJob
-import threading
+from .matching import similar
+from .engine import SAO_PAULO_TZ, ConciliacaoEngine, JobProgressSink, LogProgressSink, _get_conciliation_start_date
+from .jobs import (
+    ConciliacaoCheckpoint, active_job_for_group, enqueue_conciliacao, job_run_stats, requeue_abandoned_jobs,
+    wait_for_job,
+)
+from .guias import GuiasAPIError, iter_guias
+from .rollup import refresh_rollup
+from .watermark import refresh_watermark
 from django.db.models import Q, Sum, F, Value
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from datetime import datetime, timedelta, time
 from django.utils import timezone
-from django.http import JsonResponse, HttpResponseForbidden, HttpResponse
+from django.http import JsonResponse, HttpResponseForbidden, HttpResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
+import asyncio
 import json
+import logging
+import time as time_module
 import pandas as pd
 from django.http import HttpResponse
-import requests
-from difflib import SequenceMatcher
 from django.conf import settings
 from django.db import transaction
 import re
 from decimal import Decimal, InvalidOperation
-import pytz
 
-# Timezone de São Paulo - usar sempre este para processar horários do Brasil
-SAO_PAULO_TZ = pytz.timezone('America/Sao_Paulo')
-
-def make_aware_sao_paulo(dt):
-    """
-    Torna um datetime naive em datetime aware no fuso de São Paulo.
-    Se já for aware, retorna sem alteração.
-    """
-    if dt is None:
-        return None
-    if timezone.is_naive(dt):
-        return timezone.make_aware(dt, SAO_PAULO_TZ)
-    return dt
-
-DATA_INICIO_PUXAR_GUIAS_API = datetime(2025, 1, 1).date()
-
-
-def _get_conciliation_start_date(group, force_full=False):
-    if force_full:
-        return DATA_INICIO_PUXAR_GUIAS_API
-    last_completed = (
-        ConciliacaoJob.objects
-        .filter(group=group, status='completed', completed_at__isnull=False)
-        .order_by('-completed_at')
-        .first()
-    )
-    buffer_candidates = []
-    if last_completed and last_completed.completed_at:
-        buffer_candidates.append((last_completed.completed_at - timedelta(days=7)).date())
-
-    # Ensure we also cover any old guides still pending or in glosa
-    pending_statuses = [
-        'em_processamento',
-        'aguardando_pagamento',
-        'recurso_de_glosa',
-    ]
-    pending_qs = ProcedimentoFinancas.objects.filter(
-        Q(group=group) | Q(procedimento__group=group),
-        status_pagamento__in=pending_statuses,
-    )
-    oldest_pending_date = (
-        pending_qs
-        .exclude(procedimento__data_horario__isnull=True)
-        .order_by('procedimento__data_horario')
-        .values_list('procedimento__data_horario', flat=True)
-        .first()
-    )
-    if oldest_pending_date:
-        buffer_candidates.append((oldest_pending_date - timedelta(days=7)).date())
-
-    oldest_pending_api_date = (
-        pending_qs
-        .exclude(api_data_cirurgia__isnull=True)
-        .order_by('api_data_cirurgia')
-        .values_list('api_data_cirurgia', flat=True)
-        .first()
-    )
-    if oldest_pending_api_date:
-        buffer_candidates.append((oldest_pending_api_date - timedelta(days=7)))
-
-    if buffer_candidates:
-        return max(DATA_INICIO_PUXAR_GUIAS_API, min(buffer_candidates))
-
-    return DATA_INICIO_PUXAR_GUIAS_API
+logger = logging.getLogger(__name__)
 
 
 def clean_money_value(value_str):
@@ -123,15 +68,6 @@ def clean_money_value(value_str):
         return None
 
 
-def _api_decimal(value):
-    """Convert API numeric (str/float/int/Decimal) to Decimal safely."""
-    if value is None or value == '':
-        return None
-    try:
-        return Decimal(str(value))
-    except (InvalidOperation, ValueError, TypeError):
-        return None
-
 @login_required
 def financas_view(request):
     # Base permission check
@@ -177,7 +113,7 @@ def financas_view(request):
     # Base queryset - Filter by group first
     if view_type == 'receitas':
         base_qs = ProcedimentoFinancas.objects.filter(
-            Q(procedimento__group=user_group) | Q(group=user_group) # Linked via procedure OR directly via group FK
+            group=user_group # Always set, also for rows linked to a procedure (see ProcedimentoFinancas.save)
         ).select_related('procedimento', 'procedimento__hospital', 'procedimento__cooperado').prefetch_related('procedimento__anestesistas_responsaveis')
 
         # Filter for user type
@@ -320,9 +256,8 @@ def get_finance_item(request, type, id):
 
     try:
         if type == 'receitas':
-            # Fetch considering group linkage via procedure OR direct FK
             item = ProcedimentoFinancas.objects.select_related('procedimento').get(
-                Q(procedimento__group=user_group) | Q(group=user_group),
+                group=user_group,
                 id=id
             )
 
@@ -424,7 +359,7 @@ def update_finance_item(request):
         if finance_type == 'receitas':
             # Lock only the ProcedimentoFinancas table ('self')
             item = ProcedimentoFinancas.objects.select_for_update(of=('self',)).get(
-                 Q(procedimento__group=user_group) | Q(group=user_group),
+                 group=user_group,
                  id=finance_id
             )
 
@@ -678,7 +613,7 @@ def export_finances(request):
     # Get queryset using the same logic as financas_view
     if view_type == 'receitas':
         base_qs = ProcedimentoFinancas.objects.filter(
-            Q(procedimento__group=user_group) | Q(group=user_group)
+            group=user_group
         ).select_related('procedimento', 'procedimento__hospital', 'procedimento__convenio').prefetch_related('procedimento__anestesistas_responsaveis')
         
         active_role = user.get_active_role()
@@ -860,7 +795,7 @@ def delete_finance_item(request):
 
         if finance_type == 'receitas':
             item = ProcedimentoFinancas.objects.get(
-                 Q(procedimento__group=user_group) | Q(group=user_group),
+                 group=user_group,
                  id=finance_id
             )
              # Permission Check (similar to get/update)
@@ -903,449 +838,15 @@ def delete_finance_item(request):
         return JsonResponse({'success': False, 'error': f'Erro ao excluir item: {str(e)}'}, status=500)
 
 
-def update_procedimento_with_api_data_cached(procedimento, guia, group, hospital_cache, convenio_cache, 
-                                             surgeon_cache, anesthesiologist_cache, proc_detalhes_cache, 
-                                             save_immediately=True):
-    """
-    Optimized version of update_procedimento_with_api_data using caches.
-    """
-    updated = False
-    
-    # Times and Dates
-    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
-    guia_hora_final = parse_api_time(guia.get('hora_final'))
-    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-    
-    if guia_date and guia_hora_inicial:
-        new_data_horario = datetime.combine(guia_date, guia_hora_inicial)
-        new_data_horario = make_aware_sao_paulo(new_data_horario)
-        current_time = procedimento.data_horario.time() if procedimento.data_horario else None
-        if not current_time or current_time == time(0, 0) or current_time != guia_hora_inicial:
-            procedimento.data_horario = new_data_horario
-            updated = True
-    
-    if guia_date and guia_hora_final and guia_hora_final != guia_hora_inicial:
-        new_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
-        new_data_horario_fim = make_aware_sao_paulo(new_data_horario_fim)
-        if not procedimento.data_horario_fim or procedimento.data_horario_fim != new_data_horario_fim:
-            procedimento.data_horario_fim = new_data_horario_fim
-            updated = True
-
-    # CPF
-    api_cpf = guia.get('cpf') or guia.get('nr_cpf')
-    if api_cpf and not procedimento.cpf_paciente:
-        procedimento.cpf_paciente = api_cpf
-        updated = True
-
-    # Birth Date
-    api_nascimento = parse_api_date(guia.get('data_nascimento'))
-    if api_nascimento and not procedimento.data_nascimento:
-        procedimento.data_nascimento = api_nascimento
-        updated = True
-
-    # Accommodation
-    api_acomodacao = guia.get('tip_acomod')
-    if api_acomodacao and not procedimento.acomodacao:
-        procedimento.acomodacao = api_acomodacao
-        updated = True
-    
-    # Surgeon (Cached)
-    api_surgeon_name = guia.get('cirurgiao')
-    if api_surgeon_name and api_surgeon_name.strip():
-        name_key = api_surgeon_name.strip().lower()
-        surgeon_obj = None
-        if name_key in surgeon_cache:
-            surgeon_obj = surgeon_cache[name_key]
-        else:
-            # Fallback to create (already handles duplicate by crm/name inside)
-            surgeon_obj = find_or_create_surgeon(group, api_surgeon_name, guia.get('crm_cirurgiao'))
-            surgeon_cache[name_key] = surgeon_obj
-        
-        if surgeon_obj and (not procedimento.cirurgiao or procedimento.cirurgiao_id != surgeon_obj.id):
-            procedimento.cirurgiao = surgeon_obj
-            updated = True
-    
-    # Hospital (Cached)
-    api_hospital_name = guia.get('hospital')
-    if api_hospital_name and api_hospital_name.strip():
-        name_key = api_hospital_name.strip().lower()
-        hospital_obj = None
-        if name_key in hospital_cache:
-            hospital_obj = hospital_cache[name_key]
-        else:
-            hospital_obj, _ = HospitalClinic.objects.get_or_create(
-                name__iexact=api_hospital_name.strip(),
-                defaults={'name': api_hospital_name.strip(), 'group': group}
-            )
-            hospital_cache[name_key] = hospital_obj
-        
-        if hospital_obj and (not procedimento.hospital or procedimento.hospital_id != hospital_obj.id):
-            procedimento.hospital = hospital_obj
-            updated = True
-
-    # Cooperado (Cached)
-    api_cooperado_name = guia.get('cooperado')
-    if api_cooperado_name:
-        name_key = api_cooperado_name.strip().lower()
-        anest_obj = None
-        if name_key in anesthesiologist_cache:
-            anest_obj = anesthesiologist_cache[name_key]
-        else:
-            anest_obj = find_or_create_anesthesiologist(group, api_cooperado_name)
-            anesthesiologist_cache[name_key] = anest_obj
-            
-        if anest_obj and (not procedimento.cooperado or procedimento.cooperado_id != anest_obj.id):
-            procedimento.cooperado = anest_obj
-            updated = True
-
-    # Procedure Detail (Cached)
-    api_procedimentos = guia.get('procedimentos')
-    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
-        principal = api_procedimentos[0]
-        api_codigo = principal.get('codigo')
-        api_descricao = principal.get('descricao')
-        if api_codigo and api_descricao:
-            detalhe = None
-            if api_codigo in proc_detalhes_cache:
-                detalhe = proc_detalhes_cache[api_codigo]
-            else:
-                detalhe, _ = ProcedimentoDetalhes.objects.get_or_create(
-                    codigo_procedimento=api_codigo,
-                    defaults={'name': api_descricao}
-                )
-                proc_detalhes_cache[api_codigo] = detalhe
-            
-            if detalhe and procedimento.procedimento_principal_id != detalhe.id:
-                procedimento.procedimento_principal = detalhe
-                procedimento.procedimento_type = CONSULTA_PROCEDIMENTO if api_codigo == '10101012' else CIRURGIA_AMBULATORIAL_PROCEDIMENTO
-                updated = True
-    
-    if updated and save_immediately:
-        procedimento.save()
-    
-    return (updated, procedimento)
-
-
-def similar(a, b):
-    if not a or not b:
-        return 0
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
-
-def parse_api_date(date_str):
-    """Safely parses date string from API format YYYY-MM-DD."""
-    if not date_str:
-        return None
-    try:
-        return datetime.strptime(date_str, '%Y-%m-%d').date()
-    except ValueError:
-        print(f"Warning: Could not parse date '{date_str}'")
-        return None
-
-def map_api_status(api_status_str):
-    """Maps API status string to internal status choices."""
-    if not api_status_str:
-        return 'em_processamento' # Default if status is missing
-    api_status = str(api_status_str).lower().strip()
-    status_mapping = {
-        'em processamento': 'em_processamento',
-        'aguardando pagamento': 'aguardando_pagamento',
-        'recurso de glosa': 'recurso_de_glosa',
-        'processo finalizado': 'processo_finalizado',
-        'cancelada': 'cancelada',
-        # Add other potential mappings if needed
-    }
-    return status_mapping.get(api_status, 'em_processamento') # Default if unknown status
-
-def parse_api_time(time_str):
-    """Safely parses time string from API format HH:MM."""
-    if not time_str:
-        return None
-    try:
-        # Handle various time formats (HH:MM, H:MM, etc.)
-        time_str = str(time_str).strip()
-        if ':' in time_str:
-            parts = time_str.split(':')
-            hour = int(parts[0])
-            minute = int(parts[1]) if len(parts) > 1 else 0
-            return time(hour=hour, minute=minute)
-        else:
-            # Handle cases where only hour is provided
-            hour = int(time_str)
-            return time(hour=hour, minute=0)
-    except (ValueError, TypeError):
-        print(f"Warning: Could not parse time '{time_str}'")
-        return None
-
-
-def _sorted_guias_newest_first(guias_dict):
-    def _guias_sort_key(item):
-        _, guia = item
-        guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-        guia_time = parse_api_time(guia.get('hora_inicial'))
-        if guia_date:
-            guia_time = guia_time or time(0, 0)
-            return datetime.combine(guia_date, guia_time)
-        return datetime.min
-
-    return sorted(guias_dict.items(), key=_guias_sort_key, reverse=True)
-
-def find_or_create_anesthesiologist(group, anesthesiologist_name):
-    """Find existing anesthesiologist by similarity in the group or create a new one."""
-    if not anesthesiologist_name or not str(anesthesiologist_name).strip():
-        return None
-
-    name = str(anesthesiologist_name).strip()
-    # Try exact (case-insensitive) match first
-    exact = Anesthesiologist.objects.filter(group=group, name__iexact=name).first()
-    if exact:
-        return exact
-
-    best_match = None
-    highest_sim = 0.7
-    for candidate in Anesthesiologist.objects.filter(group=group):
-        if candidate.name:
-            sim_score = similar(name, candidate.name)
-            if sim_score > highest_sim:
-                highest_sim = sim_score
-                best_match = candidate
-    if best_match:
-        return best_match
-
-    # Create new when no good match found
-    return Anesthesiologist.objects.create(name=name, group=group)
-
-def find_or_create_surgeon(group, surgeon_name, surgeon_crm=None):
-    """Find existing surgeon or create new one based on name and CRM."""
-    if not surgeon_name or not surgeon_name.strip():
-        return None
-    
-    surgeon_name = surgeon_name.strip()
-    surgeon_crm = surgeon_crm.strip() if surgeon_crm else None
-    
-    # Try to find existing surgeon by CRM first (if provided)
-    if surgeon_crm:
-        surgeon = Surgeon.objects.filter(group=group, crm=surgeon_crm).first()
-        if surgeon:
-            return surgeon
-    
-    # Try to find by name similarity
-    surgeons_in_group = Surgeon.objects.filter(group=group)
-    best_match_surgeon = None
-    highest_sim = 0.7
-    
-    for surgeon in surgeons_in_group:
-        if surgeon.name:
-            sim_score = similar(surgeon_name, surgeon.name)
-            if sim_score > highest_sim:
-                highest_sim = sim_score
-                best_match_surgeon = surgeon
-    
-    if best_match_surgeon:
-        return best_match_surgeon
-    
-    # Create new surgeon
-    new_surgeon = Surgeon.objects.create(
-        name=surgeon_name,
-        crm=surgeon_crm,
-        group=group
-    )
-    return new_surgeon
-
-def update_procedimento_with_api_data(procedimento, guia, group, save_immediately=True):
-    """
-    Update existing Procedimento with API data if it's more complete.
-    If save_immediately is False, the caller must handle saving the procedimento.
-    Returns (updated, procedimento) tuple - updated is True if any changes were made.
-    """
-    updated = False
-    
-    # Update times if API has them and they're more precise
-    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
-    guia_hora_final = parse_api_time(guia.get('hora_final'))
-    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-    
-    if guia_date and guia_hora_inicial:
-        new_data_horario = datetime.combine(guia_date, guia_hora_inicial)
-        new_data_horario = make_aware_sao_paulo(new_data_horario)
-        
-        current_time = procedimento.data_horario.time() if procedimento.data_horario else None
-        if not current_time or current_time == time(0, 0) or current_time != guia_hora_inicial:
-            procedimento.data_horario = new_data_horario
-            updated = True
-    
-    if guia_date and guia_hora_final:
-        if guia_hora_final != guia_hora_inicial:
-            new_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
-            new_data_horario_fim = make_aware_sao_paulo(new_data_horario_fim)
-            
-            if not procedimento.data_horario_fim or procedimento.data_horario_fim != new_data_horario_fim:
-                procedimento.data_horario_fim = new_data_horario_fim
-                updated = True
-
-    # Update CPF if present and missing in procedure
-    api_cpf = guia.get('cpf') or guia.get('nr_cpf')
-    if api_cpf and not procedimento.cpf_paciente:
-        procedimento.cpf_paciente = api_cpf
-        updated = True
-
-    # Update Data Nascimento if present and missing in procedure (API sends as 'data_nascimento')
-    api_nascimento = parse_api_date(guia.get('data_nascimento'))
-    if api_nascimento and not procedimento.data_nascimento:
-        procedimento.data_nascimento = api_nascimento
-        updated = True
-
-    # Update Acomodação if present (API sends as 'tip_acomod')
-    api_acomodacao = guia.get('tip_acomod')
-    if api_acomodacao and not procedimento.acomodacao:
-        procedimento.acomodacao = api_acomodacao
-        updated = True
-    
-    api_surgeon_name = guia.get('cirurgiao')
-    api_surgeon_crm = guia.get('crm_cirurgiao')
-    
-    if api_surgeon_name and api_surgeon_name.strip():
-        api_surgeon = find_or_create_surgeon(group, api_surgeon_name, api_surgeon_crm)
-        if api_surgeon and (not procedimento.cirurgiao or procedimento.cirurgiao.id != api_surgeon.id):
-            procedimento.cirurgiao = api_surgeon
-            updated = True
-    
-    api_hospital_name = guia.get('hospital')
-    if api_hospital_name and api_hospital_name.strip():
-        hospital_obj, created = HospitalClinic.objects.get_or_create(
-            name__iexact=api_hospital_name.strip(),
-            defaults={'name': api_hospital_name.strip(), 'group': group}
-        )
-        if not procedimento.hospital or procedimento.hospital.id != hospital_obj.id:
-            procedimento.hospital = hospital_obj
-            updated = True
-
-    # Sync Cooperado on Procedimento from API 'cooperado'
-    api_cooperado_name = guia.get('cooperado')
-    if api_cooperado_name:
-        anest = find_or_create_anesthesiologist(group, api_cooperado_name)
-        if anest and (not procedimento.cooperado or procedimento.cooperado_id != anest.id):
-            procedimento.cooperado = anest
-            updated = True
-
-    # Update ProcedimentoDetalhes (procedimento_principal)
-    api_procedimentos = guia.get('procedimentos')
-    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
-        principal_proc_data = api_procedimentos[0] # Taking the first procedure as the principal
-        api_codigo = principal_proc_data.get('codigo')
-        api_descricao = principal_proc_data.get('descricao')
-
-        if api_codigo and api_descricao:
-            proc_detalhe, created = ProcedimentoDetalhes.objects.get_or_create(
-                codigo_procedimento=api_codigo,
-                defaults={'name': api_descricao}
-            )
-            if not created:
-                if proc_detalhe.name != api_descricao:
-                    proc_detalhe.name = api_descricao
-                    proc_detalhe.save() # Decide if overriding name is desired
-
-            if procedimento.procedimento_principal != proc_detalhe:
-                procedimento.procedimento_principal = proc_detalhe
-                # Also update the procedure type based on the new principal procedure
-                if proc_detalhe.codigo_procedimento == '10101012':
-                    procedimento.procedimento_type = CONSULTA_PROCEDIMENTO
-                else:
-                    procedimento.procedimento_type = CIRURGIA_AMBULATORIAL_PROCEDIMENTO
-                updated = True
-    
-    if updated and save_immediately:
-        procedimento.save()
-    
-    return (updated, procedimento)
-
-def find_comprehensive_procedure_match(all_procs_list, guia, group):
-    """
-    Find existing Procedimento that matches all key fields from the guide.
-    This prevents creating duplicate procedures for the same surgery with multiple financial charges.
-    """
-    guia_paciente = guia.get('paciente')
-    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
-    guia_cooperado = guia.get('cooperado')
-    guia_hospital = guia.get('hospital')
-    guia_cirurgiao = guia.get('cirurgiao')
-    
-    if not guia_paciente or not guia_date:
-        return None
-    
-    best_match_proc = None
-    highest_score = 0.0
-    
-    for proc in all_procs_list:
-        score = 0.0
-        total_factors = 0
-        
-        # 1. Patient name similarity (most important) - CASE INSENSITIVE
-        if proc.nome_paciente:
-            name_sim = similar(guia_paciente.lower(), proc.nome_paciente.lower())
-            if name_sim < 0.8:  # Skip if name similarity is too low
-                continue
-            score += name_sim * 0.4  # 40% weight
-            total_factors += 0.4
-        
-        # 2. Date match (essential)
-        proc_date = proc.data_horario.date() if proc.data_horario else None
-        if proc_date:
-            date_diff = abs((guia_date - proc_date).days)
-            if date_diff > 1:  # Skip if date difference is more than 1 day
-                continue
-            date_score = 1.0 if date_diff == 0 else 0.7  # Exact date match gets full score
-            score += date_score * 0.25  # 25% weight
-            total_factors += 0.25
-        
-        # 3. Time match (if available)
-        if guia_hora_inicial and proc.data_horario:
-            # Convert procedure's UTC time to local time for comparison
-            proc_local_time = timezone.localtime(proc.data_horario).time()
-            if proc_local_time != time(0, 0):  # Only compare if procedure has a real time (not midnight default)
-                time_diff_minutes = abs(
-                    (guia_hora_inicial.hour * 60 + guia_hora_inicial.minute) - 
-                    (proc_local_time.hour * 60 + proc_local_time.minute)
-                )
-                if time_diff_minutes <= 30:  # Within 30 minutes
-                    time_score = 1.0 if time_diff_minutes == 0 else 0.8
-                    score += time_score * 0.15  # 15% weight
-                    total_factors += 0.15
-                elif time_diff_minutes > 240:  # More than 4 hours difference
-                    continue  # Skip this procedure
-        
-        # 4. Hospital match (if available) - CASE INSENSITIVE
-        if guia_hospital and proc.hospital:
-            hospital_sim = similar(guia_hospital.lower(), proc.hospital.name.lower())
-            if hospital_sim > 0.7:
-                score += hospital_sim * 0.1  # 10% weight
-                total_factors += 0.1
-        
-        # 5. Anesthesiologist match (if available) - CASE INSENSITIVE
-        if guia_cooperado and proc.anestesistas_responsaveis.exists():
-            anest_match = False
-            
-            for anest in proc.anestesistas_responsaveis.all():
-                if anest.name and similar(guia_cooperado.lower(), anest.name.lower()) > 0.8:
-                    anest_match = True
-                    break
-            if anest_match:
-                score += 0.1  # 10% weight
-                total_factors += 0.1
-        
-        # Calculate final score as percentage
-        if total_factors > 0:
-            final_score = score / total_factors
-            
-            # Require minimum combined score for match
-            if final_score > 0.85 and final_score > highest_score:
-                highest_score = final_score
-                best_match_proc = proc
-    
-    return best_match_proc
-
 @login_required
 def conciliar_financas(request):
+    """
+    Versão "síncrona" da conciliação: enfileira um job (ou reaproveita o job
+    ativo do grupo) e, com ?wait=<segundos>, aguarda o resultado até esse
+    limite (jobs.WAIT_MAX_SECONDS). A conciliação em si roda sempre no worker
+    (`manage.py conciliacao_worker`), nunca dentro do request.
+    Responde 202 com o job_id se o job ainda não terminou.
+    """
     if not request.user.validado:
         # End the current session and instruct frontend to redirect to login
         logout(request)
@@ -1362,454 +863,62 @@ def conciliar_financas(request):
     if not user.connection_key:
          return JsonResponse({'error': 'Chave de conexão não configurada para o usuário'}, status=400)
 
-    # --- Initialization ---
-    auto_matched_reports = []
-    updated_records_count = 0
-    newly_created_count = 0
-    newly_linked_count = 0
-    processed_cpsa_ids = set()
-    api_errors = []
-    print(f"--- Starting Conciliation for Group: {group.name}, User: {user.username} ---")
-
-    try:
-        # --- Fetch API Data ---
-        api_url = f"{settings.COOPAHUB_API['BASE_URL']}/portal/guias/ajaxGuias.php"
-        #api_url = "https://aplicacao.coopanestrio.dev.br/portal/guias/ajaxGuias.php"  #TODO : endpoint dev para testes na parteb de procedimnto principal
+    requeue_abandoned_jobs()
+    job = active_job_for_group(group)
+    if job is None:
         fast = request.GET.get('fast') == '1'
         force_full = request.GET.get('full') == '1' or not fast
-        start_date = _get_conciliation_start_date(group, force_full=force_full)
-        api_payload = {
-            "conexao": user.connection_key,
-            "periodo_de": start_date.strftime('%Y-%m-%d'),
-            "periodo_ate": timezone.now().strftime('%Y-%m-%d'),
-            "status": "Listagem Geral",
-            "coopahub": "S"
-        }
-        response = requests.post(api_url, json=api_payload, timeout=120)
-        response.raise_for_status()
-        
-        # Debug prints for raw API response (avoid heavy logging in production)
-        if getattr(settings, 'DEBUG', False):
-            print(f"=== RAW API RESPONSE DEBUG ===")
-            print(f"Response Status Code: {response.status_code}")
-            print(f"Raw Response Text (first 500 chars): {response.text[:500]}")
-            print(f"=== END RAW API RESPONSE DEBUG ===")
-        
-        api_response_data = response.json()
-        
-        # Show example of a single guia for debugging (avoid heavy logging in production)
-        if getattr(settings, 'DEBUG', False):
-            guias_for_debug = api_response_data.get('listaguias', [])
-            if guias_for_debug:
-                print(f"=== SINGLE GUIA EXAMPLE ===")
-                print(f"Example Guia JSON: {guias_for_debug[0]}")
-                print(f"\n=== ALL KEYS AVAILABLE: ===")
-                print(f"Keys: {list(guias_for_debug[0].keys())}")
-                print(f"=== END SINGLE GUIA EXAMPLE ===")
-
-        if api_response_data.get('erro') != '000':
-            error_msg = f"API Error: {api_response_data.get('msg', 'Unknown API error')}"
-            print(f"API Error for group {group.name}: {error_msg}")
-            return JsonResponse({'error': error_msg}, status=500)
-
-        guias = api_response_data.get('listaguias', [])
-        
-        
-        # Filter out guides without essential nrocpsa
-        guias_dict = {
-            str(g['nrocpsa']): g for g in guias
-            if g.get('nrocpsa') and str(g.get('nrocpsa')).strip()
-        }
-        print(f"API Fetch: Found {len(guias_dict)} guides with valid nrocpsa.")
-        guias_items = _sorted_guias_newest_first(guias_dict)
-
-        # --- Fetch Existing DB Data ---
-        # Fetch existing financas records with CPSA (for quick lookup and updates)
-        financas_qs = ProcedimentoFinancas.objects.filter(
-            Q(procedimento__group=group) | Q(group=group)
-        ).select_related('procedimento') # Keep this select_related
-
-        active_role = user.get_active_role()
-        #Apesar de anestesista não terem acesso a parte de financas, assegurado pela validação acima, deixamos essa parte caso futuramnete venham a ter e então verão apenas a sua parte
-        if active_role == ANESTESISTA_USER and hasattr(user, 'anesthesiologist'):
-             financas_qs = financas_qs.filter(
-                 Q(procedimento__anestesistas_responsaveis=user.anesthesiologist) |
-                 Q(procedimento__isnull=True, api_cooperado_nome__iexact=user.anesthesiologist.name)
-             )
-
-        financas_dict_by_cpsa = {f.cpsa: f for f in financas_qs if f.cpsa}
-        print(f"DB Fetch: Found {len(financas_dict_by_cpsa)} existing financas records with CPSA.")
-
-        guias_cpsa_ids = set(guias_dict.keys())
-        missing_cpsa_ids = guias_cpsa_ids - set(financas_dict_by_cpsa.keys())
-        unlinked_financas_exists = financas_qs.filter(procedimento__isnull=True).exists()
-        needs_procedure_matching = bool(missing_cpsa_ids) or unlinked_financas_exists
-
-        from collections import defaultdict
-        all_procs_list = []
-        proc_lookup_dict = defaultdict(list)
-        hospital_cache = {}
-        convenio_cache = {}
-        surgeon_cache = {}
-        anesthesiologist_cache = {}
-        proc_detalhes_cache = {}
-
-        if needs_procedure_matching:
-            # Fetch ALL relevant procedures for the group (within a reasonable timeframe?)
-            # Let's keep fetching recent procedures for matching, but not filter by financas__isnull
-            cutoff_date = start_date
-            all_procs_qs = Procedimento.objects.filter(
-                group=group,
-                data_horario__date__gte=cutoff_date
-            ).select_related('hospital', 'convenio').prefetch_related('financas_records') # Use prefetch_related for financas_records
-
-            # Add anesthesiologist filter if applicable
-            active_role = user.get_active_role()
-            #Apesar de anestesista não terem acesso a parte de financas, assegurado pela validação acima, deixamos essa parte caso futuramnete venham a ter e então verão apenas a sua parte
-            if active_role == ANESTESISTA_USER and hasattr(user, 'anesthesiologist'):
-                all_procs_qs = all_procs_qs.filter(anestesistas_responsaveis=user.anesthesiologist)
-            
-            all_procs_list = list(all_procs_qs)
-            print(f"DB Fetch: Found {len(all_procs_list)} potentially relevant procedures.")
-
-            # --- Build O(1) lookup dictionary for procedures by (patient_name_lower, date) ---
-            # This avoids O(n) iteration for each guide
-            for proc in all_procs_list:
-                if proc.nome_paciente and proc.data_horario:
-                    key = (proc.nome_paciente.strip().lower(), proc.data_horario.date())
-                    proc_lookup_dict[key].append(proc)
-            print(f"Built procedure lookup with {len(proc_lookup_dict)} unique (patient, date) keys.")
-
-            # --- Build caches for related entities to avoid repeated get_or_create queries ---
-            # Cache hospitals by name (lowercase)
-            hospital_cache = {h.name.lower(): h for h in HospitalClinic.objects.filter(group=group)}
-            # Cache convenios by name (lowercase)
-            convenio_cache = {c.name.lower(): c for c in Convenios.objects.all()}
-            # Cache surgeons by name (lowercase)
-            surgeon_cache = {s.name.lower(): s for s in Surgeon.objects.filter(group=group) if s.name}
-            # Cache anesthesiologists by name (lowercase)
-            anesthesiologist_cache = {a.name.lower(): a for a in Anesthesiologist.objects.filter(group=group) if a.name}
-            # Cache procedimento detalhes by codigo
-            proc_detalhes_cache = {pd.codigo_procedimento: pd for pd in ProcedimentoDetalhes.objects.all() if pd.codigo_procedimento}
-            print(f"Built entity caches: {len(hospital_cache)} hospitals, {len(convenio_cache)} convenios, {len(surgeon_cache)} surgeons, {len(anesthesiologist_cache)} anesthesiologists, {len(proc_detalhes_cache)} proc_detalhes.")
-        else:
-            print("Skipping procedure/caches: no missing CPSA and no unlinked financas.")
-
-        # --- Processing ---
-        financas_to_update = []
-        financas_to_create = []
-        procedimentos_to_update = {}  # Dict by id to avoid duplicates
-        procedimentos_to_create = []  # List of (Procedimento, guia, cpsa_id) tuples for bulk_create
-        financas_pending_proc = []    # List of (financa_data, proc_index) for linking after bulk_create
-        processed_cpsa_ids = set()
-        
-        # Define batch size for processing - increased for better performance
-        BATCH_SIZE = 200
-        
-        # Fields to update for bulk_update
-        FINANCAS_UPDATE_FIELDS = [
-            'valor_faturado', 'valor_recebido', 'valor_recuperado', 'valor_acatado',
-            'status_pagamento', 'api_paciente_nome', 'api_hospital_nome', 'api_cooperado_nome',
-            'matricula', 'senha', 'api_data_cirurgia', 'plantao_eletiva', 'procedimento'
-        ]
-        PROCEDIMENTO_UPDATE_FIELDS = [
-            'data_horario', 'data_horario_fim', 'cpf_paciente', 'data_nascimento',
-            'acomodacao', 'cirurgiao', 'hospital', 'cooperado', 'procedimento_principal', 'procedimento_type'
-        ]
-        
-        print("--- Processing API Guides ---")
-        for cpsa_id, guia in guias_items:
-            processed_cpsa_ids.add(cpsa_id) 
-            
-            guia_paciente = guia.get('paciente')
-            guia_date_str = guia.get('dt_cirurg', guia.get('dt_cpsa'))
-            guia_date = parse_api_date(guia_date_str)
-            guia_cooperado = guia.get('cooperado') 
-
-            active_role = user.get_active_role()
-            if active_role == ANESTESISTA_USER and hasattr(user, 'anesthesiologist'):
-                if not guia_cooperado or not similar(guia_cooperado.lower(), user.anesthesiologist.name.lower()) > 0.8:
-                    continue
-
-            if cpsa_id in financas_dict_by_cpsa:
-                financa = financas_dict_by_cpsa[cpsa_id]
-                
-                # Skip records that are already finalized - no need to update them
-                if financa.status_pagamento == 'processo_finalizado':
-                    continue
-                
-                if financa.tipo_cobranca == 'cooperativa':
-                    updated = False
-                    guia_valor_faturado = guia.get('valor_faturado')
-                    guia_valor_recebido = guia.get('valor_recebido')
-                    guia_valor_recuperado = guia.get('valor_receuperado', guia.get('valor_recuperado'))
-                    guia_valor_acatado = guia.get('valor_acatado')
-                    guia_status = map_api_status(guia.get('STATUS'))
-
-                    if guia_valor_faturado is not None and (financa.valor_faturado is None or financa.valor_faturado != float(guia_valor_faturado)):
-                        financa.valor_faturado = guia_valor_faturado; updated = True
-                    if guia_valor_recebido is not None and (financa.valor_recebido is None or financa.valor_recebido != float(guia_valor_recebido)):
-                        financa.valor_recebido = guia_valor_recebido; updated = True
-                    if guia_valor_recuperado is not None and (financa.valor_recuperado is None or financa.valor_recuperado != float(guia_valor_recuperado)):
-                        financa.valor_recuperado = guia_valor_recuperado; updated = True
-                    if guia_valor_acatado is not None and (financa.valor_acatado is None or financa.valor_acatado != float(guia_valor_acatado)):
-                        financa.valor_acatado = guia_valor_acatado; updated = True
-                    if guia_status and financa.status_pagamento != guia_status:
-                        financa.status_pagamento = guia_status; updated = True
-                    if financa.api_paciente_nome != guia.get('paciente'):
-                        financa.api_paciente_nome = guia.get('paciente'); updated = True
-                    if financa.api_hospital_nome != guia.get('hospital'):
-                        financa.api_hospital_nome = guia.get('hospital'); updated = True
-                    if financa.api_cooperado_nome != guia.get('cooperado'):
-                        financa.api_cooperado_nome = guia.get('cooperado'); updated = True
-                    if financa.matricula != guia.get('matricula'):
-                        financa.matricula = guia.get('matricula'); updated = True
-                    if financa.senha != guia.get('senha'):
-                        financa.senha = guia.get('senha'); updated = True
-                    
-                    guia_api_date_parsed = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-                    if financa.api_data_cirurgia != guia_api_date_parsed:
-                        financa.api_data_cirurgia = guia_api_date_parsed; updated = True
-                    
-                    if financa.plantao_eletiva != guia.get('classificacao'):
-                        financa.plantao_eletiva = guia.get('classificacao'); updated = True
-                    
-                    if updated:
-                        if financa not in financas_to_update: financas_to_update.append(financa)
-
-                if not financa.procedimento and needs_procedure_matching:
-                     best_match_proc = None
-                     highest_similarity = 0.7 
-                     if guia_paciente and guia_date:
-                          # Use O(1) lookup first
-                          lookup_key = (guia_paciente.strip().lower(), guia_date)
-                          candidate_procs = proc_lookup_dict.get(lookup_key, [])
-                          
-                          # If no exact match, try adjacent dates
-                          if not candidate_procs:
-                              next_day = guia_date + timedelta(days=1)
-                              prev_day = guia_date - timedelta(days=1)
-                              candidate_procs = (
-                                  proc_lookup_dict.get((guia_paciente.strip().lower(), next_day), []) +
-                                  proc_lookup_dict.get((guia_paciente.strip().lower(), prev_day), [])
-                              )
-                          
-                          # If still no match, fall back to similarity search (limited)
-                          if not candidate_procs and len(all_procs_list) <= 100:
-                              candidate_procs = all_procs_list
-                          
-                          for proc in candidate_procs:
-                              name_similarity = similar(guia_paciente.lower(), proc.nome_paciente.lower())
-                              proc_date = proc.data_horario.date() if proc.data_horario else None
-                              date_diff = abs((guia_date - proc_date).days) if proc_date else float('inf')
-                              exact_match = name_similarity > 0.95 and date_diff == 0
-                              good_match = name_similarity > 0.85 and date_diff <= 1
-                              current_similarity = name_similarity
-                              if (exact_match or good_match) and current_similarity > highest_similarity:
-                                  highest_similarity = current_similarity
-                                  best_match_proc = proc
-                          if best_match_proc:
-                              # Check if this procedure already has any financial records
-                              existing_financas_for_proc = list(best_match_proc.financas_records.all())
-                              
-                              # Allow linking even if procedure has other financial records (multiple charges per procedure)
-                              # Update the procedure with API data before linking
-                              update_procedimento_with_api_data(best_match_proc, guia, group)
-                              
-                              financa.procedimento = best_match_proc
-                              newly_linked_count += 1 
-                              if financa not in financas_to_update: financas_to_update.append(financa)
-                elif financa.procedimento:
-                     # Also update existing linked procedures (deferred save for bulk_update)
-                     was_updated, updated_proc = update_procedimento_with_api_data(financa.procedimento, guia, group, save_immediately=False)
-                     if was_updated:
-                         procedimentos_to_update[updated_proc.id] = updated_proc
-                     processed_cpsa_ids.add(financa.cpsa)
-
-            else: # No existing Finanças with this CPSA
-                best_match_proc = None
-                
-                if guia_paciente and guia_date:
-                    # Use comprehensive matching instead of simple name/date matching
-                    best_match_proc = find_comprehensive_procedure_match(all_procs_list, guia, group)
-
-                if best_match_proc: # Matching procedure found
-                    # Update the matched procedure with API data (deferred save)
-                    was_updated, updated_proc = update_procedimento_with_api_data(best_match_proc, guia, group, save_immediately=False)
-                    if was_updated:
-                        procedimentos_to_update[updated_proc.id] = updated_proc
-                    
-                    new_financa = ProcedimentoFinancas(
-                        procedimento=best_match_proc,
-                        group=group,
-                        tipo_cobranca='cooperativa',
-                        cpsa=cpsa_id,
-                        valor_faturado=guia.get('valor_faturado'),
-                        valor_recebido=guia.get('valor_recebido'),
-                        valor_recuperado=guia.get('valor_receuperado', guia.get('valor_recuperado')),
-                        valor_acatado=guia.get('valor_acatado'),
-                        status_pagamento=map_api_status(guia.get('STATUS')),
-                        api_paciente_nome=guia.get('paciente'),
-                        api_data_cirurgia=guia_date, # Use parsed guia_date
-                        api_hospital_nome=guia.get('hospital'),
-                        api_cooperado_nome=guia.get('cooperado'),
-                        matricula=guia.get('matricula'),
-                        senha=guia.get('senha'),
-                        plantao_eletiva=guia.get('classificacao')
-                    )
-                    financas_to_create.append(new_financa)
-                    newly_created_count += 1 # For ProcedimentoFinancas
-                    newly_linked_count += 1
-                else: # No matching procedure found OR guide data was insufficient to search
-                    if guia_paciente and guia_date:
-                        # Prepare procedure object without saving (for bulk_create)
-                        try:
-                            proc_obj = prepare_procedimento_from_guia(
-                                guia, cpsa_id, group,
-                                hospital_cache, convenio_cache, surgeon_cache,
-                                anesthesiologist_cache, proc_detalhes_cache
-                            )
-                            if proc_obj:
-                                procedimentos_to_create.append(proc_obj)
-                                # Store financa data with index to link after bulk_create
-                                financa_data = {
-                                    'group': group,
-                                    'tipo_cobranca': 'cooperativa',
-                                    'cpsa': cpsa_id,
-                                    'valor_faturado': guia.get('valor_faturado'),
-                                    'valor_recebido': guia.get('valor_recebido'),
-                                    'valor_recuperado': guia.get('valor_receuperado', guia.get('valor_recuperado')),
-                                    'valor_acatado': guia.get('valor_acatado'),
-                                    'status_pagamento': map_api_status(guia.get('STATUS')),
-                                    'api_paciente_nome': guia.get('paciente'),
-                                    'api_data_cirurgia': guia_date,
-                                    'api_hospital_nome': guia.get('hospital'),
-                                    'api_cooperado_nome': guia.get('cooperado'),
-                                    'matricula': guia.get('matricula'),
-                                    'senha': guia.get('senha'),
-                                    'plantao_eletiva': guia.get('classificacao')
-                                }
-                                financas_pending_proc.append((financa_data, len(procedimentos_to_create) - 1))
-                                newly_created_count += 1
-                                newly_linked_count += 1
-                        except Exception as e_proc_create:
-                            print(f"Error preparing new Procedimento for Guide CPSA {cpsa_id}: {str(e_proc_create)}")
-                            api_errors.append(f"Erro ao criar procedimento para guia {cpsa_id}: {str(e_proc_create)}")
-            
-            # Bulk create procedures when batch is full
-            if len(procedimentos_to_create) >= BATCH_SIZE:
-                with transaction.atomic():
-                    created_procs = Procedimento.objects.bulk_create(procedimentos_to_create)
-                    print(f"--- Bulk created batch of {len(created_procs)} procedimentos ---")
-                    # Create financas with proper procedure links
-                    for financa_data, proc_idx in financas_pending_proc:
-                        financa_data['procedimento'] = created_procs[proc_idx]
-                        financas_to_create.append(ProcedimentoFinancas(**financa_data))
-                    # Add to lookup dict
-                    for proc in created_procs:
-                        all_procs_list.append(proc)
-                        if proc.nome_paciente and proc.data_horario:
-                            lookup_key = (proc.nome_paciente.strip().lower(), proc.data_horario.date())
-                            proc_lookup_dict[lookup_key].append(proc)
-                procedimentos_to_create = []
-                financas_pending_proc = []
-
-            # Process updates in batches to prevent large transactions
-            if len(financas_to_update) >= BATCH_SIZE:
-                with transaction.atomic():
-                    ProcedimentoFinancas.objects.bulk_update(financas_to_update, FINANCAS_UPDATE_FIELDS)
-                    updated_records_count += len(financas_to_update)
-                    print(f"--- Bulk updated batch of {len(financas_to_update)} financas ---")
-                financas_to_update = []
-            
-            # Process procedure updates in batches
-            if len(procedimentos_to_update) >= BATCH_SIZE:
-                with transaction.atomic():
-                    Procedimento.objects.bulk_update(list(procedimentos_to_update.values()), PROCEDIMENTO_UPDATE_FIELDS)
-                    print(f"--- Bulk updated batch of {len(procedimentos_to_update)} procedimentos ---")
-                procedimentos_to_update = {}
-
-            # Process creates in batches to prevent large transactions
-            if len(financas_to_create) >= BATCH_SIZE:
-                with transaction.atomic():
-                    ProcedimentoFinancas.objects.bulk_create(financas_to_create)
-                    print(f"--- Created batch of {len(financas_to_create)} new records ---")
-                financas_to_create = []
-
-        # --- Perform Final DB Operations ---
-        # Bulk create any remaining procedures
-        if procedimentos_to_create:
-            with transaction.atomic():
-                created_procs = Procedimento.objects.bulk_create(procedimentos_to_create)
-                print(f"--- Bulk created final batch of {len(created_procs)} procedimentos ---")
-                for financa_data, proc_idx in financas_pending_proc:
-                    financa_data['procedimento'] = created_procs[proc_idx]
-                    financas_to_create.append(ProcedimentoFinancas(**financa_data))
-                for proc in created_procs:
-                    all_procs_list.append(proc)
-        
-        # Save any remaining procedure updates
-        if procedimentos_to_update:
-            with transaction.atomic():
-                Procedimento.objects.bulk_update(list(procedimentos_to_update.values()), PROCEDIMENTO_UPDATE_FIELDS)
-                print(f"--- Bulk updated final batch of {len(procedimentos_to_update)} procedimentos ---")
-        
-        # Save any remaining financas updates
-        if financas_to_update:
-            with transaction.atomic():
-                ProcedimentoFinancas.objects.bulk_update(financas_to_update, FINANCAS_UPDATE_FIELDS)
-                updated_records_count += len(financas_to_update)
-                print(f"--- Bulk updated final batch of {len(financas_to_update)} financas ---")
-
-        # Save any remaining creates
-        if financas_to_create:
-            with transaction.atomic():
-                ProcedimentoFinancas.objects.bulk_create(financas_to_create)
-                print(f"--- Created final batch of {len(financas_to_create)} new records ---")
-
-        # --- Final Reporting ---
-        unprocessed_api_cpsa_ids = set(guias_dict.keys()) - processed_cpsa_ids 
-        print(f"--- Conciliation Finished. Updated: {updated_records_count}, Created: {newly_created_count}, Linked: {newly_linked_count}, Unprocessed API CPSA: {len(unprocessed_api_cpsa_ids)} ---")
-        if unprocessed_api_cpsa_ids: 
-            print(f"Warning: {len(unprocessed_api_cpsa_ids)} CPSA numbers from API were not processed: {list(unprocessed_api_cpsa_ids)}")
-            api_errors.append(f"{len(unprocessed_api_cpsa_ids)} guias da API não foram processadas.")
-        summary_message = []
-        if updated_records_count > 0: summary_message.append(f"{updated_records_count} registros atualizados.")
-        if newly_created_count > 0: summary_message.append(f"{newly_created_count} novos registros financeiros criados.")
-        # Note: newly_linked_count now also includes links to newly created Procedimentos.
-        # We could also add a counter for newly_created_procedimentos if needed for the summary.
-        if newly_linked_count > 0: summary_message.append(f"{newly_linked_count} vínculos financeiros estabelecidos/atualizados com procedimentos.")
-
-        final_message = " ".join(summary_message) if summary_message else "Nenhuma alteração financeira processada."
-        if api_errors: final_message += " Erros: " + " ".join(api_errors)
+        job = enqueue_conciliacao(group, user, force_full=force_full)
 
+    try:
+        wait_seconds = float(request.GET.get('wait') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Parâmetro wait inválido'}, status=400)
+    if wait_seconds > 0:
+        job = wait_for_job(job, wait_seconds)
 
+    if job.status == 'failed':
+        return JsonResponse({'error': f'Erro durante a conciliação: {job.error_message}', 'job_id': job.id}, status=500)
+    if job.status != 'completed':
         return JsonResponse({
-            'success': True, 'message': final_message,
-            'updated_count': updated_records_count, 'created_count': newly_created_count, # This is ProcedimentoFinancas created
-            'linked_count': newly_linked_count,
-            'unprocessed_cpsa_count': len(unprocessed_api_cpsa_ids),
-            'unprocessed_cpsa_ids': list(unprocessed_api_cpsa_ids),
-            'api_errors': api_errors
-        })
-
-    except requests.exceptions.RequestException as e:
-        print(f"!!! API Request Exception: {str(e)}")
-        return JsonResponse({'error': f'Erro na comunicação com a API: {str(e)}'}, status=500)
-    except Exception as e:
-        import traceback
-        print(f"!!! Conciliation Exception: {str(e)}")
-        traceback.print_exc()
-        return JsonResponse({'error': f'Erro interno durante a conciliação: {str(e)}'}, status=500)
+            'success': True,
+            'message': 'Conciliação em andamento.',
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': reverse('status_conciliacao', args=[job.id]),
+        }, status=202)
+
+    summary_message = []
+    if job.updated_count > 0: summary_message.append(f"{job.updated_count} registros atualizados.")
+    if job.created_count > 0: summary_message.append(f"{job.created_count} novos registros financeiros criados.")
+    if job.linked_count > 0: summary_message.append(f"{job.linked_count} vínculos financeiros estabelecidos/atualizados com procedimentos.")
+    return JsonResponse({
+        'success': True,
+        'message': " ".join(summary_message) if summary_message else "Nenhuma alteração financeira processada.",
+        'job_id': job.id,
+        'status': job.status,
+        'updated_count': job.updated_count,
+        'created_count': job.created_count,
+        'linked_count': job.linked_count,
+        'skipped_count': job.skipped_count,
+    })
 
 
 # ===== CONCILIAÇÃO EM BACKGROUND =====
 
+# Progress stream (stream_conciliacao): job row poll interval, keepalive comment
+# interval, connection lifetime before the client reconnects, client retry delay
+SSE_POLL_SECONDS = 1.0
+SSE_KEEPALIVE_SECONDS = 15
+SSE_MAX_SECONDS = 300
+SSE_RETRY_MILLISECONDS = 3000
+
 @login_required
 def iniciar_conciliacao_async(request):
     """
-    Inicia a conciliação em background e retorna imediatamente.
-    O frontend faz polling em status_conciliacao para acompanhar o progresso.
+    Enfileira a conciliação e retorna imediatamente.
+    Um worker (`manage.py conciliacao_worker`) processa o job; o frontend faz
+    polling em status_conciliacao para acompanhar o progresso.
     """
     if not request.user.validado:
         logout(request)
@@ -1827,50 +936,26 @@ def iniciar_conciliacao_async(request):
     if not user.connection_key:
         return JsonResponse({'error': 'Chave de conexão não configurada'}, status=400)
     
-    # Auto-cleanup: Mark jobs stuck in 'running' for > 30 minutes as 'failed'
-    stale_cutoff = timezone.now() - timedelta(minutes=30)
-    stale_jobs = ConciliacaoJob.objects.filter(
-        group=group,
-        status='running',
-        started_at__lt=stale_cutoff
-    )
-    stale_count = stale_jobs.update(
-        status='failed',
-        error_message='Job marcado como falho automaticamente (timeout de 30 minutos)',
-        completed_at=timezone.now()
-    )
-    if stale_count > 0:
-        print(f"[CONCILIACAO] Auto-cleaned {stale_count} stale jobs for group {group.name}")
+    # Jobs whose worker stopped sending heartbeats go back to the queue (or fail)
+    requeued, failed = requeue_abandoned_jobs()
+    if requeued or failed:
+        logger.warning("[CONCILIACAO] Requeued %d and failed %d abandoned jobs", requeued, failed)
     
-    # Check if there's already a running job (that isn't stale)
-    running_job = ConciliacaoJob.objects.filter(group=group, status='running').first()
-    if running_job:
+    # Check if there's already a queued or running job for this group
+    active_job = active_job_for_group(group)
+    if active_job:
         return JsonResponse({
             'error': 'Já existe uma conciliação em andamento.',
-            'job_id': running_job.id
+            'job_id': active_job.id
         }, status=409)
     
-    # Create new job
-    job = ConciliacaoJob.objects.create(
-        group=group,
-        status='pending',
-        current_step='Iniciando conciliação...'
-    )
     fast = request.GET.get('fast') == '1'
     force_full = request.GET.get('full') == '1' or not fast
-    
-    # Start background thread
-    def run_conciliation():
-        from django.db import connection
-        connection.close()  # Close connection before threading
-        _run_conciliacao_background(job.id, user.id, force_full=force_full)
-    
-    thread = threading.Thread(target=run_conciliation, daemon=True)
-    thread.start()
+    job = enqueue_conciliacao(group, user, force_full=force_full)
     
     return JsonResponse({
         'success': True,
-        'message': 'Conciliação iniciada em background.',
+        'message': 'Conciliação enfileirada para processamento em background.',
         'job_id': job.id
     })
 
@@ -1893,7 +978,11 @@ def status_conciliacao(request, job_id):
     if job.group != request.user.group:
         return JsonResponse({'error': 'Acesso negado'}, status=403)
     
-    return JsonResponse({
+    return JsonResponse(_job_status_payload(job))
+
+
+def _job_status_payload(job):
+    return {
         'job_id': job.id,
         'status': job.status,
         'current_step': job.current_step,
@@ -1903,18 +992,90 @@ def status_conciliacao(request, job_id):
         'created_count': job.created_count,
         'updated_count': job.updated_count,
         'linked_count': job.linked_count,
+        'skipped_count': job.skipped_count,
+        'changed_count': job.changed_count,
+        'new_count': job.new_count,
+        'candidate_lookups': job.candidate_lookups,
+        'candidate_avg': job.candidate_avg,
+        'candidate_max': job.candidate_max,
         'error_message': job.error_message,
+        'trigger': job.trigger,
+        'duration_seconds': job.duration_seconds,
+        'guias_per_second': job.guias_per_second,
         'completed_at': job.completed_at.isoformat() if job.completed_at else None
-    })
+    }
+
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _conciliacao_events(job_id, poll_seconds=None, max_seconds=None):
+    """
+    Server-sent events for a job: the full status first, then only the fields
+    that changed, read from the job row every poll_seconds. Ends with a 'done'
+    event once the job finishes, or silently after max_seconds (EventSource
+    reconnects and receives the full status again).
+    """
+    poll_seconds = SSE_POLL_SECONDS if poll_seconds is None else poll_seconds
+    max_seconds = SSE_MAX_SECONDS if max_seconds is None else max_seconds
+    started = last_sent = time_module.monotonic()
+    previous = {}
+    yield f"retry: {SSE_RETRY_MILLISECONDS}\n\n"
+    while True:
+        job = await ConciliacaoJob.objects.filter(pk=job_id).afirst()
+        if job is None:
+            yield _sse_event('done', {'status': 'missing'})
+            return
+        payload = _job_status_payload(job)
+        delta = {key: value for key, value in payload.items() if key not in previous or previous[key] != value}
+        now = time_module.monotonic()
+        if delta:
+            yield _sse_event('progress', delta)
+            previous = payload
+            last_sent = now
+        elif now - last_sent >= SSE_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = now
+        if job.status in ('completed', 'failed'):
+            yield _sse_event('done', {'status': job.status})
+            return
+        if now - started >= max_seconds:
+            return
+        await asyncio.sleep(poll_seconds)
+
+
+async def stream_conciliacao(request, job_id):
+    """
+    Stream do progresso de um job (text/event-stream), alternativa ao polling
+    de status_conciliacao: a autenticação é feita uma vez por conexão.
+    Deve ser servido via ASGI (clinic_erp/asgi.py) para não prender um worker.
+    """
+    user = await request.auser()
+    if not user.is_authenticated or not user.validado:
+        return JsonResponse({'error': 'Sessão expirada.'}, status=401)
+
+    job = await ConciliacaoJob.objects.filter(pk=job_id).afirst()
+    if job is None:
+        return JsonResponse({'error': 'Job não encontrado'}, status=404)
+    if job.group_id != user.group_id:
+        return JsonResponse({'error': 'Acesso negado'}, status=403)
+
+    response = StreamingHttpResponse(_conciliacao_events(job.pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 def _run_conciliacao_background(job_id, user_id, force_full=False):
     """
-    Executa a conciliação em background. Esta função roda em uma thread separada.
+    Executa a conciliação em background. Chamada pelo worker (jobs.run_job)
+    depois de reivindicar o job na fila.
     Atualiza o ConciliacaoJob com progresso durante a execução.
     """
     from django.contrib.auth import get_user_model
     User = get_user_model()
+    run_started = time_module.monotonic()
     
     try:
         job = ConciliacaoJob.objects.get(id=job_id)
@@ -1925,44 +1086,50 @@ def _run_conciliacao_background(job_id, user_id, force_full=False):
         user = User.objects.get(id=user_id)
         group = job.group
         
-        # --- Fetch API Data ---
-        api_url = f"{settings.COOPAHUB_API['BASE_URL']}/portal/guias/ajaxGuias.php"
+        # --- Stream API Data (one month window at a time) ---
         start_date = _get_conciliation_start_date(group, force_full=force_full)
-        api_payload = {
-            "conexao": user.connection_key,
-            "periodo_de": start_date.strftime('%Y-%m-%d'),
-            "periodo_ate": timezone.now().strftime('%Y-%m-%d'),
-            "status": "Listagem Geral",
-            "coopahub": "S"
-        }
-        response = requests.post(api_url, json=api_payload, timeout=120)
-        response.raise_for_status()
-        api_response_data = response.json()
+
+        # Counters restart on every attempt; guides already committed by a previous
+        # attempt are skipped through the checkpoint but still counted as processed.
+        job.total_guias = 0
+        job.processed_count = 0
+        checkpoint = ConciliacaoCheckpoint(job)
+
+        def on_window(periodo_de, periodo_ate, guias_count, window_hash):
+            checkpoint.on_window(periodo_de, periodo_ate, guias_count, window_hash)
+            job.total_guias += guias_count
+            job.current_step = f'Processando guias de {periodo_de.strftime("%m/%Y")}...'
+            job.save(update_fields=['total_guias', 'current_step'])
+
+        guias_items = iter_guias(user.connection_key, start_date, on_window=on_window)
         
-        if api_response_data.get('erro') != '000':
+        # Run the actual conciliation process
+        try:
+            ConciliacaoEngine(
+                group, start_date=start_date, checkpoint=checkpoint,
+                sinks=[JobProgressSink(job), LogProgressSink(f'{group.name} (job {job.id})')],
+            ).run(guias_items)
+        except GuiasAPIError as e:
             job.status = 'failed'
-            job.error_message = f"API Error: {api_response_data.get('msg', 'Unknown')}"
-            job.save()
+            job.completed_at = timezone.now()
+            job.error_message = str(e)
+            job_run_stats(job, time_module.monotonic() - run_started)
+            with transaction.atomic():
+                job.save()
+                refresh_watermark(group)
+            refresh_rollup(group)
             return
         
-        guias = api_response_data.get('listaguias', [])
-        guias_dict = {
-            str(g['nrocpsa']): g for g in guias
-            if g.get('nrocpsa') and str(g.get('nrocpsa')).strip()
-        }
-        
-        guias_items = _sorted_guias_newest_first(guias_dict)
-        job.total_guias = len(guias_items)
-        job.current_step = f'Processando {job.total_guias} guias...'
-        job.save()
-        
-        # Run the actual conciliation process
-        _execute_conciliation_logic(job, user, group, guias_items, start_date=start_date)
-        
         job.status = 'completed'
         job.completed_at = timezone.now()
         job.current_step = 'Concluído!'
-        job.save()
+        job_run_stats(job, time_module.monotonic() - run_started)
+        with transaction.atomic():
+            job.save()
+            refresh_watermark(group)
+        # Rebuild the months the run touched before the dashboard asks for them
+        refresh_rollup(group)
+        checkpoint.clear()
         
     except Exception as e:
         import traceback
@@ -1970,662 +1137,16 @@ def _run_conciliacao_background(job_id, user_id, force_full=False):
         try:
             job = ConciliacaoJob.objects.get(id=job_id)
             job.status = 'failed'
+            job.completed_at = timezone.now()
             job.error_message = str(e)
-            job.save()
+            job_run_stats(job, time_module.monotonic() - run_started)
+            with transaction.atomic():
+                job.save()
+                refresh_watermark(job.group)
         except:
             pass
 
 
-def _execute_conciliation_logic(job, user, group, guias_items, start_date=None):
-    """
-    Core conciliation logic - processes guides and updates job progress.
-    Similar to conciliar_financas but updates job.processed_count periodically.
-    """
-    from collections import defaultdict
-    
-    # Fetch existing data
-    financas_qs = ProcedimentoFinancas.objects.filter(
-        Q(procedimento__group=group) | Q(group=group)
-    ).select_related('procedimento')
-    financas_dict_by_cpsa = {f.cpsa: f for f in financas_qs if f.cpsa}
-
-    guias_cpsa_ids = {cpsa_id for cpsa_id, _ in guias_items}
-    missing_cpsa_ids = guias_cpsa_ids - set(financas_dict_by_cpsa.keys())
-    unlinked_financas_exists = financas_qs.filter(procedimento__isnull=True).exists()
-    needs_procedure_matching = bool(missing_cpsa_ids) or unlinked_financas_exists
-
-    cutoff_date = start_date or DATA_INICIO_PUXAR_GUIAS_API
-    all_procs_list = []
-    proc_lookup_dict = defaultdict(list)
-    hospital_cache = {}
-    convenio_cache = {}
-    surgeon_cache = {}
-    anesthesiologist_cache = {}
-    proc_detalhes_cache = {}
-
-    if needs_procedure_matching:
-        all_procs_qs = Procedimento.objects.filter(
-            group=group,
-            data_horario__date__gte=cutoff_date
-        ).select_related('hospital', 'convenio').prefetch_related('financas_records')
-        all_procs_list = list(all_procs_qs)
-        
-        # Build lookup dictionaries
-        for proc in all_procs_list:
-            if proc.nome_paciente and proc.data_horario:
-                key = (proc.nome_paciente.strip().lower(), proc.data_horario.date())
-                proc_lookup_dict[key].append(proc)
-        
-        # Build entity caches
-        hospital_cache = {h.name.lower(): h for h in HospitalClinic.objects.filter(group=group)}
-        convenio_cache = {c.name.lower(): c for c in Convenios.objects.all()}
-        surgeon_cache = {s.name.lower(): s for s in Surgeon.objects.filter(group=group) if s.name}
-        anesthesiologist_cache = {a.name.lower(): a for a in Anesthesiologist.objects.filter(group=group) if a.name}
-        proc_detalhes_cache = {pd.codigo_procedimento: pd for pd in ProcedimentoDetalhes.objects.all() if pd.codigo_procedimento}
-    
-    # Processing
-    financas_to_update = []
-    financas_to_create = []
-    procedimentos_to_update = {}
-    procedimentos_to_create = []
-    financas_pending_proc = []
-    processed_cpsa_ids = set()
-    
-    BATCH_SIZE = 20  # Smaller batch size for faster table refresh and real-time updates
-    FINANCAS_UPDATE_FIELDS = [
-        'valor_faturado', 'valor_recebido', 'valor_recuperado', 'valor_acatado',
-        'status_pagamento', 'api_paciente_nome', 'api_hospital_nome', 'api_cooperado_nome',
-        'matricula', 'senha', 'api_data_cirurgia', 'plantao_eletiva', 'procedimento'
-    ]
-    PROCEDIMENTO_UPDATE_FIELDS = [
-        'data_horario', 'data_horario_fim', 'cpf_paciente', 'data_nascimento',
-        'acomodacao', 'cirurgiao', 'hospital', 'cooperado', 'procedimento_principal', 'procedimento_type'
-    ]
-    
-    processed_count = 0
-    update_interval = 20  # More granular progress updates
-    
-    for cpsa_id, guia in guias_items:
-        processed_cpsa_ids.add(cpsa_id)
-        processed_count += 1
-        
-        # Update job progress periodically
-        if processed_count % update_interval == 0 or processed_count == job.total_guias:
-            job.processed_count = processed_count
-            job.current_step = f'Processando guia {processed_count} de {job.total_guias}...'
-            job.save(update_fields=['processed_count', 'current_step'])
-        
-        guia_paciente = guia.get('paciente')
-        guia_date_str = guia.get('dt_cirurg', guia.get('dt_cpsa'))
-        guia_date = parse_api_date(guia_date_str)
-        
-        if cpsa_id in financas_dict_by_cpsa:
-            financa = financas_dict_by_cpsa[cpsa_id]
-            
-            # Skip records that are already finalized - no need to update them
-            if financa.status_pagamento == 'processo_finalizado':
-                continue
-            
-            # Update existing financa
-            updated = False
-            guia_valor_faturado = _api_decimal(guia.get('valor_faturado'))
-            guia_valor_recebido = _api_decimal(guia.get('valor_recebido'))
-            guia_valor_recuperado = _api_decimal(guia.get('valor_receuperado', guia.get('valor_recuperado')))
-            guia_valor_acatado = _api_decimal(guia.get('valor_acatado'))
-
-            if guia_valor_faturado is not None and financa.valor_faturado != guia_valor_faturado:
-                financa.valor_faturado = guia_valor_faturado; updated = True
-            if guia_valor_recebido is not None and financa.valor_recebido != guia_valor_recebido:
-                financa.valor_recebido = guia_valor_recebido; updated = True
-            if guia_valor_recuperado is not None and financa.valor_recuperado != guia_valor_recuperado:
-                financa.valor_recuperado = guia_valor_recuperado; updated = True
-            if guia_valor_acatado is not None and financa.valor_acatado != guia_valor_acatado:
-                financa.valor_acatado = guia_valor_acatado; updated = True
-            
-            api_status = map_api_status(guia.get('STATUS'))
-            if financa.status_pagamento != api_status:
-                financa.status_pagamento = api_status; updated = True
-            if financa.api_paciente_nome != guia.get('paciente'):
-                financa.api_paciente_nome = guia.get('paciente'); updated = True
-            if financa.api_hospital_nome != guia.get('hospital'):
-                financa.api_hospital_nome = guia.get('hospital'); updated = True
-            if financa.api_cooperado_nome != guia.get('cooperado'):
-                financa.api_cooperado_nome = guia.get('cooperado'); updated = True
-            if financa.matricula != guia.get('matricula'):
-                financa.matricula = guia.get('matricula'); updated = True
-            if financa.senha != guia.get('senha'):
-                financa.senha = guia.get('senha'); updated = True
-            guia_api_date_parsed = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-            if financa.api_data_cirurgia != guia_api_date_parsed:
-                financa.api_data_cirurgia = guia_api_date_parsed; updated = True
-            if financa.plantao_eletiva != guia.get('classificacao'):
-                financa.plantao_eletiva = guia.get('classificacao'); updated = True
-            if updated:
-                if financa not in financas_to_update: financas_to_update.append(financa)
-            
-            # PERFORMANCE FIX: Only attempt matching if it's currently unlinked
-            if not financa.procedimento and needs_procedure_matching:
-                best_match_proc = find_comprehensive_procedure_match(all_procs_list, guia, group)
-                if best_match_proc:
-                    # Update procedure using caches (FAST)
-                    was_updated, updated_proc = update_procedimento_with_api_data_cached(
-                        best_match_proc, guia, group, 
-                        hospital_cache, convenio_cache, surgeon_cache, 
-                        anesthesiologist_cache, proc_detalhes_cache,
-                        save_immediately=False
-                    )
-                    if was_updated:
-                        procedimentos_to_update[updated_proc.id] = updated_proc
-                    
-                    financa.procedimento = best_match_proc
-                    job.linked_count += 1
-                    if financa not in financas_to_update: financas_to_update.append(financa)
-            
-        else:
-            # New financa
-            best_match_proc = None
-            if guia_paciente and guia_date:
-                lookup_key = (guia_paciente.strip().lower(), guia_date)
-                candidate_procs = proc_lookup_dict.get(lookup_key, [])
-                if not candidate_procs:
-                    next_day = guia_date + timedelta(days=1)
-                    prev_day = guia_date - timedelta(days=1)
-                    candidate_procs = (
-                        proc_lookup_dict.get((guia_paciente.strip().lower(), next_day), []) +
-                        proc_lookup_dict.get((guia_paciente.strip().lower(), prev_day), [])
-                    )
-                
-                highest_similarity = 0.7
-                for proc in candidate_procs:
-                    name_similarity = similar(guia_paciente.lower(), proc.nome_paciente.lower())
-                    proc_date = proc.data_horario.date() if proc.data_horario else None
-                    date_diff = abs((guia_date - proc_date).days) if proc_date else float('inf')
-                    if name_similarity > 0.85 and date_diff <= 1 and name_similarity > highest_similarity:
-                        highest_similarity = name_similarity
-                        best_match_proc = proc
-            
-            if best_match_proc:
-                was_updated, updated_proc = update_procedimento_with_api_data_cached(
-                    best_match_proc, guia, group, 
-                    hospital_cache, convenio_cache, surgeon_cache, 
-                    anesthesiologist_cache, proc_detalhes_cache,
-                    save_immediately=False
-                )
-                if was_updated:
-                    procedimentos_to_update[updated_proc.id] = updated_proc
-                
-                new_financa = ProcedimentoFinancas(
-                    procedimento=best_match_proc, group=group, tipo_cobranca='cooperativa', cpsa=cpsa_id,
-                    valor_faturado=guia.get('valor_faturado'), valor_recebido=guia.get('valor_recebido'),
-                    status_pagamento=map_api_status(guia.get('STATUS')), api_paciente_nome=guia.get('paciente'),
-                    api_data_cirurgia=guia_date, api_hospital_nome=guia.get('hospital'),
-                    api_cooperado_nome=guia.get('cooperado'), matricula=guia.get('matricula'),
-                    senha=guia.get('senha'), plantao_eletiva=guia.get('classificacao')
-                )
-                financas_to_create.append(new_financa)
-                job.linked_count += 1
-            else:
-                if guia_paciente and guia_date:
-                    try:
-                        proc_obj = prepare_procedimento_from_guia(
-                            guia, cpsa_id, group, hospital_cache, convenio_cache,
-                            surgeon_cache, anesthesiologist_cache, proc_detalhes_cache
-                        )
-                        if proc_obj:
-                            procedimentos_to_create.append(proc_obj)
-                            financa_data = {
-                                'group': group, 'tipo_cobranca': 'cooperativa', 'cpsa': cpsa_id,
-                                'valor_faturado': guia.get('valor_faturado'), 'valor_recebido': guia.get('valor_recebido'),
-                                'status_pagamento': map_api_status(guia.get('STATUS')), 'api_paciente_nome': guia.get('paciente'),
-                                'api_data_cirurgia': guia_date, 'api_hospital_nome': guia.get('hospital')
-                            }
-                            financas_pending_proc.append((financa_data, len(procedimentos_to_create) - 1))
-                    except Exception as e:
-                        print(f"Error preparing proc: {e}")
-        
-        # Batch saves - IMMEDIATELY commit after each batch for real-time visibility
-        if len(procedimentos_to_create) >= BATCH_SIZE:
-            with transaction.atomic():
-                created_procs = Procedimento.objects.bulk_create(procedimentos_to_create)
-                # Create financas records that were waiting for these procedures
-                pending_financas = []
-                for financa_data, proc_idx in financas_pending_proc:
-                    financa_data['procedimento'] = created_procs[proc_idx]
-                    pending_financas.append(ProcedimentoFinancas(**financa_data))
-                if pending_financas:
-                    ProcedimentoFinancas.objects.bulk_create(pending_financas)
-            job.created_count += len(procedimentos_to_create)
-            procedimentos_to_create = []
-            financas_pending_proc = []
-            job.save(update_fields=['created_count'])
-        
-        if len(financas_to_update) >= BATCH_SIZE:
-            with transaction.atomic():
-                ProcedimentoFinancas.objects.bulk_update(financas_to_update, FINANCAS_UPDATE_FIELDS)
-            job.updated_count += len(financas_to_update)
-            financas_to_update = []
-            job.save(update_fields=['updated_count'])
-        
-        if len(procedimentos_to_update) >= BATCH_SIZE:
-            with transaction.atomic():
-                Procedimento.objects.bulk_update(list(procedimentos_to_update.values()), PROCEDIMENTO_UPDATE_FIELDS)
-            procedimentos_to_update = {}
-        
-        if len(financas_to_create) >= BATCH_SIZE:
-            with transaction.atomic():
-                ProcedimentoFinancas.objects.bulk_create(financas_to_create)
-            financas_to_create = []
-    
-    # Final batch saves
-    if procedimentos_to_create:
-        with transaction.atomic():
-            created_procs = Procedimento.objects.bulk_create(procedimentos_to_create)
-            # Immediately create financas records for these procedures
-            pending_financas = []
-            for financa_data, proc_idx in financas_pending_proc:
-                financa_data['procedimento'] = created_procs[proc_idx]
-                pending_financas.append(ProcedimentoFinancas(**financa_data))
-            if pending_financas:
-                ProcedimentoFinancas.objects.bulk_create(pending_financas)
-        job.created_count += len(procedimentos_to_create)
-    
-    if procedimentos_to_update:
-        with transaction.atomic():
-            Procedimento.objects.bulk_update(list(procedimentos_to_update.values()), PROCEDIMENTO_UPDATE_FIELDS)
-    
-    if financas_to_update:
-        with transaction.atomic():
-            ProcedimentoFinancas.objects.bulk_update(financas_to_update, FINANCAS_UPDATE_FIELDS)
-        job.updated_count += len(financas_to_update)
-    
-    if financas_to_create:
-        with transaction.atomic():
-            ProcedimentoFinancas.objects.bulk_create(financas_to_create)
-    
-    job.processed_count = processed_count
-    job.save()
-
-
-def create_new_procedimento_from_guia(guia, cpsa_id, group):
-    """
-    Helper function to create a new Procedimento from API guide data.
-    This is separated to allow individual transaction handling.
-    cpsa_id parameter now contains the nrocpsa value from the API.
-    """
-    guia_paciente = guia.get('paciente')
-    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-    
-    # Parse API time information
-    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
-    guia_hora_final = parse_api_time(guia.get('hora_final'))
-    
-    # Create datetime with time if available, otherwise use midnight
-    proc_data_horario = None
-    proc_data_horario_fim = None
-    
-    if guia_date:
-        start_time = guia_hora_inicial if guia_hora_inicial else time(8, 0)  # Default to 8:00 AM
-        proc_data_horario = datetime.combine(guia_date, start_time)
-        proc_data_horario = make_aware_sao_paulo(proc_data_horario)
-        
-        if guia_hora_final:
-            proc_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
-            proc_data_horario_fim = make_aware_sao_paulo(proc_data_horario_fim)
-        else:
-            # Default end time to start time + 2 hours
-            proc_data_horario_fim = proc_data_horario + timedelta(hours=2)
-    
-    hospital_obj = None
-    api_hospital_name = guia.get('hospital')
-    if api_hospital_name and api_hospital_name.strip():
-        hospital_obj, _ = HospitalClinic.objects.get_or_create(
-            name__iexact=api_hospital_name.strip(),
-            defaults={'name': api_hospital_name.strip(), 'group': group}
-        )
-    
-    convenio_obj = None
-    api_convenio_name = guia.get('convenio')
-    if api_convenio_name and api_convenio_name.strip():
-        convenio_obj, _ = Convenios.objects.get_or_create(
-            name__iexact=api_convenio_name.strip(),
-            defaults={'name': api_convenio_name.strip()}
-        )
-
-    # Find or create surgeon
-    surgeon_obj = None
-    api_surgeon_name = guia.get('cirurgiao')
-    api_surgeon_crm = guia.get('crm_cirurgiao')
-    if api_surgeon_name and api_surgeon_name.strip():
-        surgeon_obj = find_or_create_surgeon(group, api_surgeon_name, api_surgeon_crm)
-
-    paciente_nome_para_proc = guia_paciente
-    if not paciente_nome_para_proc:
-        paciente_nome_para_proc = f"Paciente CPSA {cpsa_id}"
-
-    # Handle ProcedimentoDetalhes (procedimento_principal)
-    procedimento_principal_obj = None
-    api_procedimentos = guia.get('procedimentos')
-    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
-        principal_proc_data = api_procedimentos[0]
-        api_codigo = principal_proc_data.get('codigo')
-        api_descricao = principal_proc_data.get('descricao')
-        if api_codigo and api_descricao:
-            procedimento_principal_obj, created = ProcedimentoDetalhes.objects.get_or_create(
-                codigo_procedimento=api_codigo,
-                defaults={'name': api_descricao}
-            )
-            if not created:
-                if procedimento_principal_obj.name != api_descricao:
-                    procedimento_principal_obj.name = api_descricao
-                    procedimento_principal_obj.save() # Decide if overriding name is desired
-
-    proc_type = CIRURGIA_AMBULATORIAL_PROCEDIMENTO
-    if procedimento_principal_obj and procedimento_principal_obj.codigo_procedimento == '10101012':
-        proc_type = CONSULTA_PROCEDIMENTO
-
-    newly_created_procedimento = Procedimento.objects.create(
-        group=group,
-        nome_paciente=paciente_nome_para_proc,
-        cpf_paciente=guia.get('cpf') or guia.get('nr_cpf'), # Capture CPF
-        data_nascimento=parse_api_date(guia.get('data_nascimento')), # Capture birth date (API sends as 'data_nascimento')
-        acomodacao=guia.get('tip_acomod'), # Capture accommodation (API sends as 'tip_acomod')
-        data_horario=proc_data_horario,
-        data_horario_fim=proc_data_horario_fim,
-        hospital=hospital_obj,
-        convenio=convenio_obj,
-        cirurgiao=surgeon_obj,
-        procedimento_principal=procedimento_principal_obj, # Assign here
-        procedimento_type=proc_type,
-        status=STATUS_PENDING
-    )
-    print(f"Created new Procedimento ID {newly_created_procedimento.id} for patient '{newly_created_procedimento.nome_paciente}' from guide CPSA {cpsa_id}")
-
-    # Handle anesthesiologist
-    guia_cooperado = guia.get('cooperado')
-    if guia_cooperado:
-        anest_final = find_or_create_anesthesiologist(group, guia_cooperado)
-        if anest_final:
-            # Set as Cooperado (primary)
-            newly_created_procedimento.cooperado = anest_final
-            newly_created_procedimento.save(update_fields=['cooperado'])
-
-    return newly_created_procedimento
-
-
-def create_new_procedimento_from_guia_cached(guia, cpsa_id, group, hospital_cache, convenio_cache, 
-                                              surgeon_cache, anesthesiologist_cache, proc_detalhes_cache):
-    """
-    Optimized version of create_new_procedimento_from_guia that uses pre-built caches
-    instead of get_or_create for each entity. This dramatically reduces database queries.
-    """
-    guia_paciente = guia.get('paciente')
-    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-    
-    # Parse API time information
-    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
-    guia_hora_final = parse_api_time(guia.get('hora_final'))
-    
-    # Create datetime with time if available
-    proc_data_horario = None
-    proc_data_horario_fim = None
-    
-    if guia_date:
-        start_time = guia_hora_inicial if guia_hora_inicial else time(8, 0)
-        proc_data_horario = datetime.combine(guia_date, start_time)
-        proc_data_horario = make_aware_sao_paulo(proc_data_horario)
-        
-        if guia_hora_final:
-            proc_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
-            proc_data_horario_fim = make_aware_sao_paulo(proc_data_horario_fim)
-        else:
-            proc_data_horario_fim = proc_data_horario + timedelta(hours=2)
-    
-    # Use cache for hospital (only 1 query if creating new)
-    hospital_obj = None
-    api_hospital_name = guia.get('hospital')
-    if api_hospital_name and api_hospital_name.strip():
-        cache_key = api_hospital_name.strip().lower()
-        if cache_key in hospital_cache:
-            hospital_obj = hospital_cache[cache_key]
-        else:
-            hospital_obj, _ = HospitalClinic.objects.get_or_create(
-                name__iexact=api_hospital_name.strip(),
-                defaults={'name': api_hospital_name.strip(), 'group': group}
-            )
-            hospital_cache[cache_key] = hospital_obj  # Update cache
-    
-    # Use cache for convenio
-    convenio_obj = None
-    api_convenio_name = guia.get('convenio')
-    if api_convenio_name and api_convenio_name.strip():
-        cache_key = api_convenio_name.strip().lower()
-        if cache_key in convenio_cache:
-            convenio_obj = convenio_cache[cache_key]
-        else:
-            convenio_obj, _ = Convenios.objects.get_or_create(
-                name__iexact=api_convenio_name.strip(),
-                defaults={'name': api_convenio_name.strip()}
-            )
-            convenio_cache[cache_key] = convenio_obj
-    
-    # Use cache for surgeon (with similarity fallback)
-    surgeon_obj = None
-    api_surgeon_name = guia.get('cirurgiao')
-    if api_surgeon_name and api_surgeon_name.strip():
-        cache_key = api_surgeon_name.strip().lower()
-        if cache_key in surgeon_cache:
-            surgeon_obj = surgeon_cache[cache_key]
-        else:
-            # Try similarity match from cache
-            best_match = None
-            for cached_name, cached_surgeon in surgeon_cache.items():
-                if similar(cache_key, cached_name) > 0.85:
-                    best_match = cached_surgeon
-                    break
-            if best_match:
-                surgeon_obj = best_match
-            else:
-                # Create new
-                surgeon_obj = Surgeon.objects.create(
-                    name=api_surgeon_name.strip(),
-                    crm=guia.get('crm_cirurgiao'),
-                    group=group
-                )
-                surgeon_cache[cache_key] = surgeon_obj
-
-    paciente_nome_para_proc = guia_paciente or f"Paciente CPSA {cpsa_id}"
-
-    # Use cache for procedimento principal
-    procedimento_principal_obj = None
-    proc_type = CIRURGIA_AMBULATORIAL_PROCEDIMENTO
-    api_procedimentos = guia.get('procedimentos')
-    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
-        principal_proc_data = api_procedimentos[0]
-        api_codigo = principal_proc_data.get('codigo')
-        api_descricao = principal_proc_data.get('descricao')
-        if api_codigo and api_descricao:
-            if api_codigo in proc_detalhes_cache:
-                procedimento_principal_obj = proc_detalhes_cache[api_codigo]
-            else:
-                procedimento_principal_obj, _ = ProcedimentoDetalhes.objects.get_or_create(
-                    codigo_procedimento=api_codigo,
-                    defaults={'name': api_descricao}
-                )
-                proc_detalhes_cache[api_codigo] = procedimento_principal_obj
-            
-            if procedimento_principal_obj.codigo_procedimento == '10101012':
-                proc_type = CONSULTA_PROCEDIMENTO
-
-    # Resolve anesthesiologist (cooperado) using cache BEFORE create
-    cooperado_obj = None
-    guia_cooperado = guia.get('cooperado')
-    if guia_cooperado:
-        cache_key = guia_cooperado.strip().lower()
-        if cache_key in anesthesiologist_cache:
-            cooperado_obj = anesthesiologist_cache[cache_key]
-        else:
-            # Try similarity match
-            for cached_name, cached_anest in anesthesiologist_cache.items():
-                if similar(cache_key, cached_name) > 0.85:
-                    cooperado_obj = cached_anest
-                    break
-            if not cooperado_obj:
-                cooperado_obj = Anesthesiologist.objects.create(name=guia_cooperado.strip(), group=group)
-                anesthesiologist_cache[cache_key] = cooperado_obj
-
-    # Create the procedure with all data in a single query
-    newly_created_procedimento = Procedimento.objects.create(
-        group=group,
-        nome_paciente=paciente_nome_para_proc,
-        cpf_paciente=guia.get('cpf') or guia.get('nr_cpf'),
-        data_nascimento=parse_api_date(guia.get('data_nascimento')),
-        acomodacao=guia.get('tip_acomod'),
-        data_horario=proc_data_horario,
-        data_horario_fim=proc_data_horario_fim,
-        hospital=hospital_obj,
-        convenio=convenio_obj,
-        cirurgiao=surgeon_obj,
-        cooperado=cooperado_obj,  # Include cooperado in create
-        procedimento_principal=procedimento_principal_obj,
-        procedimento_type=proc_type,
-        status=STATUS_PENDING
-    )
-
-    return newly_created_procedimento
-
-
-def prepare_procedimento_from_guia(guia, cpsa_id, group, hospital_cache, convenio_cache,
-                                    surgeon_cache, anesthesiologist_cache, proc_detalhes_cache):
-    """
-    Prepare a Procedimento object WITHOUT saving to database.
-    Returns the unsaved object for bulk_create.
-    Similar to create_new_procedimento_from_guia_cached but doesn't call .create()
-    """
-    guia_paciente = guia.get('paciente')
-    guia_date = parse_api_date(guia.get('dt_cirurg', guia.get('dt_cpsa')))
-    
-    guia_hora_inicial = parse_api_time(guia.get('hora_inicial'))
-    guia_hora_final = parse_api_time(guia.get('hora_final'))
-    
-    proc_data_horario = None
-    proc_data_horario_fim = None
-    
-    if guia_date:
-        start_time = guia_hora_inicial if guia_hora_inicial else time(8, 0)
-        proc_data_horario = datetime.combine(guia_date, start_time)
-        proc_data_horario = make_aware_sao_paulo(proc_data_horario)
-        
-        if guia_hora_final:
-            proc_data_horario_fim = datetime.combine(guia_date, guia_hora_final)
-            proc_data_horario_fim = make_aware_sao_paulo(proc_data_horario_fim)
-        else:
-            proc_data_horario_fim = proc_data_horario + timedelta(hours=2)
-    
-    # Use cache for hospital
-    hospital_obj = None
-    api_hospital_name = guia.get('hospital')
-    if api_hospital_name and api_hospital_name.strip():
-        cache_key = api_hospital_name.strip().lower()
-        if cache_key in hospital_cache:
-            hospital_obj = hospital_cache[cache_key]
-        else:
-            hospital_obj, _ = HospitalClinic.objects.get_or_create(
-                name__iexact=api_hospital_name.strip(),
-                defaults={'name': api_hospital_name.strip(), 'group': group}
-            )
-            hospital_cache[cache_key] = hospital_obj
-    
-    # Use cache for convenio
-    convenio_obj = None
-    api_convenio_name = guia.get('convenio')
-    if api_convenio_name and api_convenio_name.strip():
-        cache_key = api_convenio_name.strip().lower()
-        if cache_key in convenio_cache:
-            convenio_obj = convenio_cache[cache_key]
-        else:
-            convenio_obj, _ = Convenios.objects.get_or_create(
-                name__iexact=api_convenio_name.strip(),
-                defaults={'name': api_convenio_name.strip()}
-            )
-            convenio_cache[cache_key] = convenio_obj
-    
-    # Use cache for surgeon
-    surgeon_obj = None
-    api_surgeon_name = guia.get('cirurgiao')
-    if api_surgeon_name and api_surgeon_name.strip():
-        cache_key = api_surgeon_name.strip().lower()
-        if cache_key in surgeon_cache:
-            surgeon_obj = surgeon_cache[cache_key]
-        else:
-            for cached_name, cached_surgeon in surgeon_cache.items():
-                if similar(cache_key, cached_name) > 0.85:
-                    surgeon_obj = cached_surgeon
-                    break
-            if not surgeon_obj:
-                surgeon_obj = Surgeon.objects.create(
-                    name=api_surgeon_name.strip(),
-                    crm=guia.get('crm_cirurgiao'),
-                    group=group
-                )
-                surgeon_cache[cache_key] = surgeon_obj
-
-    paciente_nome_para_proc = guia_paciente or f"Paciente CPSA {cpsa_id}"
-
-    # Use cache for procedimento principal
-    procedimento_principal_obj = None
-    proc_type = CIRURGIA_AMBULATORIAL_PROCEDIMENTO
-    api_procedimentos = guia.get('procedimentos')
-    if api_procedimentos and isinstance(api_procedimentos, list) and len(api_procedimentos) > 0:
-        principal_proc_data = api_procedimentos[0]
-        api_codigo = principal_proc_data.get('codigo')
-        api_descricao = principal_proc_data.get('descricao')
-        if api_codigo and api_descricao:
-            if api_codigo in proc_detalhes_cache:
-                procedimento_principal_obj = proc_detalhes_cache[api_codigo]
-            else:
-                procedimento_principal_obj, _ = ProcedimentoDetalhes.objects.get_or_create(
-                    codigo_procedimento=api_codigo,
-                    defaults={'name': api_descricao}
-                )
-                proc_detalhes_cache[api_codigo] = procedimento_principal_obj
-            
-            if procedimento_principal_obj.codigo_procedimento == '10101012':
-                proc_type = CONSULTA_PROCEDIMENTO
-
-    # Resolve cooperado using cache
-    cooperado_obj = None
-    guia_cooperado = guia.get('cooperado')
-    if guia_cooperado:
-        cache_key = guia_cooperado.strip().lower()
-        if cache_key in anesthesiologist_cache:
-            cooperado_obj = anesthesiologist_cache[cache_key]
-        else:
-            for cached_name, cached_anest in anesthesiologist_cache.items():
-                if similar(cache_key, cached_name) > 0.85:
-                    cooperado_obj = cached_anest
-                    break
-            if not cooperado_obj:
-                cooperado_obj = Anesthesiologist.objects.create(name=guia_cooperado.strip(), group=group)
-                anesthesiologist_cache[cache_key] = cooperado_obj
-
-    # Return unsaved Procedimento object (for bulk_create)
-    return Procedimento(
-        group=group,
-        nome_paciente=paciente_nome_para_proc,
-        cpf_paciente=guia.get('cpf') or guia.get('nr_cpf'),
-        data_nascimento=parse_api_date(guia.get('data_nascimento')),
-        acomodacao=guia.get('tip_acomod'),
-        data_horario=proc_data_horario,
-        data_horario_fim=proc_data_horario_fim,
-        hospital=hospital_obj,
-        convenio=convenio_obj,
-        cirurgiao=surgeon_obj,
-        cooperado=cooperado_obj,
-        procedimento_principal=procedimento_principal_obj,
-        procedimento_type=proc_type,
-        status=STATUS_PENDING
-    )
-
 
 @login_required
 def get_despesa_recorrente_item(request, id):
@@ -0,0 +1,92 @@
+"""
+Per-group conciliation watermark (ConciliacaoWatermark).
+
+The incremental start date depends on the group's last completed job and on
+the oldest surgery date among its finance records still awaiting payment.
+Both are kept on one row per group, so starting a job is a primary-key read:
+
+- the conciliation recomputes the row (refresh_watermark) in the transaction
+  that marks its job finished;
+- finance and procedure saves only move oldest_pending_date back
+  (lower_oldest_pending, see financas.signals), which keeps the window
+  conservative until the next refresh.
+
+A group without a row gets one computed on first use.
+"""
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import ConciliacaoJob, ConciliacaoWatermark, ProcedimentoFinancas
+
+
+PENDING_STATUSES = ('em_processamento', 'aguardando_pagamento', 'recurso_de_glosa')
+
+
+def local_date(value):
+    """Date of a (possibly naive) datetime in the local timezone."""
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+def pending_financas(group):
+    return ProcedimentoFinancas.objects.filter(group=group, status_pagamento__in=PENDING_STATUSES)
+
+
+def compute_oldest_pending_date(group):
+    """Oldest local procedure date or API surgery date of the group's pending finance rows."""
+    pending_qs = pending_financas(group)
+    candidates = []
+    oldest_data_horario = (
+        pending_qs
+        .exclude(procedimento__data_horario__isnull=True)
+        .order_by('procedimento__data_horario')
+        .values_list('procedimento__data_horario', flat=True)
+        .first()
+    )
+    if oldest_data_horario:
+        candidates.append(local_date(oldest_data_horario))
+    oldest_api_date = (
+        pending_qs
+        .exclude(api_data_cirurgia__isnull=True)
+        .order_by('api_data_cirurgia')
+        .values_list('api_data_cirurgia', flat=True)
+        .first()
+    )
+    if oldest_api_date:
+        candidates.append(oldest_api_date)
+    return min(candidates) if candidates else None
+
+
+def refresh_watermark(group):
+    """Recompute the group's watermark from the jobs and finance rows; returns it."""
+    last_completed_at = (
+        ConciliacaoJob.objects
+        .filter(group=group, status='completed')
+        .aggregate(last=Max('completed_at'))['last']
+    )
+    watermark, _ = ConciliacaoWatermark.objects.update_or_create(
+        group=group,
+        defaults={
+            'last_completed_at': last_completed_at,
+            'oldest_pending_date': compute_oldest_pending_date(group),
+        },
+    )
+    return watermark
+
+
+def get_watermark(group):
+    return ConciliacaoWatermark.objects.filter(pk=group.pk).first() or refresh_watermark(group)
+
+
+def lower_oldest_pending(group_ids, day):
+    """Move oldest_pending_date of the groups' existing watermarks back to day, if earlier."""
+    group_ids = [group_id for group_id in group_ids if group_id]
+    if not group_ids or day is None:
+        return 0
+    return (
+        ConciliacaoWatermark.objects
+        .filter(pk__in=group_ids)
+        .filter(Q(oldest_pending_date__isnull=True) | Q(oldest_pending_date__gt=day))
+        .update(oldest_pending_date=day, atualizado_em=timezone.now())
+    )